@@ -0,0 +1,182 @@
+/**
+ * Elastic Git Sync - baseline helpers shared by the hooks in main.pb.js
+ *
+ * Loaded inside each handler with require(__hooks + "/baseline.js"), since
+ * PocketBase JSVM handlers cannot see functions defined at file level.
+ *
+ * rule_snapshots is the authoritative baseline. Every write to it is
+ * mirrored into the sync service's baseline store (/baseline/commit), so
+ * detections send use_baseline_store instead of every snapshot; the store
+ * is reseeded from rule_snapshots whenever it is empty or out of step.
+ */
+
+function esc(v) {
+  return String(v || "").replace(/\\/g, "\\\\").replace(/'/g, "\\'");
+}
+
+// PocketBase JSVM may return JSON fields as byte arrays
+function decodeJsonField(value, fallback) {
+  if (!value || typeof value[0] !== "number") return value || fallback;
+  var str = "";
+  for (var i = 0; i < value.length; i++) str += String.fromCharCode(value[i]);
+  try { str = decodeURIComponent(escape(str)); } catch(ue) {}
+  try { return JSON.parse(str); } catch (err) { return fallback; }
+}
+
+function loadRuleSnapshots(app, projectId, environmentId) {
+  var out = [];
+  var filter = "project = '" + esc(projectId) + "'";
+  if (environmentId) filter += " && environment = '" + esc(environmentId) + "'";
+  var pageSize = 1000;
+  var offset = 0;
+
+  while (true) {
+    var snaps = app.findRecordsByFilter("rule_snapshots", filter, "", pageSize, offset);
+    if (!snaps || snaps.length === 0) break;
+    for (var si = 0; si < snaps.length; si++) {
+      var s = snaps[si];
+      out.push({
+        rule_id: s.get("rule_id"),
+        rule_name: s.get("rule_name"),
+        rule_hash: s.get("rule_hash"),
+        rule_content: decodeJsonField(s.get("rule_content"), s.get("rule_content")),
+        exceptions: decodeJsonField(s.get("exceptions"), []),
+        enabled: s.get("enabled"),
+        severity: s.get("severity"),
+        tags: decodeJsonField(s.get("tags"), [])
+      });
+    }
+    if (snaps.length < pageSize) break;
+    offset += pageSize;
+  }
+
+  return out;
+}
+
+// The sync service keeps one baseline per project/environment
+function baselineId(projectId, environmentId) {
+  return projectId + "/" + (environmentId || "");
+}
+
+function resolveSpace(app, projectId, environmentId) {
+  var project = app.findRecordById("projects", projectId);
+  var elastic = app.findRecordById("elastic_instances", project.get("elastic_instance"));
+  var space = project.get("elastic_space");
+  if (environmentId) {
+    space = app.findRecordById("environments", environmentId).get("elastic_space") || space;
+  }
+  return { kibanaUrl: elastic.get("url").replace(/\/$/, ""), space: space || "default" };
+}
+
+// Mirror a rule_snapshots write into the sync service's baseline store.
+// Failures are logged and otherwise ignored: rule_snapshots stays the
+// source of truth, and detectChanges reseeds a store that fell behind.
+function commitBaseline(app, projectId, environmentId, snapshots, deletedRuleIds, replace) {
+  try {
+    var target = resolveSpace(app, projectId, environmentId);
+    var resp = $http.send({
+      url: "http://localhost:8091/baseline/commit",
+      method: "POST",
+      headers: { "Content-Type": "application/json" },
+      body: JSON.stringify({
+        kibana_url: target.kibanaUrl,
+        space: target.space,
+        baseline_id: baselineId(projectId, environmentId),
+        snapshots: snapshots,
+        deleted_rule_ids: deletedRuleIds || [],
+        replace: !!replace
+      }),
+      timeout: 30
+    });
+    if (resp.statusCode !== 200) {
+      console.log("[Baseline] Store commit returned " + resp.statusCode + ": " + resp.raw);
+      return false;
+    }
+    return true;
+  } catch (err) {
+    console.log("[Baseline] Store commit error: " + String(err));
+    return false;
+  }
+}
+
+// Number of rule_snapshots of a project/environment, or -1 if unknown
+function countSnapshots(app, projectId, environmentId) {
+  try {
+    var match = { project: projectId };
+    if (environmentId) match.environment = environmentId;
+    return app.countRecords("rule_snapshots", $dbx.hashExp(match));
+  } catch (err) {
+    return -1;
+  }
+}
+
+// Whether the store holds this project/environment's baseline with as many
+// rules as rule_snapshots (a missed mirror of an add or delete shows here)
+function storeInSync(app, params) {
+  try {
+    var resp = $http.send({
+      url: "http://localhost:8091/baseline/status",
+      method: "POST",
+      headers: { "Content-Type": "application/json" },
+      body: JSON.stringify({
+        kibana_url: params.kibanaUrl,
+        space: params.space,
+        baseline_id: baselineId(params.projectId, params.environmentId)
+      }),
+      timeout: 10
+    });
+    if (resp.statusCode !== 200) return false;
+    var status = JSON.parse(resp.raw);
+    var expected = countSnapshots(app, params.projectId, params.environmentId);
+    return !!status.initialized && (expected < 0 || status.rule_count === expected);
+  } catch (err) {
+    return false;
+  }
+}
+
+// Run /detect-changes against the baseline store, so the snapshots are not
+// sent on every run. When the store is empty, out of step with
+// rule_snapshots or cannot be used, fall back to sending the rule_snapshots
+// and reseed the store with them for the next run. Returns the $http response.
+function detectChanges(app, params) {
+  var request = {
+    kibana_url: params.kibanaUrl,
+    api_key: params.apiKey,
+    space: params.space
+  };
+  var resp;
+  if (storeInSync(app, params)) {
+    resp = $http.send({
+      url: "http://localhost:8091/detect-changes",
+      method: "POST",
+      headers: { "Content-Type": "application/json" },
+      body: JSON.stringify(Object.assign({
+        use_baseline_store: true,
+        baseline_id: baselineId(params.projectId, params.environmentId)
+      }, request)),
+      timeout: params.timeout || 120
+    });
+    if (resp.statusCode === 200) return resp;
+    console.log("[Baseline] Store detection returned " + resp.statusCode + ", sending rule_snapshots");
+  }
+
+  var snapshots = loadRuleSnapshots(app, params.projectId, params.environmentId);
+  resp = $http.send({
+    url: "http://localhost:8091/detect-changes",
+    method: "POST",
+    headers: { "Content-Type": "application/json" },
+    body: JSON.stringify(Object.assign({ baseline_snapshots: snapshots }, request)),
+    timeout: params.timeout || 120
+  });
+  if (resp.statusCode === 200) {
+    commitBaseline(app, params.projectId, params.environmentId, snapshots, [], true);
+  }
+  return resp;
+}
+
+module.exports = {
+  loadRuleSnapshots: loadRuleSnapshots,
+  baselineId: baselineId,
+  commitBaseline: commitBaseline,
+  detectChanges: detectChanges
+};
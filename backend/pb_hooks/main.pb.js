@@ -6,7 +6,8 @@
  */
 
 // Audit logging helper is defined inside each routerAdd/cronAdd handler
-// (PocketBase JSVM requires helper functions to be in the same callback scope)
+// (PocketBase JSVM requires helper functions to be in the same callback scope);
+// the rule_snapshots / baseline store helpers are shared via baseline.js
 
 // SSL Status API
 routerAdd("GET", "/api/settings/ssl-status", function(e) {
@@ -310,70 +311,43 @@ routerAdd("POST", "/api/rules/list", function(e) {
     var apiKey = elastic.get("api_key");
     var elasticSpace = spaceOverride || project.get("elastic_space");
 
-    var rulesBaseUrl = elasticUrl + (elasticSpace && elasticSpace !== "default" ? "/s/" + elasticSpace : "") + "/api/detection_engine/rules/_find";
+    // The sync service serves listings from its shared export cache, so
+    // browsing and detection reuse one fetch from Kibana
+    var resp = $http.send({
+      url: "http://localhost:8091/rules/export",
+      method: "POST",
+      headers: { "Content-Type": "application/json" },
+      body: JSON.stringify({
+        kibana_url: elasticUrl,
+        api_key: apiKey,
+        space: elasticSpace,
+        summary: true
+      }),
+      timeout: 120
+    });
 
-    // Fetch all rules with pagination
-    var allRules = [];
-    var currentPage = 1;
-    var perPage = 10000;
+    var fetchError = resp.statusCode !== 200;
+    var rulesSummary = [];
     var totalRules = 0;
-    var fetchError = false;
-
-    do {
-      var rulesApiUrl = rulesBaseUrl + "?per_page=" + perPage + "&page=" + currentPage + "&sort_field=name&sort_order=asc";
-      var resp = $http.send({
-        url: rulesApiUrl,
-        method: "GET",
-        headers: {
-          "Authorization": "ApiKey " + apiKey,
-          "kbn-xsrf": "true",
-          "Content-Type": "application/json"
-        },
-        timeout: 60
-      });
-
-      if (resp.statusCode === 200) {
-        var responseData = JSON.parse(resp.raw);
-        var pageRules = responseData.data || [];
-        totalRules = responseData.total || 0;
-        console.log("[Rules List] Page " + currentPage + ": got " + pageRules.length + " rules, total=" + totalRules + ", accumulated=" + (allRules.length + pageRules.length));
-        for (var pi = 0; pi < pageRules.length; pi++) {
-          allRules.push(pageRules[pi]);
-        }
-        currentPage++;
-      } else {
-        console.log("[Rules List] Fetch error on page " + currentPage + ": status=" + resp.statusCode);
-        fetchError = true;
-        break;
-      }
-    } while (allRules.length < totalRules);
-
-    if (!fetchError && allRules.length > 0) {
-      var rulesSummary = [];
-
-      for (var i = 0; i < allRules.length; i++) {
-        var rule = allRules[i];
-        rulesSummary.push({
-          rule_id: rule.rule_id || rule.id,
-          id: rule.id,
-          name: rule.name || "",
-          description: rule.description || "",
-          severity: rule.severity || "unknown",
-          type: rule.type || "unknown",
-          tags: rule.tags || [],
-          enabled: !!rule.enabled
-        });
-      }
+    if (fetchError) {
+      console.log("[Rules List] Sync service export error: status=" + resp.statusCode);
+    } else {
+      var responseData = JSON.parse(resp.raw);
+      rulesSummary = responseData.rules || [];
+      totalRules = responseData.total || 0;
+      console.log("[Rules List] got " + rulesSummary.length + " rules (cached=" + !!responseData.cached + ")");
+    }
 
+    if (!fetchError && rulesSummary.length > 0) {
       return e.json(200, {
         success: true,
         rules: rulesSummary,
-        total: totalRules || allRules.length
+        total: totalRules || rulesSummary.length
       });
     } else {
       return e.json(200, {
         success: false,
-        message: fetchError ? "Elastic API returned an error" : "No rules found",
+        message: fetchError ? "Rule export failed: " + resp.raw : "No rules found",
         rules: [],
         total: 0
       });
@@ -492,56 +466,7 @@ routerAdd("POST", "/api/sync/trigger", function(e) {
     return null;
   }
 
-  function loadRuleSnapshots(app, projectId, environmentId) {
-    var out = [];
-    var filter = "project = '" + esc(projectId) + "'";
-    if (environmentId) filter += " && environment = '" + esc(environmentId) + "'";
-    var pageSize = 1000;
-    var offset = 0;
-
-    while (true) {
-      var snaps = app.findRecordsByFilter("rule_snapshots", filter, "", pageSize, offset);
-      if (!snaps || snaps.length === 0) break;
-      for (var si = 0; si < snaps.length; si++) {
-        var s = snaps[si];
-        var rc = s.get("rule_content");
-        if (rc && typeof rc[0] === "number") {
-          var rcStr = "";
-          for (var bi = 0; bi < rc.length; bi++) rcStr += String.fromCharCode(rc[bi]);
-          try { rcStr = decodeURIComponent(escape(rcStr)); } catch(ue) {}
-          try { rc = JSON.parse(rcStr); } catch (err) {}
-        }
-        var exc = s.get("exceptions") || [];
-        if (exc && typeof exc[0] === "number") {
-          var excStr = "";
-          for (var bi2 = 0; bi2 < exc.length; bi2++) excStr += String.fromCharCode(exc[bi2]);
-          try { excStr = decodeURIComponent(escape(excStr)); } catch(ue) {}
-          try { exc = JSON.parse(excStr); } catch (err) { exc = []; }
-        }
-        var tgs = s.get("tags") || [];
-        if (tgs && typeof tgs[0] === "number") {
-          var tgsStr = "";
-          for (var bi3 = 0; bi3 < tgs.length; bi3++) tgsStr += String.fromCharCode(tgs[bi3]);
-          try { tgsStr = decodeURIComponent(escape(tgsStr)); } catch(ue) {}
-          try { tgs = JSON.parse(tgsStr); } catch (err) { tgs = []; }
-        }
-        out.push({
-          rule_id: s.get("rule_id"),
-          rule_name: s.get("rule_name"),
-          rule_hash: s.get("rule_hash"),
-          rule_content: rc,
-          exceptions: exc,
-          enabled: s.get("enabled"),
-          severity: s.get("severity"),
-          tags: tgs
-        });
-      }
-      if (snaps.length < pageSize) break;
-      offset += pageSize;
-    }
-
-    return out;
-  }
+  var baseline = require(__hooks + "/baseline.js");
 
   function findPendingChange(app, projectId, environmentId, ruleId) {
     var filter = "project = '" + esc(projectId) + "' && status = 'pending' && rule_id = '" + esc(ruleId) + "'";
@@ -678,26 +603,14 @@ routerAdd("POST", "/api/sync/trigger", function(e) {
     if (direction === "elastic_to_git" || direction === "bidirectional") {
       console.log("[Sync] Running change detection for review (elastic_to_git)");
 
-      // Load baseline snapshots for this project/environment
-      var baselineSnapshots = [];
-      try {
-        baselineSnapshots = loadRuleSnapshots(e.app, projectId, environmentId);
-      } catch (err) {
-        console.log("[Sync] Error loading snapshots: " + String(err));
-      }
-
-      // Call sync service to detect changes
-      var detectResp = $http.send({
-        url: "http://localhost:8091/detect-changes",
-        method: "POST",
-        headers: { "Content-Type": "application/json" },
-        body: JSON.stringify({
-          kibana_url: elasticUrl,
-          api_key: apiKey,
-          space: elasticSpace,
-          baseline_snapshots: baselineSnapshots
-        }),
-        timeout: 120
+      // Call sync service to detect changes against this project/environment's
+      // baseline (the snapshots are only sent when its store copy is stale)
+      var detectResp = baseline.detectChanges(e.app, {
+        kibanaUrl: elasticUrl,
+        apiKey: apiKey,
+        space: elasticSpace,
+        projectId: projectId,
+        environmentId: environmentId
       });
 
       if (detectResp.statusCode !== 200) {
@@ -1030,7 +943,7 @@ routerAdd("POST", "/api/sync/trigger", function(e) {
           // Restrict prune scope to rules tracked for this project/environment.
           var managedRuleIds = {};
           try {
-            var managedSnapshots = loadRuleSnapshots(e.app, projectId, environmentId);
+            var managedSnapshots = baseline.loadRuleSnapshots(e.app, projectId, environmentId);
             for (var ms = 0; ms < managedSnapshots.length; ms++) {
               if (managedSnapshots[ms].rule_id) managedRuleIds[managedSnapshots[ms].rule_id] = true;
             }
@@ -1752,6 +1665,8 @@ routerAdd("GET", "/api/review/pending", function(e) {
 // Review API: Approve a change
 // ============================================================================
 routerAdd("POST", "/api/review/approve", function(e) {
+  var baseline = require(__hooks + "/baseline.js");
+
   function logAudit(app, params) {
     try {
       var user = params.user || "system";
@@ -2070,6 +1985,16 @@ routerAdd("POST", "/api/review/approve", function(e) {
           } catch (err) {}
 
           e.app.save(snap);
+          baseline.commitBaseline(e.app, projectId, environmentId, [{
+            rule_id: ruleId,
+            rule_name: ruleName,
+            rule_hash: snap.get("rule_hash") || "",
+            rule_content: currentState,
+            exceptions: currentState.exceptions_list || [],
+            enabled: currentState.enabled || false,
+            severity: currentState.severity || "",
+            tags: currentState.tags || []
+          }], [], false);
         } catch (err) {
           console.log("[Review] Snapshot update error: " + String(err));
         }
@@ -2082,6 +2007,7 @@ routerAdd("POST", "/api/review/approve", function(e) {
             e.app.delete(delSnaps[0]);
           }
         } catch (err) {}
+        baseline.commitBaseline(e.app, projectId, environmentId, [], [ruleId], false);
       }
     } else {
       console.log("[Review-Approve] Git commit failed — snapshot NOT updated so change reappears on next sync. Rule: " + ruleName);
@@ -2133,6 +2059,8 @@ routerAdd("POST", "/api/review/approve", function(e) {
 // Review API: Reject a change (with auto-revert in Elastic)
 // ============================================================================
 routerAdd("POST", "/api/review/reject", function(e) {
+  var baseline = require(__hooks + "/baseline.js");
+
   function logAudit(app, params) {
     try {
       var user = params.user || "system";
@@ -2391,7 +2319,8 @@ routerAdd("POST", "/api/review/reject", function(e) {
               api_key: apiKey,
               space: envSpace,
               previous_items: prevItems,
-              current_items: currItems
+              current_items: currItems,
+              previous_lists: (previousState && previousState._enriched_exceptions) || []
             }),
             timeout: 30
           });
@@ -2463,6 +2392,16 @@ routerAdd("POST", "/api/review/reject", function(e) {
             }
           } catch (err2) {}
           e.app.save(snap);
+          baseline.commitBaseline(e.app, projectId, environmentId, [{
+            rule_id: ruleId,
+            rule_name: baselineState.name || ruleName,
+            rule_hash: snap.get("rule_hash") || "",
+            rule_content: baselineState,
+            exceptions: baselineState.exceptions_list || [],
+            enabled: !!baselineState.enabled,
+            severity: baselineState.severity || "",
+            tags: baselineState.tags || []
+          }], [], false);
           console.log("[Review-Reject] Updated rule_snapshot for " + ruleId);
         } else if (changeType === "new_rule") {
           // New rule was rejected (deleted from Elastic): remove its snapshot if one exists
@@ -2473,6 +2412,7 @@ routerAdd("POST", "/api/review/reject", function(e) {
               e.app.delete(snaps2[0]);
             }
           } catch (err) {}
+          baseline.commitBaseline(e.app, projectId, environmentId, [], [ruleId], false);
         }
       } catch (err) {
         console.log("[Review-Reject] Failed to update snapshot for " + ruleId + ": " + String(err));
@@ -2560,6 +2500,8 @@ routerAdd("POST", "/api/review/reject", function(e) {
 // Review API: Bulk approve
 // ============================================================================
 routerAdd("POST", "/api/review/bulk-approve", function(e) {
+  var baseline = require(__hooks + "/baseline.js");
+
   function logAudit(app, params) {
     try {
       var user = params.user || "system";
@@ -2769,6 +2711,8 @@ routerAdd("POST", "/api/review/bulk-approve", function(e) {
     var approved = 0;
     var failed = 0;
     var errors = [];
+    // Approved snapshots per project/environment, committed to the baseline store once
+    var baselineCommits = {};
     for (var j = 0; j < records.length; j++) {
       try {
         var change = records[j];
@@ -2860,6 +2804,20 @@ routerAdd("POST", "/api/review/bulk-approve", function(e) {
                 console.log("[Bulk-Approve] Hash compute error for " + ruleId + ": " + String(err2));
               }
               e.app.save(snap);
+              var commitKey = projectId + "|" + (environmentId || "");
+              if (!baselineCommits[commitKey]) {
+                baselineCommits[commitKey] = { project: projectId, environment: environmentId, snapshots: [] };
+              }
+              baselineCommits[commitKey].snapshots.push({
+                rule_id: ruleId,
+                rule_name: ruleName,
+                rule_hash: snap.get("rule_hash") || "",
+                rule_content: currentState,
+                exceptions: currentState.exceptions_list || [],
+                enabled: currentState.enabled || false,
+                severity: currentState.severity || "",
+                tags: currentState.tags || []
+              });
             } catch (err) {
               console.log("[Bulk-Approve] Snapshot update error for " + ruleId + ": " + String(err));
             }
@@ -2876,6 +2834,11 @@ routerAdd("POST", "/api/review/bulk-approve", function(e) {
       }
     }
 
+    for (var commitKey in baselineCommits) {
+      var pending = baselineCommits[commitKey];
+      baseline.commitBaseline(e.app, pending.project, pending.environment, pending.snapshots, [], false);
+    }
+
     // Create summary notification
     if (approved > 0) {
       createNotification(e.app,
@@ -3020,8 +2983,25 @@ routerAdd("POST", "/api/review/bulk-reject", function(e) {
     var failed = 0;
     var errors = [];
 
+    function finishRecord(rec, ruleName, reverted) {
+      if (reverted) {
+        e.app.delete(rec);
+        rejected++;
+      } else {
+        rec.set("status", "rejected");
+        rec.set("reviewed_by", reviewedBy);
+        rec.set("reviewed_at", new Date().toISOString());
+        rec.set("reverted", false);
+        e.app.save(rec);
+        failed++;
+        errors.push("Failed to revert " + ruleName);
+      }
+    }
+
     // Cache Elastic connection info per project+environment
     var connCache = {};
+    // Rules to restore, grouped per connection for one bulk revert call each
+    var pendingReverts = {};
 
     for (var j = 0; j < records.length; j++) {
       try {
@@ -3093,7 +3073,6 @@ routerAdd("POST", "/api/review/bulk-reject", function(e) {
           };
         }
         var conn = connCache[connKey];
-        var reverted = false;
 
         if (changeType === "new_rule") {
           // Delete the new rule from Elastic
@@ -3104,38 +3083,13 @@ routerAdd("POST", "/api/review/bulk-reject", function(e) {
             headers: { "Authorization": "ApiKey " + conn.apiKey, "kbn-xsrf": "true" },
             timeout: 15
           });
-          reverted = delResp.statusCode === 200;
+          finishRecord(rec, ruleName, delResp.statusCode === 200);
         } else if (previousState && typeof previousState === "object") {
-          // Revert to previous state
-          var revertResp = $http.send({
-            url: "http://localhost:8091/revert-rule",
-            method: "POST",
-            headers: { "Content-Type": "application/json" },
-            body: JSON.stringify({
-              kibana_url: conn.elasticUrl,
-              api_key: conn.apiKey,
-              space: conn.space,
-              rule_content: previousState
-            }),
-            timeout: 30
-          });
-          if (revertResp.statusCode === 200) {
-            var revertData = JSON.parse(revertResp.raw);
-            reverted = revertData.success;
-          }
-        }
-
-        if (reverted) {
-          e.app.delete(rec);
-          rejected++;
+          // Revert to previous state (below, batched per connection)
+          if (!pendingReverts[connKey]) pendingReverts[connKey] = { conn: conn, items: [] };
+          pendingReverts[connKey].items.push({ rec: rec, ruleName: ruleName, rule: previousState });
         } else {
-          rec.set("status", "rejected");
-          rec.set("reviewed_by", reviewedBy);
-          rec.set("reviewed_at", new Date().toISOString());
-          rec.set("reverted", false);
-          e.app.save(rec);
-          failed++;
-          errors.push("Failed to revert " + ruleName);
+          finishRecord(rec, ruleName, false);
         }
       } catch (err) {
         failed++;
@@ -3143,6 +3097,42 @@ routerAdd("POST", "/api/review/bulk-reject", function(e) {
       }
     }
 
+    for (var pk in pendingReverts) {
+      var group = pendingReverts[pk];
+      var revertRules = [];
+      for (var gi = 0; gi < group.items.length; gi++) revertRules.push(group.items[gi].rule);
+      var revertResults = [];
+      try {
+        var revertResp = $http.send({
+          url: "http://localhost:8091/revert-rules/bulk",
+          method: "POST",
+          headers: { "Content-Type": "application/json" },
+          body: JSON.stringify({
+            kibana_url: group.conn.elasticUrl,
+            api_key: group.conn.apiKey,
+            space: group.conn.space,
+            rules: revertRules
+          }),
+          timeout: 120
+        });
+        if (revertResp.statusCode === 200) {
+          revertResults = JSON.parse(revertResp.raw).results || [];
+        } else {
+          console.log("[Bulk-Reject] Bulk revert returned " + revertResp.statusCode + ": " + revertResp.raw);
+        }
+      } catch (err) {
+        console.log("[Bulk-Reject] Bulk revert failed: " + String(err));
+      }
+      for (var ri = 0; ri < group.items.length; ri++) {
+        try {
+          finishRecord(group.items[ri].rec, group.items[ri].ruleName, !!(revertResults[ri] && revertResults[ri].success));
+        } catch (err) {
+          failed++;
+          errors.push(String(err));
+        }
+      }
+    }
+
     // Audit log
     logAudit(e.app, {
       user: reviewedBy,
@@ -3375,6 +3365,8 @@ routerAdd("POST", "/api/webhooks/{id}/test", function(e) {
 // Baseline Sync API: Initialize snapshots from current Elastic state
 // ============================================================================
 routerAdd("POST", "/api/review/init-baseline", function(e) {
+  var baseline = require(__hooks + "/baseline.js");
+
   function logAudit(app, params) {
     try {
       var user = params.user || "system";
@@ -3436,6 +3428,7 @@ routerAdd("POST", "/api/review/init-baseline", function(e) {
       if (detectResp.statusCode === 200) {
         var detectData = JSON.parse(detectResp.raw);
         var currentRules = detectData.current_rules || [];
+        var envSnapshots = [];
 
         for (var ri = 0; ri < currentRules.length; ri++) {
           var rule = currentRules[ri];
@@ -3466,10 +3459,21 @@ routerAdd("POST", "/api/review/init-baseline", function(e) {
             snap.set("last_approved_at", new Date().toISOString());
             e.app.save(snap);
             totalSnapshotted++;
+            envSnapshots.push({
+              rule_id: rule.rule_id,
+              rule_name: rule.rule_name,
+              rule_hash: rule.rule_hash,
+              rule_content: rule.rule_content,
+              exceptions: rule.exceptions || [],
+              enabled: !!rule.enabled,
+              severity: rule.severity || "",
+              tags: rule.tags || []
+            });
           } catch (err) {
             console.log("[Baseline] Error saving snapshot: " + String(err));
           }
         }
+        baseline.commitBaseline(e.app, projectId, env.id, envSnapshots, [], true);
       }
     }
 
@@ -3574,55 +3578,7 @@ cronAdd("auto_sync_scheduler", "* * * * *", function() {
     return String(v || "").replace(/\\/g, "\\\\").replace(/'/g, "\\'");
   }
 
-  function loadRuleSnapshots(app, projectId, environmentId) {
-    var out = [];
-    var filter = "project = '" + esc(projectId) + "'";
-    if (environmentId) filter += " && environment = '" + esc(environmentId) + "'";
-    var pageSize = 1000;
-    var offset = 0;
-
-    while (true) {
-      var snaps = app.findRecordsByFilter("rule_snapshots", filter, "", pageSize, offset);
-      if (!snaps || snaps.length === 0) break;
-      for (var si = 0; si < snaps.length; si++) {
-        var s = snaps[si];
-        var rc = s.get("rule_content");
-        if (rc && typeof rc[0] === "number") {
-          var rcStr = "";
-          for (var bi = 0; bi < rc.length; bi++) rcStr += String.fromCharCode(rc[bi]);
-          try { rcStr = decodeURIComponent(escape(rcStr)); } catch(ue) {}
-          try { rc = JSON.parse(rcStr); } catch (err) {}
-        }
-        var exc = s.get("exceptions") || [];
-        if (exc && typeof exc[0] === "number") {
-          var excStr = "";
-          for (var bi2 = 0; bi2 < exc.length; bi2++) excStr += String.fromCharCode(exc[bi2]);
-          try { excStr = decodeURIComponent(escape(excStr)); } catch(ue) {}
-          try { exc = JSON.parse(excStr); } catch (err) { exc = []; }
-        }
-        var tgs = s.get("tags") || [];
-        if (tgs && typeof tgs[0] === "number") {
-          var tgsStr = "";
-          for (var bi3 = 0; bi3 < tgs.length; bi3++) tgsStr += String.fromCharCode(tgs[bi3]);
-          try { tgsStr = decodeURIComponent(escape(tgsStr)); } catch(ue) {}
-          try { tgs = JSON.parse(tgsStr); } catch (err) { tgs = []; }
-        }
-        out.push({
-          rule_id: s.get("rule_id"),
-          rule_name: s.get("rule_name"),
-          rule_hash: s.get("rule_hash"),
-          rule_content: rc,
-          exceptions: exc,
-          enabled: s.get("enabled"),
-          severity: s.get("severity"),
-          tags: tgs
-        });
-      }
-      if (snaps.length < pageSize) break;
-      offset += pageSize;
-    }
-    return out;
-  }
+  var baseline = require(__hooks + "/baseline.js");
 
   function findPendingChange(app, projectId, environmentId, ruleId) {
     var filter = "project = '" + esc(projectId) + "' && status = 'pending' && rule_id = '" + esc(ruleId) + "'";
@@ -3757,26 +3713,14 @@ cronAdd("auto_sync_scheduler", "* * * * *", function() {
           var apiKey = elastic.get("api_key");
           var envSpace = env.get("elastic_space");
 
-          // Load baseline snapshots
-          var baselineSnapshots = [];
-          try {
-            baselineSnapshots = loadRuleSnapshots($app, project.id, env.id);
-          } catch (err) {
-            console.log("[Auto-Sync] Error loading snapshots: " + String(err));
-          }
-
-          // Call sync service to detect changes
-          var detectResp = $http.send({
-            url: "http://localhost:8091/detect-changes",
-            method: "POST",
-            headers: { "Content-Type": "application/json" },
-            body: JSON.stringify({
-              kibana_url: elasticUrl,
-              api_key: apiKey,
-              space: envSpace,
-              baseline_snapshots: baselineSnapshots
-            }),
-            timeout: 120
+          // Call sync service to detect changes against this project/environment's
+          // baseline (the snapshots are only sent when its store copy is stale)
+          var detectResp = baseline.detectChanges($app, {
+            kibanaUrl: elasticUrl,
+            apiKey: apiKey,
+            space: envSpace,
+            projectId: project.id,
+            environmentId: env.id
           });
 
           if (detectResp.statusCode !== 200) {
@@ -0,0 +1,191 @@
+"""
+Persistent per-space baseline store for the sync service.
+
+Keeps the approved rule snapshots keyed by (kibana_url, space, baseline_id)
+in a local SQLite file, with an in-memory {rule_id: rule_hash} index per
+baseline so detection can compare hashes without touching the stored
+content. Full snapshots are only read back for rules whose hash differs.
+The index is revalidated against the baseline's commit time, so commits
+made by another service worker against the same file are picked up.
+
+baseline_id is the caller's name for a baseline (PocketBase sends
+"<project>/<environment>"), so projects watching the same Kibana space
+keep, and replace, only their own baseline.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+def default_data_dir() -> str:
+    """Directory for sync service state files (SYNC_SERVICE_DATA_DIR)."""
+    return os.environ.get(
+        "SYNC_SERVICE_DATA_DIR",
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), "data"),
+    )
+
+
+def _space_key(kibana_url: str, space: str, baseline_id: str = "") -> tuple[str, str, str]:
+    return kibana_url.rstrip("/"), space or "default", baseline_id or ""
+
+
+_KEY = "kibana_url = ? AND space = ? AND baseline_id = ?"
+
+
+class BaselineStore:
+    """SQLite-backed baseline snapshots with an in-memory hash index."""
+
+    def __init__(self, path: str):
+        self.path = path
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(baseline_spaces)")]
+        if columns and "baseline_id" not in columns:
+            # A file from before baselines had ids. The store mirrors
+            # PocketBase's rule_snapshots, which seed it again on the next
+            # detection, so it is simply started over.
+            self._conn.executescript("DROP TABLE baseline_spaces; DROP TABLE baseline_rules;")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS baseline_spaces (
+                kibana_url TEXT NOT NULL,
+                space TEXT NOT NULL,
+                baseline_id TEXT NOT NULL,
+                committed_at REAL NOT NULL,
+                PRIMARY KEY (kibana_url, space, baseline_id)
+            );
+            CREATE TABLE IF NOT EXISTS baseline_rules (
+                kibana_url TEXT NOT NULL,
+                space TEXT NOT NULL,
+                baseline_id TEXT NOT NULL,
+                rule_id TEXT NOT NULL,
+                rule_hash TEXT NOT NULL,
+                snapshot TEXT NOT NULL,
+                PRIMARY KEY (kibana_url, space, baseline_id, rule_id)
+            );
+            """
+        )
+        self._conn.commit()
+        # {baseline key: (committed_at, {rule_id: rule_hash})}
+        self._index: dict[tuple[str, str, str], tuple[float, dict[str, str]]] = {}
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+    def _load_index(self, key: tuple[str, str, str]) -> dict[str, str] | None:
+        """Return the cached hash index for a baseline, or None if never committed."""
+        row = self._conn.execute(
+            f"SELECT committed_at FROM baseline_spaces WHERE {_KEY}", key,
+        ).fetchone()
+        if row is None:
+            self._index.pop(key, None)
+            return None
+        cached = self._index.get(key)
+        if cached is not None and cached[0] == row[0]:
+            return cached[1]
+        index = dict(self._conn.execute(
+            f"SELECT rule_id, rule_hash FROM baseline_rules WHERE {_KEY}", key,
+        ).fetchall())
+        self._index[key] = (row[0], index)
+        return index
+
+    def has_space(self, kibana_url: str, space: str, baseline_id: str = "") -> bool:
+        with self._lock:
+            return self._load_index(_space_key(kibana_url, space, baseline_id)) is not None
+
+    def hashes(self, kibana_url: str, space: str, baseline_id: str = "") -> dict[str, str] | None:
+        """Return {rule_id: rule_hash} for a baseline, or None if it was never committed."""
+        with self._lock:
+            index = self._load_index(_space_key(kibana_url, space, baseline_id))
+            return dict(index) if index is not None else None
+
+    def load(self, kibana_url: str, space: str, rule_ids: list[str], baseline_id: str = "") -> list[dict]:
+        """Load full snapshots for the given rule_ids."""
+        key = _space_key(kibana_url, space, baseline_id)
+        snapshots = []
+        with self._lock:
+            # Stay well below SQLite's bound-parameter limit
+            for start in range(0, len(rule_ids), 500):
+                chunk = rule_ids[start:start + 500]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self._conn.execute(
+                    f"SELECT snapshot FROM baseline_rules WHERE {_KEY} AND rule_id IN ({placeholders})",
+                    (*key, *chunk),
+                ).fetchall()
+                snapshots.extend(json.loads(row[0]) for row in rows)
+        return snapshots
+
+    def status(self, kibana_url: str, space: str, baseline_id: str = "") -> dict:
+        key = _space_key(kibana_url, space, baseline_id)
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT committed_at FROM baseline_spaces WHERE {_KEY}", key,
+            ).fetchone()
+            index = self._load_index(key)
+        return {
+            "initialized": row is not None,
+            "rule_count": len(index) if index is not None else 0,
+            "committed_at": row[0] if row else None,
+        }
+
+    def commit(
+        self,
+        kibana_url: str,
+        space: str,
+        snapshots: list[dict],
+        deleted_rule_ids: list[str] | None = None,
+        replace: bool = False,
+        baseline_id: str = "",
+    ) -> dict:
+        """
+        Record approved snapshots for a baseline.
+
+        With replace=True the given snapshots become the complete baseline;
+        otherwise they are upserted and deleted_rule_ids are removed. Other
+        baseline_ids of the same space are never touched.
+        """
+        key = _space_key(kibana_url, space, baseline_id)
+        deleted_rule_ids = deleted_rule_ids or []
+        rows = [
+            (*key, snap["rule_id"], snap.get("rule_hash", ""), json.dumps(snap))
+            for snap in snapshots if snap.get("rule_id")
+        ]
+        committed_at = time.time()
+        with self._lock:
+            with self._conn:
+                # Take the write lock before reading the index, so a commit
+                # from another worker cannot land in between
+                self._conn.execute("BEGIN IMMEDIATE")
+                index = self._load_index(key) or {}
+                if replace:
+                    self._conn.execute(f"DELETE FROM baseline_rules WHERE {_KEY}", key)
+                    index = {}
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO baseline_rules "
+                    "(kibana_url, space, baseline_id, rule_id, rule_hash, snapshot) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    rows,
+                )
+                self._conn.executemany(
+                    f"DELETE FROM baseline_rules WHERE {_KEY} AND rule_id = ?",
+                    [(*key, rid) for rid in deleted_rule_ids],
+                )
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO baseline_spaces "
+                    "(kibana_url, space, baseline_id, committed_at) VALUES (?, ?, ?, ?)",
+                    (*key, committed_at),
+                )
+            for row in rows:
+                index[row[3]] = row[4]
+            for rid in deleted_rule_ids:
+                index.pop(rid, None)
+            self._index[key] = (committed_at, index)
+        return {"upserted": len(rows), "deleted": len(deleted_rule_ids), "rule_count": len(index)}
@@ -0,0 +1,66 @@
+"""
+Canonical JSON form of exception items.
+
+Exception items are compared, sorted and fingerprinted by their
+``json.dumps(item, sort_keys=True)`` text. The same item dict is shared by
+every rule that references its list, so callers processing one export pass
+a ``texts`` dict ({id(item): text}) that lives as long as that export's
+items do: one serialization per item per export instead of one per rule
+and sort comparison. Nothing is memoized across exports or requests.
+
+Rules referencing the same exception lists share one ItemList, which
+carries the digest computed when the export attached it; the digest
+travels with the export (and to CPU workers) instead of being looked up by
+object identity.
+"""
+
+import hashlib
+import json
+from typing import Any
+
+
+def _dumps(obj: Any) -> str:
+    return json.dumps(obj, sort_keys=True)
+
+
+class ItemList(list):
+    """Sorted exception items of a rule, with the digest of their canonical form."""
+
+    def __init__(self, items: list, digest: str):
+        super().__init__(items)
+        self.digest = digest
+
+
+def canonical(item: Any, texts: dict[int, str] | None = None) -> str:
+    """json.dumps(item, sort_keys=True), looked up in / added to texts when given."""
+    if texts is None:
+        return _dumps(item)
+    text = texts.get(id(item))
+    if text is None:
+        text = texts[id(item)] = _dumps(item)
+    return text
+
+
+def canonical_list(items: list, texts: dict[int, str] | None = None) -> str:
+    """json.dumps(items, sort_keys=True), assembled from the per-item forms."""
+    return "[" + ", ".join(canonical(item, texts) for item in items) + "]"
+
+
+def items_digest(items: list, texts: dict[int, str] | None = None) -> str:
+    """sha256 of canonical_list(items); an ItemList's carried digest when it has one."""
+    digest = getattr(items, "digest", None)
+    if digest is not None:
+        return digest
+    text = canonical_list(items, texts) if isinstance(items, list) else _dumps(items)
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def sort_items(items: list, texts: dict[int, str] | None = None) -> ItemList:
+    """
+    Items sorted by their canonical form, with their digest. texts must only
+    hold entries for items that are still alive (an id is only unique among
+    live objects).
+    """
+    texts = {} if texts is None else texts
+    ordered = sorted(items, key=lambda item: canonical(item, texts))
+    return ItemList(ordered, items_digest(ordered, texts))
@@ -6,33 +6,306 @@ hash-based detection (matching the elastic/detection-rules CLI algorithm)
 and field-level diffing for granular change classification.
 """
 
+import asyncio
 import base64
 import hashlib
 import json
 import os
 import subprocess
 import tempfile
+import threading
+import time
 import shutil
-from typing import Any
+from collections import OrderedDict
+from typing import Any, AsyncIterator, Callable
+
+import httpx
+
+import canonical
+import toml_engine
+from cli_exporter import CliUnavailableError, get_cli_exporter
+from cpu_pool import CpuPool, get_cpu_pool
+from kibana_client import borrow_client, kibana_base_url, kibana_headers
+from single_flight import SingleFlight
+
+# Maximum number of exception lists whose items are fetched concurrently
+EXCEPTION_FETCH_CONCURRENCY = int(os.environ.get("SYNC_EXCEPTION_FETCH_CONCURRENCY", "8"))
+# Page size for exception list and exception item _find requests
+EXCEPTION_PAGE_SIZE = int(os.environ.get("SYNC_EXCEPTION_PAGE_SIZE", "500"))
+
+# Rules hashed, classified or rendered per CPU pool task, and the batch
+# size from which work is sharded across the pool instead of one thread
+CPU_CHUNK_SIZE = int(os.environ.get("SYNC_CPU_CHUNK_SIZE", "250"))
+CPU_PARALLEL_THRESHOLD = int(os.environ.get("SYNC_CPU_PARALLEL_THRESHOLD", "500"))
+_thread_pool = CpuPool(workers=0)
+
+# Rule hash algorithm. 1: the detection-rules algorithm, exception items
+# serialized inside every rule. 2: a rule's exception items enter the hash
+# as one digest of its (shared) item list, computed once per list. The two
+# give different hashes, so switching invalidates stored baseline hashes.
+RULE_HASH_VERSION = int(os.environ.get("SYNC_RULE_HASH_VERSION", "1"))
+
+# Fields left out of rule hashes: volatile/documentation fields that change
+# without user action
+_HASH_EXCLUDED_FIELDS = frozenset((
+    "id", "created_at", "updated_at", "created_by", "updated_by",
+    "execution_summary", "revision", "related_integrations",
+    "required_fields", "setup", "note", "immutable", "output_index",
+    "rule_source", "version", "meta", "_enriched_exceptions",
+))
+
+# State for incremental exports, {export_cache_key(...): {"rules", "watermark"}},
+# least recently used spaces evicted first. It is per worker process: with
+# SYNC_SERVICE_WORKERS > 1 each worker does its own first full export.
+_incremental_state: OrderedDict[tuple, dict] = OrderedDict()
+_INCREMENTAL_STATE_SIZE = int(os.environ.get("SYNC_INCREMENTAL_STATE_SIZE", "64"))
+
+
+class RuleHashCache:
+    """
+    Bounded LRU of rule hashes keyed by a cheap fingerprint.
+
+    Kibana bumps a rule's revision/updated_at on every edit, so
+    (id, revision, updated_at, digest of exception items) identifies the
+    content without serializing it. Rules missing any of these fields
+    (e.g. CLI exports or hand-built payloads) are never cached.
+
+    When a SharedCache is attached (multi-worker mode), batch lookups that
+    miss in memory fall through to it and batch inserts are written to it.
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.shared_hits = 0
+        self.shared = None
+        self._entries: OrderedDict[tuple, str] = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def fingerprint(rule: dict) -> tuple | None:
+        rule_id = rule.get("id")
+        revision = rule.get("revision")
+        updated_at = rule.get("updated_at")
+        if not rule_id or revision is None or not updated_at:
+            return None
+        # A missing _exception_items key hashes differently from an empty list
+        items = rule.get("_exception_items")
+        items_digest = canonical.items_digest(items) if items is not None else None
+        return (rule_id, revision, updated_at, items_digest, RULE_HASH_VERSION)
+
+    def get(self, key: tuple) -> str | None:
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: tuple, value: str) -> None:
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def get_many(self, keys: list[tuple | None]) -> list[str | None]:
+        """get() for many keys (None keys stay None), consulting the shared cache."""
+        values = [self.get(key) if key is not None else None for key in keys]
+        if self.shared is None:
+            return values
+        missing = {json.dumps(key): i for i, key in enumerate(keys) if key is not None and values[i] is None}
+        if missing:
+            found = self.shared.get_hashes(list(missing))
+            for fingerprint, value in found.items():
+                i = missing[fingerprint]
+                values[i] = value
+                self.put(keys[i], value)
+            with self._lock:
+                self.shared_hits += len(found)
+        return values
+
+    def put_many(self, items: list[tuple[tuple, str]]) -> None:
+        for key, value in items:
+            self.put(key, value)
+        if self.shared is not None:
+            self.shared.put_hashes([(json.dumps(key), value) for key, value in items])
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+            if self.shared is not None:
+                stats["shared_hits"] = self.shared_hits
+            return stats
+
+
+rule_hash_cache = RuleHashCache(int(os.environ.get("SYNC_HASH_CACHE_SIZE", "20000")))
 
 
 def compute_rule_hash(rule: dict) -> str:
     """
     Compute a rule hash using the detection-rules algorithm:
-    sorted JSON -> serialized -> base64 -> SHA256.
+    sorted JSON -> serialized -> base64 -> SHA256
+    (with SYNC_RULE_HASH_VERSION=2, exception items enter as a list digest).
+
+    Results are memoized in rule_hash_cache for rules carrying Kibana's
+    id/revision/updated_at.
     """
-    # Remove volatile/documentation fields that change without user action
-    stable = {k: v for k, v in rule.items() if k not in (
-        "id", "created_at", "updated_at", "created_by", "updated_by",
-        "execution_summary", "revision", "related_integrations",
-        "required_fields", "setup", "note", "immutable", "output_index",
-        "rule_source", "version", "meta", "_enriched_exceptions",
-    )}
+    key = RuleHashCache.fingerprint(rule) if rule_hash_cache.maxsize > 0 else None
+    if key is not None:
+        cached = rule_hash_cache.get(key)
+        if cached is not None:
+            return cached
+    rule_hash = _compute_rule_hash_uncached(rule)
+    if key is not None:
+        rule_hash_cache.put(key, rule_hash)
+    return rule_hash
+
+
+def _compute_rule_hash_uncached(rule: dict, version: int | None = None) -> str:
+    version = RULE_HASH_VERSION if version is None else version
+    stable = {k: v for k, v in rule.items() if k not in _HASH_EXCLUDED_FIELDS}
+    if version == 2 and "_exception_items" in stable:
+        # Exports carry the digest attached with the items (canonical.ItemList)
+        stable["_exception_items"] = canonical.items_digest(stable["_exception_items"])
     serialized = json.dumps(stable, sort_keys=True, separators=(",", ":"))
     b64 = base64.b64encode(serialized.encode("utf-8")).decode("utf-8")
     return hashlib.sha256(b64.encode("utf-8")).hexdigest()
 
 
+def export_version(rules: list[dict], hashes: list[str] | None = None) -> str:
+    """
+    Space-level version digest of an export: changes whenever any rule hash
+    does. hashes, when given, are the rules' precomputed hashes.
+    """
+    if hashes is None:
+        hashes = [compute_rule_hash(r) for r in rules]
+    digest = hashlib.sha256()
+    for line in sorted(f"{r.get('rule_id') or r.get('id', '')}:{h}" for r, h in zip(rules, hashes)):
+        digest.update(line.encode("utf-8"))
+        digest.update(b"\n")
+    return digest.hexdigest()
+
+
+def export_cache_key(kibana_url: str, space: str, api_key: str) -> tuple[str, str, str]:
+    # Credentials are part of the key: what an API key can see may differ
+    return (
+        kibana_url.rstrip("/"),
+        space or "default",
+        hashlib.sha256(api_key.encode("utf-8")).hexdigest(),
+    )
+
+
+class ExportCache:
+    """
+    Most recent complete API export per (kibana_url, space, API key).
+
+    Every complete API export made by a detection refreshes the entry, so
+    detections keep it warm and the cached /rules/export endpoint can answer
+    rule listings without another round of _find requests within the TTL.
+    With a SharedCache attached, exports made for listings are also written
+    to it and read back from it on a miss, so every worker sees the other
+    workers' exports; detections only refresh their own worker's entry, so
+    the whole export is not re-serialized into the file on every run.
+    """
+
+    def __init__(self, ttl: float, maxsize: int = 64):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.shared = None
+        self._entries: OrderedDict[tuple, dict] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: tuple, max_age: float | None = None) -> dict | None:
+        """Return the entry for key if it is younger than max_age (default: ttl)."""
+        max_age = self.ttl if max_age is None else max_age
+        with self._lock:
+            entry = self._entries.get(key)
+        if (entry is None or time.time() - entry["fetched_at"] > max_age) and self.shared is not None:
+            entry = self.shared.get_export(json.dumps(key), max_age)
+            if entry is not None:
+                self._remember(key, entry)
+        with self._lock:
+            if entry is None or time.time() - entry["fetched_at"] > max_age:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry
+
+    def put(
+        self, key: tuple, rules: list[dict], hashes: list[str] | None = None, share: bool = True,
+    ) -> dict:
+        """Cache an export; share=False keeps it out of the SharedCache."""
+        entry = {"rules": rules, "version": export_version(rules, hashes), "fetched_at": time.time()}
+        if self.ttl <= 0:
+            return entry
+        self._remember(key, entry)
+        if share and self.shared is not None:
+            self.shared.put_export(json.dumps(key), entry)
+        return entry
+
+    def _remember(self, key: tuple, entry: dict) -> None:
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"size": len(self._entries), "ttl": self.ttl, "hits": self.hits, "misses": self.misses}
+
+
+export_cache = ExportCache(float(os.environ.get("SYNC_EXPORT_CACHE_TTL", "30")))
+_export_flights = SingleFlight()
+
+
+async def cached_export(
+    kibana_url: str,
+    api_key: str,
+    space: str,
+    client: httpx.AsyncClient | None = None,
+    max_age: float | None = None,
+) -> tuple[dict, bool]:
+    """
+    Return ({rules, version, fetched_at}, from_cache) for a space.
+
+    Serves export_cache while the entry is younger than max_age; otherwise
+    runs one API export (shared by concurrent callers) and caches it.
+    Raises RuntimeError when the rules cannot be fetched. When only exception
+    lists fail, the rules are returned with the failures under "errors" and
+    are not cached.
+    """
+    key = export_cache_key(kibana_url, space, api_key)
+    # The shared cache, when attached, is a SQLite read
+    entry = await asyncio.to_thread(export_cache.get, key, max_age)
+    if entry is not None:
+        return entry, True
+
+    async def export() -> dict:
+        rules, errors = await _export_via_api(kibana_url, api_key, space, client=client, strict=True)
+        hashes = await _hash_rules(rules)
+        if errors:
+            # Served to the callers sharing this export, never cached
+            return {
+                "rules": rules, "version": export_version(rules, hashes),
+                "fetched_at": time.time(), "errors": errors,
+            }
+        return await asyncio.to_thread(export_cache.put, key, rules, hashes)
+
+    return await _export_flights.run(key, export), False
+
+
 def classify_changes(previous: dict | None, current: dict | None) -> list[str]:
     """
     Given previous and current rule states, return a list of specific change types.
@@ -69,7 +342,7 @@ def classify_changes(previous: dict | None, current: dict | None) -> list[str]:
     # Exception list references (adding/removing entire exception lists)
     prev_exceptions = previous.get("exceptions_list") or []
     curr_exceptions = current.get("exceptions_list") or []
-    if json.dumps(prev_exceptions, sort_keys=True) != json.dumps(curr_exceptions, sort_keys=True):
+    if canonical.canonical_list(prev_exceptions) != canonical.canonical_list(curr_exceptions):
         if len(curr_exceptions) > len(prev_exceptions):
             changes.append("exception_added")
         elif len(curr_exceptions) < len(prev_exceptions):
@@ -80,9 +353,7 @@ def classify_changes(previous: dict | None, current: dict | None) -> list[str]:
     # Exception list items (changes to items within exception lists)
     prev_items = previous.get("_exception_items") or []
     curr_items = current.get("_exception_items") or []
-    prev_items_str = json.dumps(prev_items, sort_keys=True)
-    curr_items_str = json.dumps(curr_items, sort_keys=True)
-    if prev_items_str != curr_items_str and "exception_added" not in changes and "exception_removed" not in changes and "exception_modified" not in changes:
+    if canonical.items_digest(prev_items) != canonical.items_digest(curr_items) and "exception_added" not in changes and "exception_removed" not in changes and "exception_modified" not in changes:
         if len(curr_items) > len(prev_items):
             changes.append("exception_added")
         elif len(curr_items) < len(prev_items):
@@ -134,8 +405,6 @@ def rule_to_toml(rule: dict) -> str:
     Convert an Elastic Security rule JSON to TOML format
     following the detection-rules convention.
     """
-    import toml
-
     # Build metadata section
     metadata = {
         "creation_date": rule.get("created_at", ""),
@@ -158,15 +427,103 @@ def rule_to_toml(rule: dict) -> str:
         "rule": rule_section,
     }
 
-    return toml.dumps(toml_dict)
+    return toml_engine.dumps(toml_dict)
+
+
+def classify_change(rule_id: str, rule_name: str,
+                    previous: dict | None, current: dict | None) -> dict:
+    """
+    Classify a single previous/current pair and build its summary.
+
+    Used to finish changes reported with ``baseline_required`` by a
+    hash-only detection run, once the caller has loaded the previous content.
+    """
+    change_types = classify_changes(previous, current)
+    return {
+        "rule_id": rule_id,
+        "rule_name": rule_name,
+        "change_types": change_types,
+        "diff_summary": build_diff_summary(change_types, rule_name, previous, current),
+    }
+
+
+def classify_change_batch(pairs: list[tuple[str, str, dict | None, dict | None]]) -> list[dict]:
+    """classify_change for many (rule_id, rule_name, previous, current) tuples; a CPU pool task."""
+    return [classify_change(*pair) for pair in pairs]
+
+
+async def classify_change_pairs(pairs: list[tuple[str, str, dict | None, dict | None]]) -> list[dict]:
+    """classify_change_batch off the event loop, sharded across the CPU pool when large."""
+    pool, chunk_size = _cpu_plan(len(pairs))
+    parts = await asyncio.gather(*(pool.run(classify_change_batch, chunk) for chunk in _chunks(pairs, chunk_size)))
+    return [change for part in parts for change in part]
 
 
-def detect_changes(
+def _pointer_token(key: Any) -> str:
+    return str(key).replace("~", "~0").replace("/", "~1")
+
+
+def json_patch(previous: Any, current: Any, path: str = "") -> list[dict]:
+    """
+    Return RFC 6902 JSON Patch operations turning previous into current.
+
+    Objects are diffed key by key and equal-length arrays element by
+    element; any other difference replaces the value at that path.
+    """
+    if isinstance(previous, dict) and isinstance(current, dict):
+        ops = [
+            {"op": "remove", "path": f"{path}/{_pointer_token(key)}"}
+            for key in previous if key not in current
+        ]
+        for key, value in current.items():
+            key_path = f"{path}/{_pointer_token(key)}"
+            if key in previous:
+                ops.extend(json_patch(previous[key], value, key_path))
+            else:
+                ops.append({"op": "add", "path": key_path, "value": value})
+        return ops
+    if isinstance(previous, list) and isinstance(current, list) and len(previous) == len(current):
+        ops = []
+        for i, (prev_item, cur_item) in enumerate(zip(previous, current)):
+            ops.extend(json_patch(prev_item, cur_item, f"{path}/{i}"))
+        return ops
+    # Compare types too, so that e.g. 1 -> true is still reported
+    if type(previous) is type(current) and previous == current:
+        return []
+    return [{"op": "replace", "path": path, "value": current}]
+
+
+def compact_change(change: dict) -> dict:
+    """
+    Rewrite a detected change into its compact form, in place.
+
+    previous_state and current_state are replaced by "patch", the JSON Patch
+    between them (None when either side is missing). The current content and
+    its TOML are left out: they are in the current_rules entry with the same
+    rule_id. Deleted rules keep previous_state, which appears nowhere else.
+    """
+    previous = change.pop("previous_state")
+    current = change.pop("current_state")
+    change.pop("toml_content", None)
+    change["patch"] = json_patch(previous, current) if previous is not None and current is not None else None
+    if current is None:
+        change["previous_state"] = previous
+    return change
+
+
+async def detect_changes(
     kibana_url: str,
     api_key: str,
     space: str,
-    baseline_snapshots: list[dict],
+    baseline_snapshots: list[dict] | None = None,
     use_cli: bool = True,
+    baseline_hashes: dict[str, str] | None = None,
+    load_baseline: Callable[[list[str]], list[dict]] | None = None,
+    client: httpx.AsyncClient | None = None,
+    incremental: bool = False,
+    include_current_toml: bool = True,
+    compact: bool = False,
+    progress: Callable[[str, int], None] | None = None,
 ) -> dict:
     """
     Detect changes between current Elastic state and baseline snapshots.
@@ -177,6 +534,25 @@ def detect_changes(
         space: Kibana space name
         baseline_snapshots: List of {rule_id, rule_hash, rule_content, exceptions, enabled, severity, tags}
         use_cli: Whether to try the detection-rules CLI first
+        baseline_hashes: Alternative to baseline_snapshots: {rule_id: rule_hash}.
+            Previous content is only needed for rules whose hash differs
+            (or that were deleted); it is requested through load_baseline.
+        load_baseline: Optional callable returning snapshots for a list of
+            rule_ids. Without it, hash-only changes come back with
+            previous_state None and baseline_required True.
+        client: Shared Kibana client (see kibana_client.KibanaClientPool);
+            a short-lived one is used when omitted.
+        incremental: Only download rules updated since the previous run for
+            this space (API export only, see _export_incremental).
+        include_current_toml: Render toml_content for every entry of
+            current_rules. When False, only changed rules get TOML and
+            current_rules entries carry toml_content None.
+        compact: Return changes in compact form (see compact_change):
+            a JSON Patch instead of previous_state/current_state, with the
+            current content and TOML referenced through current_rules.
+        progress: Optional callback progress(stage, count) adding count to
+            a counter: rules_fetched, lists_total, lists_fetched, rules_total
+            and rules_hashed.
 
     Returns:
         {
@@ -198,7 +574,7 @@ def detect_changes(
                     "rule_name": str,
                     "rule_hash": str,
                     "rule_content": dict,
-                    "toml_content": str,
+                    "toml_content": str | None,
                     "enabled": bool,
                     "severity": str,
                     "tags": list,
@@ -208,19 +584,88 @@ def detect_changes(
             "errors": [str]
         }
     """
+    result: dict[str, Any] = {"changes": [], "current_rules": []}
+    async for kind, record in iter_detection_records(
+        kibana_url,
+        api_key,
+        space,
+        baseline_snapshots=baseline_snapshots,
+        use_cli=use_cli,
+        baseline_hashes=baseline_hashes,
+        load_baseline=load_baseline,
+        client=client,
+        incremental=incremental,
+        include_current_toml=include_current_toml,
+        compact=compact,
+        progress=progress,
+    ):
+        if kind == "change":
+            result["changes"].append(record)
+        elif kind == "current_rule":
+            result["current_rules"].append(record)
+        else:
+            result["errors"] = record["errors"]
+            result["warnings"] = record["warnings"]
+            for key in ("incremental", "compact"):
+                if key in record:
+                    result[key] = record[key]
+    return result
+
+
+async def iter_detection_records(
+    kibana_url: str,
+    api_key: str,
+    space: str,
+    baseline_snapshots: list[dict] | None = None,
+    use_cli: bool = True,
+    baseline_hashes: dict[str, str] | None = None,
+    load_baseline: Callable[[list[str]], list[dict]] | None = None,
+    client: httpx.AsyncClient | None = None,
+    incremental: bool = False,
+    include_current_toml: bool = True,
+    compact: bool = False,
+    progress: Callable[[str, int], None] | None = None,
+) -> AsyncIterator[tuple[str, dict]]:
+    """
+    Run a detection and yield its output one record at a time.
+
+    Takes the same arguments as detect_changes and yields (kind, record)
+    pairs: ("change", change) and ("current_rule", entry) shaped like the
+    items of detect_changes()["changes"] and ["current_rules"], then one
+    ("summary", {errors, warnings, change_count, rule_count[, incremental,
+    compact]}).
+
+    A changed rule's change is yielded right before its current_rule entry;
+    deleted rules follow the current rules. TOML is rendered for each record
+    as it is yielded and is not kept here, so callers that write records out
+    immediately hold no more than one rendered rule at a time.
+    """
     errors = []
     warnings = []
     current_rules_raw = []
 
     cli_rules = []
     cli_errors = []
-    if use_cli:
-        cli_rules, cli_errors = _export_via_cli(kibana_url, api_key, space)
-
-    # Always fetch via API to catch rules the CLI may have skipped
-    # (e.g. rules with KQL parse errors that the CLI can't convert to TOML)
-    api_rules, api_errors = _export_via_api(kibana_url, api_key, space)
-
+    incremental_stats = None
+    if incremental:
+        # Incremental runs rely on the API export alone, so cached and
+        # re-fetched rules share one representation.
+        api_rules, api_errors, incremental_stats = await _export_incremental(
+            kibana_url, api_key, space, client=client, progress=progress,
+        )
+    elif use_cli:
+        # Always fetch via API to catch rules the CLI may have skipped
+        # (e.g. rules with KQL parse errors that the CLI can't convert to TOML).
+        # Both exports are independent, so they run concurrently and each keeps
+        # its own timeout; the CLI export runs on the CLI pool's threads.
+        (cli_rules, cli_errors), (api_rules, api_errors) = await asyncio.gather(
+            get_cli_exporter().run_in_thread(_export_via_cli, kibana_url, api_key, space),
+            _export_via_api(kibana_url, api_key, space, client=client, progress=progress),
+        )
+    else:
+        api_rules, api_errors = await _export_via_api(
+            kibana_url, api_key, space, client=client, progress=progress,
+        )
     # Failure handling strategy:
     # - If CLI fails but API succeeds, continue without surfacing hard errors.
     # - Only surface hard errors when both exports fail (no data source available).
@@ -275,80 +720,94 @@ def detect_changes(
 
     # Build current rules map with hashes
     current_map: dict[str, dict] = {}
-    current_rules_output = []
-
-    for rule in current_rules_raw:
-        rule_id = rule.get("rule_id") or rule.get("id", "")
-        if not rule_id:
-            continue
-
-        rule_hash = compute_rule_hash(rule)
-        try:
-            toml_content = rule_to_toml(rule)
-        except Exception as e:
-            toml_content = None
-            warnings.append(f"TOML conversion failed for {rule_id}: {str(e)}")
+    if progress:
+        progress("rules_total", len(current_rules_raw))
+
+    identified = [
+        (rule.get("rule_id") or rule.get("id", ""), rule) for rule in current_rules_raw
+    ]
+    identified = [(rule_id, rule) for rule_id, rule in identified if rule_id]
+    rule_hashes = await _hash_rules([rule for _, rule in identified])
+    if progress:
+        progress("rules_hashed", len(identified))
+    if not api_errors and export_cache.ttl > 0:
+        # Keep the export warm for rule listings served by cached_export,
+        # reusing the hashes of the rules taken from the API export
+        hashed = {id(rule): rule_hash for (_, rule), rule_hash in zip(identified, rule_hashes)}
+        unhashed = [rule for rule in api_rules if id(rule) not in hashed]
+        if unhashed:
+            # API rules the CLI export replaced
+            hashed.update(zip(map(id, unhashed), await _hash_rules(unhashed)))
+        await asyncio.to_thread(
+            export_cache.put, export_cache_key(kibana_url, space, api_key),
+            api_rules, [hashed[id(rule)] for rule in api_rules], False,
+        )
 
+    for (rule_id, rule), rule_hash in zip(identified, rule_hashes):
         entry = {
             "rule_id": rule_id,
             "rule_name": rule.get("name", ""),
             "rule_hash": rule_hash,
             "rule_content": rule,
-            "toml_content": toml_content,
+            "toml_content": None,  # rendered as the record is emitted
             "enabled": rule.get("enabled", False),
             "severity": rule.get("severity", ""),
             "tags": rule.get("tags", []),
             "exceptions": rule.get("exceptions_list", []),
         }
         current_map[rule_id] = entry
-        current_rules_output.append(entry)
 
     # Build baseline map
     baseline_map: dict[str, dict] = {}
-    for snap in baseline_snapshots:
+    if baseline_hashes is not None:
+        # load_baseline reads the baseline store, so it stays off the loop
+        baseline_map = await asyncio.to_thread(
+            _baseline_map_from_hashes, baseline_hashes, current_map, load_baseline,
+        )
+    for snap in baseline_snapshots or []:
         rid = snap.get("rule_id", "")
         if rid:
             baseline_map[rid] = snap
 
-    # Detect changes
-    changes = []
-
-    # Check for new and modified rules
-    for rule_id, current in current_map.items():
-        baseline = baseline_map.get(rule_id)
-
-        if baseline is None:
-            # New rule
-            change_types = ["new_rule"]
-            diff_summary = build_diff_summary(change_types, current["rule_name"], None, current["rule_content"])
-            changes.append({
-                "rule_id": rule_id,
-                "rule_name": current["rule_name"],
-                "change_types": change_types,
-                "diff_summary": diff_summary,
-                "previous_state": None,
-                "current_state": current["rule_content"],
-                "current_hash": current["rule_hash"],
-                "toml_content": current["toml_content"],
-            })
-        elif baseline.get("rule_hash") != current["rule_hash"]:
-            # Modified rule - classify the change
-            prev_content = baseline.get("rule_content", {})
-            change_types = classify_changes(prev_content, current["rule_content"])
-            diff_summary = build_diff_summary(
-                change_types, current["rule_name"],
-                prev_content, current["rule_content"]
-            )
-            changes.append({
-                "rule_id": rule_id,
-                "rule_name": current["rule_name"],
-                "change_types": change_types,
-                "diff_summary": diff_summary,
-                "previous_state": prev_content,
-                "current_state": current["rule_content"],
-                "current_hash": current["rule_hash"],
-                "toml_content": current["toml_content"],
-            })
+    # Classification and TOML rendering (one of the slowest per-rule steps)
+    # are sharded across the CPU pool; chunks come back in order, so records
+    # keep streaming out in current_map order while later chunks are still
+    # being processed. TOML is rendered for changed rules, and for every
+    # current rule only when asked to; unchanged rules without TOML need no
+    # work at all.
+    change_count = 0
+    current_items = list(current_map.items())
+    needs_work = [
+        include_current_toml or _needs_classification(current, baseline_map.get(rule_id))
+        for rule_id, current in current_items
+    ]
+    work = [
+        (current, baseline_map.get(rule_id))
+        for (rule_id, current), needed in zip(current_items, needs_work) if needed
+    ]
+    pool, chunk_size = _cpu_plan(len(work))
+
+    async def iter_outcomes() -> AsyncIterator[tuple[dict | None, str | None, str | None]]:
+        async for outcomes in pool.imap(_classify_and_render, _chunks(work, chunk_size), include_current_toml):
+            for outcome in outcomes:
+                yield outcome
+
+    outcomes = iter_outcomes()
+    try:
+        for (rule_id, current), needed in zip(current_items, needs_work):
+            change = toml_content = None
+            if needed:
+                change, toml_content, warning = await anext(outcomes)
+                if warning:
+                    warnings.append(warning)
+            if change is not None:
+                change = _restore_states(change, current, baseline_map.get(rule_id))
+                change["toml_content"] = toml_content
+                change_count += 1
+                yield "change", compact_change(change) if compact else change
+            yield "current_rule", dict(current, toml_content=toml_content)
+    finally:
+        await outcomes.aclose()
 
     # Check for deleted rules
     for rule_id, baseline in baseline_map.items():
@@ -356,7 +815,7 @@ def detect_changes(
             change_types = ["deleted_rule"]
             rule_name = baseline.get("rule_name", rule_id)
             diff_summary = build_diff_summary(change_types, rule_name, baseline.get("rule_content"), None)
-            changes.append({
+            change = {
                 "rule_id": rule_id,
                 "rule_name": rule_name,
                 "change_types": change_types,
@@ -365,19 +824,197 @@ def detect_changes(
                 "current_state": None,
                 "current_hash": None,
                 "toml_content": None,
-            })
+            }
+            if "rule_content" not in baseline:
+                change["baseline_required"] = True
+            change_count += 1
+            yield "change", compact_change(change) if compact else change
 
-    return {
-        "changes": changes,
-        "current_rules": current_rules_output,
+    summary = {
         "errors": errors,
         "warnings": warnings,
+        "change_count": change_count,
+        "rule_count": len(current_map),
     }
+    if incremental_stats is not None:
+        summary["incremental"] = incremental_stats
+    if compact:
+        summary["compact"] = True
+    yield "summary", summary
+
+
+def _current_rule_change(rule_id: str, current: dict, baseline: dict | None) -> dict | None:
+    """Return the new/modified change for a current rule, or None if unchanged."""
+    if baseline is None:
+        # New rule
+        change_types = ["new_rule"]
+        diff_summary = build_diff_summary(change_types, current["rule_name"], None, current["rule_content"])
+        return {
+            "rule_id": rule_id,
+            "rule_name": current["rule_name"],
+            "change_types": change_types,
+            "diff_summary": diff_summary,
+            "previous_state": None,
+            "current_state": current["rule_content"],
+            "current_hash": current["rule_hash"],
+            "toml_content": None,
+        }
+    if baseline.get("rule_hash") == current["rule_hash"]:
+        return None
+    if "rule_content" not in baseline:
+        # Hash-only baseline without content: report a generic
+        # modification and let the caller classify it afterwards.
+        change_types = ["modified_rule"]
+        return {
+            "rule_id": rule_id,
+            "rule_name": current["rule_name"],
+            "change_types": change_types,
+            "diff_summary": build_diff_summary(change_types, current["rule_name"], None, None),
+            "previous_state": None,
+            "current_state": current["rule_content"],
+            "current_hash": current["rule_hash"],
+            "toml_content": None,
+            "baseline_required": True,
+        }
+
+    # Modified rule - classify the change
+    prev_content = baseline.get("rule_content", {})
+    change_types = classify_changes(prev_content, current["rule_content"])
+    diff_summary = build_diff_summary(
+        change_types, current["rule_name"],
+        prev_content, current["rule_content"]
+    )
+    return {
+        "rule_id": rule_id,
+        "rule_name": current["rule_name"],
+        "change_types": change_types,
+        "diff_summary": diff_summary,
+        "previous_state": prev_content,
+        "current_state": current["rule_content"],
+        "current_hash": current["rule_hash"],
+        "toml_content": None,
+    }
+
+
+async def _hash_rules(rules: list[dict]) -> list[str]:
+    """
+    compute_rule_hash for many rules: cached hashes are looked up here and
+    the rest are computed in the CPU pool.
+    """
+    keys = [
+        RuleHashCache.fingerprint(rule) if rule_hash_cache.maxsize > 0 else None
+        for rule in rules
+    ]
+    # The shared cache, when attached, is a SQLite read
+    hashes = await asyncio.to_thread(rule_hash_cache.get_many, keys)
+    missing = [i for i, rule_hash in enumerate(hashes) if rule_hash is None]
+    if missing:
+        pool, chunk_size = _cpu_plan(len(missing))
+        parts = await asyncio.gather(*(
+            pool.run(_hash_batch, chunk, RULE_HASH_VERSION)
+            for chunk in _chunks([rules[i] for i in missing], chunk_size)
+        ))
+        computed = [rule_hash for part in parts for rule_hash in part]
+        for i, rule_hash in zip(missing, computed):
+            hashes[i] = rule_hash
+        await asyncio.to_thread(rule_hash_cache.put_many, [
+            (keys[i], hashes[i]) for i in missing if keys[i] is not None
+        ])
+    return hashes
+
+
+def _cpu_plan(count: int) -> tuple[CpuPool, int]:
+    """
+    Pool and chunk size for count items of CPU work. From
+    CPU_PARALLEL_THRESHOLD items on they are sharded across the CPU pool in
+    CPU_CHUNK_SIZE chunks; smaller batches run as one chunk in a thread,
+    where pickling them to other processes would cost more than it saves.
+    """
+    if count >= CPU_PARALLEL_THRESHOLD:
+        return get_cpu_pool(), CPU_CHUNK_SIZE
+    return _thread_pool, max(count, 1)
+
+
+def _chunks(items: list, size: int) -> list[list]:
+    return [items[start:start + size] for start in range(0, len(items), size)]
+
+
+def _hash_batch(rules: list[dict], version: int) -> list[str]:
+    return [_compute_rule_hash_uncached(rule, version) for rule in rules]
+
+
+def _needs_classification(current: dict, baseline: dict | None) -> bool:
+    return baseline is None or baseline.get("rule_hash") != current["rule_hash"]
+
+
+def _classify_and_render(
+    pairs: list[tuple[dict, dict | None]],
+    include_current_toml: bool,
+) -> list[tuple[dict | None, str | None, str | None]]:
+    """
+    CPU pool task: for each (current entry, baseline) pair return
+    (change or None, TOML or None, warning or None). Changes come back
+    without previous_state/current_state, which the caller already holds
+    (see _restore_states), so results do not pickle the rules twice.
+    """
+    outcomes = []
+    for current, baseline in pairs:
+        change = _current_rule_change(current["rule_id"], current, baseline)
+        if change is not None:
+            del change["previous_state"], change["current_state"]
+        toml_content = warning = None
+        if change is not None or include_current_toml:
+            try:
+                toml_content = rule_to_toml(current["rule_content"])
+            except Exception as e:
+                warning = f"TOML conversion failed for {current['rule_id']}: {str(e)}"
+        outcomes.append((change, toml_content, warning))
+    return outcomes
+
+
+def _restore_states(change: dict, current: dict, baseline: dict | None) -> dict:
+    """Put back the states _classify_and_render leaves out, in their original key order."""
+    previous = baseline.get("rule_content") if baseline is not None else None
+    restored = {}
+    for key, value in change.items():
+        restored[key] = value
+        if key == "diff_summary":
+            restored["previous_state"] = previous
+            restored["current_state"] = current["rule_content"]
+    return restored
+
+
+def _baseline_map_from_hashes(
+    baseline_hashes: dict[str, str],
+    current_map: dict[str, dict],
+    load_baseline: Callable[[list[str]], list[dict]] | None,
+) -> dict[str, dict]:
+    """
+    Build a baseline map from {rule_id: rule_hash} pairs.
+
+    Full snapshots are loaded only for rules that were modified or deleted,
+    so the cost scales with the number of changes instead of the space size.
+    """
+    baseline_map = {
+        rid: {"rule_id": rid, "rule_hash": rule_hash}
+        for rid, rule_hash in baseline_hashes.items() if rid
+    }
+    needed = [
+        rid for rid, snap in baseline_map.items()
+        if rid not in current_map or current_map[rid]["rule_hash"] != snap["rule_hash"]
+    ]
+    if needed and load_baseline is not None:
+        for snap in load_baseline(needed):
+            rid = snap.get("rule_id", "")
+            if rid in baseline_map:
+                baseline_map[rid] = snap
+    return baseline_map
 
 
 def _export_via_cli(kibana_url: str, api_key: str, space: str) -> tuple[list[dict], list[str]]:
     """
-    Export rules using the detection-rules CLI.
+    Export rules using the detection-rules CLI, run on a warm worker
+    process (see cli_exporter) so detection_rules is only imported once.
     Returns (rules_list, errors_list).
     """
     rules = []
@@ -385,17 +1022,16 @@ def _export_via_cli(kibana_url: str, api_key: str, space: str) -> tuple[list[dic
     export_dir = tempfile.mkdtemp(prefix="dr_export_")
 
     try:
-        cmd = [
-            "python3", "-m", "detection_rules",
+        args = [
             "kibana",
             "--kibana-url", kibana_url,
             "--api-key", api_key,
         ]
 
         if space and space != "default":
-            cmd.extend(["--space", space])
+            args.extend(["--space", space])
 
-        cmd.extend([
+        args.extend([
             "export-rules",
             "-d", export_dir,
             "--skip-errors",
@@ -403,51 +1039,10 @@ def _export_via_cli(kibana_url: str, api_key: str, space: str) -> tuple[list[dic
             "--strip-version",
         ])
 
-        env = os.environ.copy()
-        env["PYTHONDONTWRITEBYTECODE"] = "1"
-        # Disable SSL verification via environment variables
-        env["PYTHONHTTPSVERIFY"] = "0"
-        env["REQUESTS_CA_BUNDLE"] = ""
-        env["CURL_CA_BUNDLE"] = ""
-
-        # Patch SSL at the Python level so urllib3/requests skip cert validation
-        # (the CLI subprocess does not inherit our httpx verify=False).
-        ssl_patch = (
-            "import ssl\n"
-            "ssl._create_default_https_context = ssl._create_unverified_context\n"
-            "_orig_ctx = ssl.create_default_context\n"
-            "def _noverify(*a, **kw):\n"
-            " c = _orig_ctx(*a, **kw)\n"
-            " c.check_hostname = False\n"
-            " c.verify_mode = ssl.CERT_NONE\n"
-            " return c\n"
-            "ssl.create_default_context = _noverify\n"
-            "try:\n"
-            " import urllib3\n"
-            " urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)\n"
-            "except Exception:\n"
-            " pass\n"
-            "try:\n"
-            " import requests\n"
-            " requests.packages.urllib3.disable_warnings()\n"
-            "except Exception:\n"
-            " pass\n"
-            "import runpy\n"
-            "runpy.run_module('detection_rules', run_name='__main__')\n"
-        )
-        cli_args = cmd[3:]  # everything after "python3 -m detection_rules"
-        cmd = ["python3", "-c", ssl_patch] + cli_args
-
-        result = subprocess.run(
-            cmd,
-            capture_output=True,
-            text=True,
-            timeout=120,
-            env=env,
-        )
+        returncode, stderr = get_cli_exporter().run(args, timeout=120)
 
-        if result.returncode != 0:
-            errors.append(f"CLI export failed (code {result.returncode}): {result.stderr[:500]}")
+        if returncode != 0:
+            errors.append(f"CLI export failed (code {returncode}): {stderr[:500]}")
             return rules, errors
 
         # Read exported TOML files and convert back to JSON for comparison
@@ -460,9 +1055,7 @@ def _export_via_cli(kibana_url: str, api_key: str, space: str) -> tuple[list[dic
 
             try:
                 if filename.endswith(".toml"):
-                    import toml
-                    with open(filepath, "r") as f:
-                        data = toml.load(f)
+                    data = toml_engine.load_file(filepath)
                     rule = data.get("rule", {})
                     rules.append(rule)
                 elif filename.endswith(".json"):
@@ -474,7 +1067,7 @@ def _export_via_cli(kibana_url: str, api_key: str, space: str) -> tuple[list[dic
 
     except subprocess.TimeoutExpired:
         errors.append("CLI export timed out after 120 seconds")
-    except FileNotFoundError:
+    except (FileNotFoundError, CliUnavailableError):
         errors.append("detection-rules CLI not found, falling back to API")
     except Exception as e:
         errors.append(f"CLI export error: {str(e)}")
@@ -484,124 +1077,327 @@ def _export_via_cli(kibana_url: str, api_key: str, space: str) -> tuple[list[dic
     return rules, errors
 
 
-def _export_via_api(kibana_url: str, api_key: str, space: str) -> tuple[list[dict], list[str]]:
+async def _export_via_api(
+    kibana_url: str,
+    api_key: str,
+    space: str,
+    client: httpx.AsyncClient | None = None,
+    progress: Callable[[str, int], None] | None = None,
+    strict: bool = False,
+) -> tuple[list[dict], list[str]]:
     """
     Export rules directly via Elastic API (fallback when CLI is unavailable).
-    Returns (rules_list, errors_list).
+    Returns (rules_list, errors_list). With strict=True a failed rule fetch
+    raises RuntimeError, so the returned errors are exception-list failures.
     """
-    import httpx
+    base_url = kibana_base_url(kibana_url, space)
+    headers = kibana_headers(api_key)
 
-    rules = []
-    errors = []
+    async with borrow_client(client) as client:
+        rules, errors = await _fetch_rules(client, base_url, headers)
+        if strict and errors:
+            raise RuntimeError("; ".join(errors))
+        if progress:
+            progress("rules_fetched", len(rules))
+        await _attach_exceptions(client, base_url, headers, rules, errors, progress=progress)
 
-    base_url = kibana_url.rstrip("/")
-    if space and space != "default":
-        base_url = f"{base_url}/s/{space}"
+    return rules, errors
 
-    rules_url = f"{base_url}/api/detection_engine/rules/_find"
-    headers = {
-        "Authorization": f"ApiKey {api_key}",
-        "kbn-xsrf": "true",
-        "Content-Type": "application/json",
-    }
 
+async def _export_incremental(
+    kibana_url: str,
+    api_key: str,
+    space: str,
+    client: httpx.AsyncClient | None = None,
+    progress: Callable[[str, int], None] | None = None,
+) -> tuple[list[dict], list[str], dict]:
+    """
+    Export rules via the API, only downloading rules changed since the last
+    run for this space.
+
+    Keeps the previous export and an updated_at watermark per space and API
+    key in this worker (see _incremental_state). Each run lists rule ids
+    (rule_id/updated_at only) to catch deletions, fetches rules updated
+    since the watermark, and re-fetches any listed rule the watermark query
+    missed. Exception items do not bump a rule's updated_at, so they are
+    still fetched in full and attached to copies of the cached rules.
+    Returns (rules_list, errors_list, stats).
+    """
+    # Credentials are part of the key, as for export_cache
+    key = export_cache_key(kibana_url, space, api_key)
+    base_url = kibana_base_url(kibana_url, space)
+    headers = kibana_headers(api_key)
+    state = _incremental_state.get(key)
+    stats = {"full_export": state is None, "rules_fetched": 0, "rules_deleted": 0}
+
+    async with borrow_client(client) as client:
+        if state is not None:
+            listing, errors = await _fetch_rules(
+                client, base_url, headers, {"fields": ["rule_id", "updated_at"]},
+            )
+            if not errors:
+                changed, errors = await _fetch_rules(
+                    client, base_url, headers,
+                    {"filter": f'alert.attributes.updatedAt >= "{state["watermark"]}"'},
+                )
+            if not errors:
+                cached = state["rules"]
+                fetched = {r.get("rule_id"): r for r in changed}
+                stale = [
+                    r.get("rule_id") for r in listing
+                    if r.get("rule_id") not in fetched
+                    and (r.get("rule_id") not in cached
+                         or r.get("updated_at") != cached[r.get("rule_id")].get("updated_at"))
+                ]
+                for start in range(0, len(stale), 50):
+                    ids = " OR ".join(json.dumps(rid) for rid in stale[start:start + 50])
+                    more, errors = await _fetch_rules(
+                        client, base_url, headers,
+                        {"filter": f"alert.attributes.params.ruleId: ({ids})"},
+                    )
+                    if errors:
+                        break
+                    fetched.update((r.get("rule_id"), r) for r in more)
+            if not errors:
+                listed = {r.get("rule_id") for r in listing}
+                rules_by_id = {rid: rule for rid, rule in cached.items() if rid in listed}
+                rules_by_id.update((rid, rule) for rid, rule in fetched.items() if rid in listed)
+                stats["rules_fetched"] = len(fetched)
+                stats["rules_deleted"] = len(cached) - len(set(cached) & listed)
+            else:
+                # Fall back to a full export rather than trusting a partial view
+                state = None
+                stats["full_export"] = True
+
+        if state is None:
+            all_rules, errors = await _fetch_rules(client, base_url, headers)
+            rules_by_id = {r.get("rule_id"): r for r in all_rules}
+            stats["rules_fetched"] = len(all_rules)
+
+        if errors:
+            _incremental_state.pop(key, None)
+            return [], errors, stats
+
+        _incremental_state[key] = {
+            "rules": rules_by_id,
+            "watermark": max((r.get("updated_at") or "" for r in rules_by_id.values()), default=""),
+        }
+        _incremental_state.move_to_end(key)
+        while len(_incremental_state) > _INCREMENTAL_STATE_SIZE:
+            _incremental_state.popitem(last=False)
+
+        if progress:
+            progress("rules_fetched", stats["rules_fetched"])
+        # Attach exceptions to copies so the cached rules stay untouched
+        rules = sorted((dict(r) for r in rules_by_id.values()), key=lambda r: r.get("name") or "")
+        await _attach_exceptions(client, base_url, headers, rules, errors, progress=progress)
+
+    return rules, errors, stats
+
+
+async def _fetch_rules(
+    client: httpx.AsyncClient,
+    base_url: str,
+    headers: dict,
+    extra_params: dict | None = None,
+) -> tuple[list[dict], list[str]]:
+    """Page through detection_engine/rules/_find. Returns (rules_list, errors_list)."""
+    rules_url = f"{base_url}/api/detection_engine/rules/_find"
+    rules = []
+    errors = []
     try:
         page = 1
         per_page = 10000
         total = 0
 
-        with httpx.Client(timeout=60, verify=False) as client:
-            while True:
-                resp = client.get(
-                    rules_url,
-                    params={"per_page": per_page, "page": page, "sort_field": "name", "sort_order": "asc"},
-                    headers=headers,
-                )
-                resp.raise_for_status()
-                data = resp.json()
-                page_rules = data.get("data", [])
-                total = data.get("total", 0)
-                rules.extend(page_rules)
+        while True:
+            resp = await client.get(
+                rules_url,
+                params={
+                    "per_page": per_page, "page": page, "sort_field": "name", "sort_order": "asc",
+                    **(extra_params or {}),
+                },
+                headers=headers,
+                timeout=60,
+            )
+            resp.raise_for_status()
+            data = resp.json()
+            page_rules = data.get("data", [])
+            total = data.get("total", 0)
+            rules.extend(page_rules)
 
-                if len(rules) >= total:
-                    break
-                page += 1
+            if len(rules) >= total or not page_rules:
+                break
+            page += 1
 
     except Exception as e:
         errors.append(f"API export error: {str(e)}")
 
+    return rules, errors
+
+
+async def _attach_exceptions(
+    client: httpx.AsyncClient,
+    base_url: str,
+    headers: dict,
+    rules: list[dict],
+    errors: list[str],
+    progress: Callable[[str, int], None] | None = None,
+) -> None:
+    """
+    Fetch exception lists and their items, and attach them to the rules as
+    _enriched_exceptions and _exception_items. Errors are appended in place.
+    """
     # Fetch exception lists and their items
     try:
         exceptions_url = f"{base_url}/api/exception_lists/_find"
-        with httpx.Client(timeout=60, verify=False) as client:
-            resp = client.get(
-                exceptions_url,
-                params={"per_page": 10000, "page": 1},
-                headers=headers,
-            )
-            if resp.status_code == 200:
-                exc_data = resp.json()
-                exception_lists = {
-                    el.get("list_id"): el
-                    for el in exc_data.get("data", [])
-                }
-
-                # Fetch actual exception items for each list
-                exception_items_by_list: dict[str, list[dict]] = {}
-                for list_id, exc_list in exception_lists.items():
-                    namespace = exc_list.get("namespace_type", "single")
-                    try:
-                        items_url = f"{base_url}/api/exception_lists/items/_find"
-                        items_resp = client.get(
-                            items_url,
-                            params={
-                                "list_id": list_id,
-                                "namespace_type": namespace,
-                                "per_page": 10000,
-                                "page": 1,
-                            },
-                            headers=headers,
-                        )
-                        if items_resp.status_code == 200:
-                            items_data = items_resp.json()
-                            # Clean volatile fields from items
-                            cleaned_items = []
-                            for item in items_data.get("data", []):
-                                cleaned = {
-                                    k: v for k, v in item.items()
-                                    if k not in (
-                                        "id", "created_at", "updated_at",
-                                        "created_by", "updated_by",
-                                        "_version", "tie_breaker_id",
-                                    )
-                                }
-                                cleaned_items.append(cleaned)
-                            exception_items_by_list[list_id] = cleaned_items
-                    except Exception as e:
-                        errors.append(f"Failed to fetch items for list {list_id}: {str(e)}")
-
-                # Attach enriched exceptions and items to rules
-                for rule in rules:
-                    rule_exceptions = rule.get("exceptions_list", [])
-                    enriched = []
-                    rule_exception_items = []
-                    for ref in rule_exceptions:
-                        list_id = ref.get("list_id", "")
-                        if list_id in exception_lists:
-                            enriched.append(exception_lists[list_id])
-                        else:
-                            enriched.append(ref)
-                        if list_id in exception_items_by_list:
-                            rule_exception_items.extend(exception_items_by_list[list_id])
-                    if enriched:
-                        rule["_enriched_exceptions"] = enriched
-                    # Store cleaned exception items for hash computation
-                    # (not in the hash exclusion list, so it WILL affect the hash)
-                    rule["_exception_items"] = sorted(
-                        rule_exception_items,
-                        key=lambda x: json.dumps(x, sort_keys=True),
+        # Stays None unless Kibana answered 200 (even with no lists)
+        exception_lists: dict[str, dict] | None = None
+        async for page_lists in _iter_pages(client, exceptions_url, {}, headers):
+            if exception_lists is None:
+                exception_lists = {}
+            for el in page_lists:
+                exception_lists[el.get("list_id")] = el
+        if exception_lists is not None:
+            # Fetch actual exception items for each list, a bounded
+            # number of lists at a time
+            semaphore = asyncio.Semaphore(EXCEPTION_FETCH_CONCURRENCY)
+            if progress:
+                progress("lists_total", len(exception_lists))
+
+            async def fetch_list(list_id: str, exc_list: dict) -> list[dict]:
+                async with semaphore:
+                    items = await _fetch_exception_items(
+                        client, base_url, headers,
+                        list_id, exc_list.get("namespace_type", "single"),
                     )
+                if progress:
+                    progress("lists_fetched", 1)
+                return items
+
+            fetched = await asyncio.gather(
+                *(fetch_list(list_id, exc_list) for list_id, exc_list in exception_lists.items()),
+                return_exceptions=True,
+            )
+            exception_items_by_list: dict[str, list[dict]] = {}
+            for list_id, outcome in zip(exception_lists, fetched):
+                if isinstance(outcome, BaseException):
+                    errors.append(f"Failed to fetch items for list {list_id}: {str(outcome)}")
+                else:
+                    exception_items_by_list[list_id] = outcome
+
+            # Attach enriched exceptions and items to rules. Rules that
+            # reference the same lists share one sorted item list, so each
+            # combination is built, sorted and digested once per run.
+            items_by_refs: dict[tuple[str, ...], list[dict]] = {}
+            # Canonical text per item for this export only: every item is
+            # serialized once however many combinations it appears in
+            item_texts: dict[int, str] = {}
+            for rule in rules:
+                rule_exceptions = rule.get("exceptions_list", [])
+                enriched = []
+                item_refs = []
+                for ref in rule_exceptions:
+                    list_id = ref.get("list_id", "")
+                    if list_id in exception_lists:
+                        enriched.append(exception_lists[list_id])
+                    else:
+                        enriched.append(ref)
+                    if list_id in exception_items_by_list:
+                        item_refs.append(list_id)
+                if enriched:
+                    rule["_enriched_exceptions"] = enriched
+                # Sorting makes the concatenation order irrelevant; each
+                # combination's items are sorted and digested once per run
+                refs_key = tuple(sorted(item_refs))
+                rule_exception_items = items_by_refs.get(refs_key)
+                if rule_exception_items is None:
+                    rule_exception_items = canonical.sort_items([
+                        item for list_id in refs_key for item in exception_items_by_list[list_id]
+                    ], item_texts)
+                    items_by_refs[refs_key] = rule_exception_items
+                # Store cleaned exception items for hash computation
+                # (not in the hash exclusion list, so it WILL affect the hash)
+                rule["_exception_items"] = rule_exception_items
     except Exception as e:
         errors.append(f"Exception list fetch error: {str(e)}")
 
-    return rules, errors
+
+async def _iter_pages(
+    client: httpx.AsyncClient,
+    url: str,
+    params: dict,
+    headers: dict,
+    page_size: int | None = None,
+) -> AsyncIterator[list[dict]]:
+    """
+    Yield the ``data`` array of each page of a Kibana _find endpoint.
+
+    The next page is requested while the caller processes the current one,
+    and only one page body is held at a time. Yields nothing when the first
+    page is not a 200 response; a failing later page raises, since the
+    result would otherwise be silently truncated.
+    """
+    page_size = page_size or EXCEPTION_PAGE_SIZE
+
+    async def fetch(page: int) -> httpx.Response:
+        return await client.get(
+            url,
+            params={**params, "per_page": page_size, "page": page},
+            headers=headers,
+            timeout=60,
+        )
+
+    resp = await fetch(1)
+    if resp.status_code != 200:
+        return
+    data = resp.json()
+    last_page = max(1, -(-data.get("total", 0) // page_size))
+    page = 1
+    next_page: asyncio.Task | None = None
+    try:
+        while True:
+            page_data = data.get("data", [])
+            if page < last_page and page_data:
+                next_page = asyncio.ensure_future(fetch(page + 1))
+            yield page_data
+            if next_page is None:
+                break
+            resp = await next_page
+            next_page = None
+            resp.raise_for_status()
+            data = resp.json()
+            page += 1
+    finally:
+        if next_page is not None:
+            next_page.cancel()
+
+
+async def _fetch_exception_items(
+    client: httpx.AsyncClient,
+    base_url: str,
+    headers: dict,
+    list_id: str,
+    namespace: str,
+) -> list[dict]:
+    """Fetch all items of one exception list with volatile fields removed."""
+    cleaned_items = []
+    pages = _iter_pages(
+        client,
+        f"{base_url}/api/exception_lists/items/_find",
+        {"list_id": list_id, "namespace_type": namespace},
+        headers,
+    )
+    async for page_items in pages:
+        # Clean volatile fields from items
+        for item in page_items:
+            cleaned = {
+                k: v for k, v in item.items()
+                if k not in (
+                    "id", "created_at", "updated_at",
+                    "created_by", "updated_by",
+                    "_version", "tie_breaker_id",
+                )
+            }
+            cleaned_items.append(cleaned)
+    return cleaned_items
@@ -0,0 +1,238 @@
+"""
+Pool of warm detection-rules CLI workers (see cli_worker.py).
+
+Each worker is a persistent python3 process that has already imported
+detection_rules, so an export only pays for the export itself. Workers are
+reused across detections, replaced when they crash or time out, and
+recycled after a number of exports to bound memory growth. When every warm
+worker is busy, concurrent exports start one-off workers (up to
+SYNC_CLI_MAX_WORKERS) instead of queueing behind them. Exports run on the
+pool's own threads, one per concurrent worker, so they never occupy the
+default asyncio.to_thread executor.
+
+    SYNC_CLI_WORKERS              warm worker processes kept between exports (default 1)
+    SYNC_CLI_MAX_WORKERS          concurrent exports, warm plus one-off (default
+                                  SYNC_BATCH_CONCURRENCY, so a /detect-changes/batch
+                                  takes about its slowest export, not their sum)
+    SYNC_CLI_WORKER_MAX_EXPORTS   exports before a worker is recycled (default 50)
+    SYNC_CLI_STARTUP_TIMEOUT      seconds allowed for the import (default 90)
+    SYNC_CLI_RETRY_INTERVAL       seconds before retrying a missing CLI (default 300)
+"""
+
+import asyncio
+import json
+import logging
+import os
+import queue
+import select
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
+
+logger = logging.getLogger(__name__)
+
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cli_worker.py")
+
+
+class CliUnavailableError(Exception):
+    """detection_rules cannot be imported in the worker interpreter."""
+
+
+def _worker_env() -> dict[str, str]:
+    env = os.environ.copy()
+    env["PYTHONDONTWRITEBYTECODE"] = "1"
+    # Disable SSL verification via environment variables
+    # (the CLI does not inherit our httpx verify=False).
+    env["PYTHONHTTPSVERIFY"] = "0"
+    env["REQUESTS_CA_BUNDLE"] = ""
+    env["CURL_CA_BUNDLE"] = ""
+    return env
+
+
+class CliWorker:
+    """One persistent worker process speaking the cli_worker.py protocol."""
+
+    def __init__(self, command: list[str], startup_timeout: float):
+        self.proc = subprocess.Popen(
+            command,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            text=True,
+            env=_worker_env(),
+        )
+        self.exports = 0
+        try:
+            ready = self._read(startup_timeout)
+        except BaseException:
+            self.close()
+            raise
+        self.available = bool(ready.get("available"))
+        self.error = ready.get("error", "")
+
+    def _read(self, timeout: float) -> dict:
+        readable, _, _ = select.select([self.proc.stdout], [], [], timeout)
+        if not readable:
+            raise subprocess.TimeoutExpired(self.proc.args, timeout)
+        line = self.proc.stdout.readline()
+        if not line:
+            raise RuntimeError(f"CLI worker exited with code {self.proc.wait()}")
+        return json.loads(line)
+
+    def run(self, args: list[str], timeout: float) -> dict:
+        self.proc.stdin.write(json.dumps({"args": args}) + "\n")
+        self.proc.stdin.flush()
+        result = self._read(timeout)
+        self.exports += 1
+        return result
+
+    def alive(self) -> bool:
+        return self.proc.poll() is None
+
+    def close(self) -> None:
+        if self.proc.poll() is None:
+            self.proc.kill()
+        self.proc.wait()
+
+
+class CliExporterPool:
+    """Bounded pool of warm CliWorker processes, safe to use from threads."""
+
+    def __init__(
+        self,
+        size: int = 1,
+        max_workers: int | None = None,
+        max_exports: int = 50,
+        startup_timeout: float = 90,
+        retry_interval: float = 300,
+        command: list[str] | None = None,
+    ):
+        self.command = command or ["python3", WORKER_SCRIPT]
+        self.max_exports = max_exports
+        self.startup_timeout = startup_timeout
+        self.retry_interval = retry_interval
+        self.size = size
+        self.max_workers = max(size, max_workers or size, 1)
+        self._slots = threading.BoundedSemaphore(self.max_workers)
+        self._executor: ThreadPoolExecutor | None = None
+        self._executor_lock = threading.Lock()
+        self._idle: queue.LifoQueue[CliWorker] = queue.LifoQueue()
+        self._unavailable_until = 0.0
+        self.available: bool | None = None
+        self.error = ""
+
+    @classmethod
+    def from_env(cls) -> "CliExporterPool":
+        return cls(
+            size=int(os.environ.get("SYNC_CLI_WORKERS", "1")),
+            max_workers=int(
+                os.environ.get("SYNC_CLI_MAX_WORKERS") or os.environ.get("SYNC_BATCH_CONCURRENCY", "8")
+            ),
+            max_exports=int(os.environ.get("SYNC_CLI_WORKER_MAX_EXPORTS", "50")),
+            startup_timeout=float(os.environ.get("SYNC_CLI_STARTUP_TIMEOUT", "90")),
+            retry_interval=float(os.environ.get("SYNC_CLI_RETRY_INTERVAL", "300")),
+        )
+
+    def _checkout(self) -> CliWorker:
+        while True:
+            try:
+                worker = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            if worker.alive():
+                return worker
+            worker.close()
+
+        if time.monotonic() < self._unavailable_until:
+            raise CliUnavailableError(self.error)
+        worker = CliWorker(self.command, self.startup_timeout)
+        self.available = worker.available
+        self.error = worker.error
+        if not worker.available:
+            worker.close()
+            self._unavailable_until = time.monotonic() + self.retry_interval
+            raise CliUnavailableError(worker.error)
+        logger.info(f"Started warm detection-rules worker (pid {worker.proc.pid})")
+        return worker
+
+    def _checkin(self, worker: CliWorker) -> None:
+        # Workers beyond the warm pool size were one-off and are not kept
+        if worker.alive() and worker.exports < self.max_exports and self._idle.qsize() < self.size:
+            self._idle.put(worker)
+        else:
+            worker.close()
+
+    def run(self, args: list[str], timeout: float) -> tuple[int, str]:
+        """
+        Run one CLI invocation on a warm (or one-off) worker. The timeout
+        covers waiting for a free slot as well as the export. Returns
+        (returncode, stderr). Raises CliUnavailableError or
+        subprocess.TimeoutExpired.
+        """
+        started = time.monotonic()
+        if not self._slots.acquire(timeout=timeout):
+            raise subprocess.TimeoutExpired(self.command, timeout)
+        try:
+            worker = self._checkout()
+            try:
+                result = worker.run(args, max(0.0, timeout - (time.monotonic() - started)))
+            except BaseException:
+                # The worker state is unknown after a timeout or crash
+                worker.close()
+                raise
+            self._checkin(worker)
+        finally:
+            self._slots.release()
+        return result.get("returncode", 1), result.get("stderr", "")
+
+    async def run_in_thread(self, fn: Callable[..., Any], *args: Any) -> Any:
+        """Await fn(*args) on the pool's own export threads."""
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.max_workers, thread_name_prefix="cli-export",
+                )
+            executor = self._executor
+        return await asyncio.get_running_loop().run_in_executor(executor, fn, *args)
+
+    def probe(self) -> bool:
+        """Report CLI availability, starting a warm worker if none is running."""
+        if not self._slots.acquire(blocking=False):
+            # Every worker is busy exporting, so the CLI is evidently there
+            return bool(self.available)
+        try:
+            self._checkin(self._checkout())
+            return True
+        except CliUnavailableError:
+            return False
+        except Exception as e:
+            self.available = False
+            self.error = str(e)
+            return False
+        finally:
+            self._slots.release()
+
+    def close(self) -> None:
+        with self._executor_lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+_pool: CliExporterPool | None = None
+_pool_lock = threading.Lock()
+
+
+def get_cli_exporter() -> CliExporterPool:
+    """Return the process-wide CLI worker pool."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = CliExporterPool.from_env()
+        return _pool
@@ -0,0 +1,95 @@
+"""
+Long-lived detection-rules CLI worker.
+
+Started by cli_exporter.CliExporterPool. Imports detection_rules once and
+then runs one CLI invocation per request, so the interpreter start-up and
+the (slow) schema/package imports are paid once per worker instead of once
+per export.
+
+Protocol: one JSON object per line. The worker first writes
+{"ready": true, "available": bool, "error": str}; then, for every request
+{"args": [...]} read from stdin, it writes {"returncode": int, "stderr": str}.
+The protocol uses a private copy of the original stdout; fd 1 is pointed at
+stderr so nothing the CLI prints can corrupt the channel.
+"""
+
+import contextlib
+import io
+import json
+import os
+import runpy
+import ssl
+import sys
+
+
+def _disable_ssl_verification() -> None:
+    """Skip certificate validation in urllib3/requests used by the CLI."""
+    ssl._create_default_https_context = ssl._create_unverified_context
+    orig_ctx = ssl.create_default_context
+
+    def _noverify(*a, **kw):
+        c = orig_ctx(*a, **kw)
+        c.check_hostname = False
+        c.verify_mode = ssl.CERT_NONE
+        return c
+
+    ssl.create_default_context = _noverify
+    try:
+        import urllib3
+        urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+    except Exception:
+        pass
+    try:
+        import requests
+        requests.packages.urllib3.disable_warnings()
+    except Exception:
+        pass
+
+
+def _run_cli(args: list[str]) -> dict:
+    """Run `python -m detection_rules <args>` inside this interpreter."""
+    stdout = io.StringIO()
+    stderr = io.StringIO()
+    returncode = 0
+    sys.argv = ["detection_rules", *args]
+    try:
+        with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+            runpy.run_module("detection_rules", run_name="__main__")
+    except SystemExit as e:
+        if isinstance(e.code, int):
+            returncode = e.code
+        elif e.code is not None:
+            stderr.write(str(e.code))
+            returncode = 1
+    except BaseException as e:
+        stderr.write(f"{type(e).__name__}: {e}")
+        returncode = 1
+    # Callers only log the head of stderr; keep protocol lines small
+    return {"returncode": returncode, "stderr": stderr.getvalue()[:4000]}
+
+
+def main() -> None:
+    channel = os.fdopen(os.dup(sys.stdout.fileno()), "w")
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+    def send(message: dict) -> None:
+        channel.write(json.dumps(message) + "\n")
+        channel.flush()
+
+    _disable_ssl_verification()
+    try:
+        import detection_rules.main  # noqa: F401  (the expensive import)
+        send({"ready": True, "available": True, "error": ""})
+    except Exception as e:
+        send({"ready": True, "available": False, "error": f"{type(e).__name__}: {e}"})
+        return
+
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        request = json.loads(line)
+        send(_run_cli(request.get("args", [])))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""
+Process pool for the CPU-bound stages of a detection.
+
+Hashing, classifying and rendering TOML for a whole space is pure Python
+work that would otherwise hold the event loop (and the GIL) for seconds, so
+those stages are shipped to worker processes and awaited. Workers are
+spawned lazily on first use and reused; a crashed pool is replaced on the
+next call. With SYNC_CPU_WORKERS=0 the stages run in a thread of this
+process instead, which keeps the loop responsive but not the other cores.
+
+    SYNC_CPU_WORKERS   worker processes (default: number of CPUs divided
+                       among the SYNC_SERVICE_WORKERS service processes)
+"""
+
+import asyncio
+import logging
+import multiprocessing
+import os
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, AsyncIterator, Callable
+
+logger = logging.getLogger(__name__)
+
+
+class CpuPool:
+    """Lazily started ProcessPoolExecutor awaited from the event loop."""
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self.tasks = 0
+        self._executor: ProcessPoolExecutor | None = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> "CpuPool":
+        service_workers = max(1, int(os.environ.get("SYNC_SERVICE_WORKERS", "1")))
+        default = max(1, (os.cpu_count() or 1) // service_workers)
+        return cls(workers=int(os.environ.get("SYNC_CPU_WORKERS", str(default))))
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                # spawn: forking a process that runs threads (uvicorn, CLI
+                # pool) can copy held locks into the child
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+            return self._executor
+
+    async def run(self, fn: Callable[..., Any], *args: Any) -> Any:
+        """Run fn(*args) in a worker process (or a thread when workers is 0)."""
+        self.tasks += 1
+        if self.workers <= 0:
+            return await asyncio.to_thread(fn, *args)
+        executor = self._get_executor()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(executor, fn, *args)
+        except BrokenProcessPool:
+            logger.warning("CPU worker pool broke, starting a new one")
+            with self._lock:
+                if self._executor is executor:
+                    self._executor = None
+            raise
+
+    async def imap(self, fn: Callable[..., Any], chunks: list, *args: Any) -> AsyncIterator[Any]:
+        """
+        Yield fn(chunk, *args) for each chunk, in order, keeping up to one
+        chunk per worker in flight while earlier results are consumed.
+        """
+        window = max(1, self.workers)
+        pending: deque[asyncio.Future] = deque()
+        try:
+            for chunk in chunks:
+                if len(pending) >= window:
+                    yield await pending.popleft()
+                pending.append(asyncio.ensure_future(self.run(fn, chunk, *args)))
+            while pending:
+                yield await pending.popleft()
+        finally:
+            for future in pending:
+                future.cancel()
+
+    def shutdown(self) -> None:
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "mode": "process" if self.workers > 0 else "thread",
+            "started": self._executor is not None,
+            "tasks": self.tasks,
+        }
+
+
+_pool: CpuPool | None = None
+_pool_lock = threading.Lock()
+
+
+def get_cpu_pool() -> CpuPool:
+    """Return the process-wide CPU pool."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = CpuPool.from_env()
+        return _pool
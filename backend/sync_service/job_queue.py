@@ -0,0 +1,240 @@
+"""
+In-process background job queue for long-running detections.
+
+A submitted job returns an id right away; callers poll its status and
+progress and fetch the result once it has finished, so a slow Kibana never
+holds a PocketBase request open. Jobs run on a fixed number of asyncio
+worker tasks fed by a bounded queue, and finished jobs are kept for a TTL,
+at most SYNC_JOB_MAX_FINISHED of them (oldest submitted dropped first).
+With a SharedCache attached (multi-worker mode) job state and results are
+published to it, so a poll answered by another worker still finds the job,
+and a result is dropped from memory once it is published. Publishing and
+reading run in threads, and a status poll reads the job's state only; the
+result is loaded when it is asked for.
+
+    SYNC_JOB_WORKERS       jobs running at the same time (default 2)
+    SYNC_JOB_QUEUE_SIZE    queued jobs before submissions are rejected (default 100)
+    SYNC_JOB_RESULT_TTL    seconds a finished job is kept (default 3600)
+    SYNC_JOB_MAX_FINISHED  finished jobs kept in memory (default 100)
+"""
+
+import asyncio
+import logging
+import os
+import time
+import uuid
+from typing import Any, Awaitable, Callable
+
+logger = logging.getLogger(__name__)
+
+
+class JobQueueFullError(Exception):
+    """The queue already holds its maximum number of pending jobs."""
+
+
+class Job:
+    """One submitted job with its status, progress counters and outcome."""
+
+    def __init__(self, kind: str, run: Callable[["Job"], Awaitable[Any]] | None):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.run = run
+        self.status = "queued"  # queued | running | succeeded | failed
+        self.progress: dict[str, int] = {}
+        self.result: Any = None
+        self.error: str | None = None
+        self.submitted_at = time.time()
+        self.started_at: float | None = None
+        self.finished_at: float | None = None
+        self.on_progress: Callable[["Job"], None] | None = None
+
+    @classmethod
+    def restore(cls, state: dict, result: Any = None) -> "Job":
+        """Rebuild a job published by another worker from its to_dict() state."""
+        job = cls(state["kind"], None)
+        job.id = state["job_id"]
+        job.status = state["status"]
+        job.progress = dict(state["progress"])
+        job.error = state["error"]
+        job.submitted_at = state["submitted_at"]
+        job.started_at = state["started_at"]
+        job.finished_at = state["finished_at"]
+        job.result = result
+        return job
+
+    def report(self, stage: str, count: int) -> None:
+        """Progress callback: add count to the counter for stage."""
+        self.progress[stage] = self.progress.get(stage, 0) + count
+        if self.on_progress is not None:
+            self.on_progress(self)
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("succeeded", "failed")
+
+    def to_dict(self) -> dict:
+        return {
+            "job_id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "progress": dict(self.progress),
+            "error": self.error,
+            "submitted_at": self.submitted_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class JobQueue:
+    """Bounded asyncio job queue served by a fixed set of worker tasks."""
+
+    def __init__(
+        self, workers: int = 2, max_queued: int = 100, result_ttl: float = 3600, max_finished: int = 100,
+    ):
+        self.workers = workers
+        self.max_queued = max_queued
+        self.result_ttl = result_ttl
+        self.max_finished = max_finished
+        self.shared = None
+        self._jobs: dict[str, Job] = {}
+        self._queue: asyncio.Queue[Job] | None = None
+        self._tasks: list[asyncio.Task] = []
+        self._published_at: dict[str, float] = {}
+        self._publishing: dict[str, asyncio.Task] = {}
+        self._pruning: asyncio.Future | None = None
+
+    @classmethod
+    def from_env(cls) -> "JobQueue":
+        return cls(
+            workers=int(os.environ.get("SYNC_JOB_WORKERS", "2")),
+            max_queued=int(os.environ.get("SYNC_JOB_QUEUE_SIZE", "100")),
+            result_ttl=float(os.environ.get("SYNC_JOB_RESULT_TTL", "3600")),
+            max_finished=int(os.environ.get("SYNC_JOB_MAX_FINISHED", "100")),
+        )
+
+    def start(self) -> None:
+        """Start the worker tasks on the running event loop."""
+        if self._tasks:
+            return
+        self._queue = asyncio.Queue(maxsize=self.max_queued)
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        # Let the last state of every job reach the shared cache
+        await asyncio.gather(*self._publishing.values(), return_exceptions=True)
+
+    def submit(self, kind: str, run: Callable[[Job], Awaitable[Any]]) -> Job:
+        """
+        Queue run(job) and return the job. Raises JobQueueFullError when
+        max_queued jobs are already waiting.
+        """
+        self.start()
+        self._prune()
+        job = Job(kind, run)
+        try:
+            self._queue.put_nowait(job)
+        except asyncio.QueueFull:
+            raise JobQueueFullError(f"{self.max_queued} jobs already queued") from None
+        self._jobs[job.id] = job
+        if self.shared is not None:
+            job.on_progress = self._publish_progress
+            self._publish(job)
+        return job
+
+    async def get(self, job_id: str) -> Job | None:
+        """
+        Return a job by id; with a shared cache, also jobs of other workers
+        (restored without their result, see result()).
+        """
+        self._prune()
+        job = self._jobs.get(job_id)
+        if job is None and self.shared is not None:
+            state = await asyncio.to_thread(self.shared.get_job_state, job_id)
+            if state is not None:
+                job = Job.restore(state)
+        return job
+
+    async def result(self, job: Job) -> Any:
+        """Return the result of a finished job returned by get()."""
+        if job.result is not None or self.shared is None:
+            return job.result
+        return await asyncio.to_thread(self.shared.get_job_result, job.id)
+
+    def _publish(self, job: Job) -> None:
+        # Encoding the result and writing it happen in a thread; one job's
+        # writes are chained so a late progress write cannot land after the
+        # final state
+        previous = self._publishing.get(job.id)
+        task = asyncio.ensure_future(self._write(
+            job.id, job.to_dict(), job.result if job.finished else None, previous,
+        ))
+        self._publishing[job.id] = task
+        task.add_done_callback(lambda done: self._forget_publish(job.id, done))
+        self._published_at[job.id] = time.monotonic()
+
+    async def _write(self, job_id: str, state: dict, result: Any, previous: asyncio.Task | None) -> None:
+        if previous is not None:
+            await previous
+        try:
+            await asyncio.to_thread(self.shared.put_job, job_id, state, result)
+        except Exception as e:
+            logger.warning(f"Could not publish job {job_id}: {e}")
+            return
+        job = self._jobs.get(job_id)
+        if result is not None and job is not None:
+            # Published: result() reads it back from the shared cache
+            job.result = None
+
+    def _forget_publish(self, job_id: str, task: asyncio.Task) -> None:
+        if self._publishing.get(job_id) is task:
+            del self._publishing[job_id]
+
+    def _publish_progress(self, job: Job) -> None:
+        # Progress arrives in bursts: write it at most once per second
+        if time.monotonic() - self._published_at.get(job.id, 0) >= 1:
+            self._publish(job)
+
+    def stats(self) -> dict:
+        counts = {"queued": 0, "running": 0, "succeeded": 0, "failed": 0}
+        for job in self._jobs.values():
+            counts[job.status] += 1
+        return counts
+
+    def _prune(self) -> None:
+        """Forget finished jobs older than the result TTL or beyond max_finished."""
+        cutoff = time.time() - self.result_ttl
+        finished = [job for job in self._jobs.values() if job.finished]
+        excess = len(finished) - self.max_finished
+        expired = [
+            job.id for i, job in enumerate(finished)
+            if i < excess or job.finished_at < cutoff
+        ]
+        for job_id in expired:
+            del self._jobs[job_id]
+            self._published_at.pop(job_id, None)
+        if expired and self.shared is not None and (self._pruning is None or self._pruning.done()):
+            self._pruning = asyncio.ensure_future(asyncio.to_thread(self.shared.prune_jobs, cutoff))
+
+    async def _work(self) -> None:
+        while True:
+            job = await self._queue.get()
+            job.status = "running"
+            job.started_at = time.time()
+            if self.shared is not None:
+                self._publish(job)
+            try:
+                job.result = await job.run(job)
+                job.status = "succeeded"
+            except Exception as e:
+                logger.error(f"Job {job.id} ({job.kind}) failed: {e}")
+                job.error = str(getattr(e, "detail", e))
+                job.status = "failed"
+            finally:
+                job.finished_at = time.time()
+                if self.shared is not None:
+                    self._publish(job)
+                self._queue.task_done()
@@ -0,0 +1,94 @@
+"""
+Shared, connection-pooled HTTP clients for Kibana.
+
+One long-lived httpx.AsyncClient is kept per Kibana host so detection and
+revert calls reuse TCP/TLS connections instead of paying a new handshake on
+every request. Pool limits and keep-alive are configurable via environment:
+
+    SYNC_KIBANA_MAX_CONNECTIONS      max open connections per host (default 20)
+    SYNC_KIBANA_MAX_KEEPALIVE        idle connections kept per host (default 10)
+    SYNC_KIBANA_KEEPALIVE_EXPIRY     idle connection lifetime in seconds (default 30)
+    SYNC_KIBANA_TIMEOUT              default request timeout in seconds (default 60)
+"""
+
+import contextlib
+import os
+from typing import AsyncIterator
+from urllib.parse import urlsplit
+
+import httpx
+
+
+def kibana_base_url(kibana_url: str, space: str) -> str:
+    """Return the Kibana base URL, scoped to a space when it is not 'default'."""
+    base_url = kibana_url.rstrip("/")
+    if space and space != "default":
+        base_url = f"{base_url}/s/{space}"
+    return base_url
+
+
+def kibana_host_key(kibana_url: str) -> tuple[str, str, int | None]:
+    """Return the (scheme, host, port) a Kibana URL connects to."""
+    parts = urlsplit(kibana_url)
+    return parts.scheme, parts.hostname or "", parts.port
+
+
+def kibana_headers(api_key: str) -> dict[str, str]:
+    return {
+        "Authorization": f"ApiKey {api_key}",
+        "kbn-xsrf": "true",
+        "Content-Type": "application/json",
+    }
+
+
+class KibanaClientPool:
+    """Lazily created httpx.AsyncClient per Kibana host (scheme, host, port)."""
+
+    def __init__(
+        self,
+        max_connections: int = 20,
+        max_keepalive_connections: int = 10,
+        keepalive_expiry: float = 30.0,
+        timeout: float = 60.0,
+    ):
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self.timeout = timeout
+        self._clients: dict[tuple[str, str, int | None], httpx.AsyncClient] = {}
+
+    @classmethod
+    def from_env(cls) -> "KibanaClientPool":
+        return cls(
+            max_connections=int(os.environ.get("SYNC_KIBANA_MAX_CONNECTIONS", "20")),
+            max_keepalive_connections=int(os.environ.get("SYNC_KIBANA_MAX_KEEPALIVE", "10")),
+            keepalive_expiry=float(os.environ.get("SYNC_KIBANA_KEEPALIVE_EXPIRY", "30")),
+            timeout=float(os.environ.get("SYNC_KIBANA_TIMEOUT", "60")),
+        )
+
+    def get(self, kibana_url: str) -> httpx.AsyncClient:
+        """Return the shared client for the host of kibana_url."""
+        key = kibana_host_key(kibana_url)
+        client = self._clients.get(key)
+        if client is None or client.is_closed:
+            client = httpx.AsyncClient(timeout=self.timeout, limits=self.limits, verify=False)
+            self._clients[key] = client
+        return client
+
+    async def aclose(self) -> None:
+        clients = list(self._clients.values())
+        self._clients.clear()
+        for client in clients:
+            await client.aclose()
+
+
+@contextlib.asynccontextmanager
+async def borrow_client(client: httpx.AsyncClient | None, timeout: float = 60) -> AsyncIterator[httpx.AsyncClient]:
+    """Yield the given shared client, or a short-lived one when none is provided."""
+    if client is not None:
+        yield client
+        return
+    async with httpx.AsyncClient(timeout=timeout, verify=False) as own_client:
+        yield own_client
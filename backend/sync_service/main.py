@@ -3,28 +3,118 @@ Sync Service — FastAPI wrapper around the detection-rules CLI.
 
 Runs on port 8091 inside the PocketBase container.
 PocketBase hooks call this via $http.send() to localhost:8091.
+
+SYNC_SERVICE_WORKERS (default 1) starts that many uvicorn worker processes;
+with more than one, the hash, export and job caches are backed by a SQLite
+file shared by all workers (see shared_cache.py).
 """
 
+import asyncio
+import hashlib
 import json
 import logging
 import os
-from typing import Any
+import time
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Callable
 
 import httpx
 import uvicorn
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel
 
+import canonical
+import toml_engine
+from baseline_store import BaselineStore, default_data_dir
 from change_detector import (
+    RULE_HASH_VERSION,
+    cached_export,
+    classify_change_pairs,
     compute_rule_hash,
     detect_changes,
+    export_cache,
+    iter_detection_records,
+    rule_hash_cache,
     rule_to_toml,
 )
+from cli_exporter import get_cli_exporter
+from compression import CompressionMiddleware
+from cpu_pool import get_cpu_pool
+from job_queue import JobQueue, JobQueueFullError
+from kibana_client import KibanaClientPool, kibana_base_url, kibana_headers, kibana_host_key
+from shared_cache import SharedCache
+from single_flight import SingleFlight
 
 logging.basicConfig(level=logging.INFO, format="[sync-service] %(levelname)s %(message)s")
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="Elastic Git Sync Service", version="1.0.0")
+_kibana_pool: KibanaClientPool | None = None
+_job_queue: JobQueue | None = None
+_shared_cache: SharedCache | None = None
+
+# uvicorn worker processes; more than one shares caches through SQLite
+SERVICE_WORKERS = int(os.environ.get("SYNC_SERVICE_WORKERS", "1"))
+
+# How often the background task re-checks detection-rules CLI availability
+CLI_PROBE_TTL = float(os.environ.get("SYNC_CLI_PROBE_TTL", "300"))
+
+# Concurrent jobs per /detect-changes/batch request, overall and per Kibana host
+BATCH_CONCURRENCY = int(os.environ.get("SYNC_BATCH_CONCURRENCY", "8"))
+BATCH_HOST_CONCURRENCY = int(os.environ.get("SYNC_BATCH_HOST_CONCURRENCY", "2"))
+
+# Concurrent Kibana writes per bulk revert, and rules per _import request
+REVERT_CONCURRENCY = int(os.environ.get("SYNC_REVERT_CONCURRENCY", "8"))
+REVERT_IMPORT_CHUNK = int(os.environ.get("SYNC_REVERT_IMPORT_CHUNK", "200"))
+
+# Identical concurrent detections share one export; with a TTL (seconds),
+# repeated triggers within that window reuse the finished result too
+_detections = SingleFlight(result_ttl=float(os.environ.get("SYNC_DETECTION_RESULT_TTL", "0")))
+
+# Cached state reported by /health (never computed inside the request)
+_health_state: dict[str, Any] = {
+    "cli_available": None,
+    "cli_probed_at": None,
+    "last_detection_latency_ms": None,
+    "last_detection_at": None,
+}
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Create the shared Kibana client pool, attach the shared cache in
+    multi-worker mode and start the background CLI probe and job workers at
+    startup; stop them, and the CPU pool, on shutdown.
+    """
+    global _kibana_pool
+    _kibana_pool = KibanaClientPool.from_env()
+    logger.info(
+        f"Kibana client pool: max_connections={_kibana_pool.limits.max_connections}, "
+        f"keepalive={_kibana_pool.limits.max_keepalive_connections}"
+    )
+    if SERVICE_WORKERS > 1:
+        shared = get_shared_cache()
+        rule_hash_cache.shared = shared
+        export_cache.shared = shared
+        get_job_queue().shared = shared
+        logger.info(f"Worker {os.getpid()} using shared cache {shared.path}")
+    probe_task = asyncio.create_task(_cli_probe_loop())
+    get_job_queue().start()
+    try:
+        yield
+    finally:
+        probe_task.cancel()
+        await get_job_queue().stop()
+        await _kibana_pool.aclose()
+        get_cli_exporter().close()
+        get_cpu_pool().shutdown()
+        if _shared_cache is not None:
+            _shared_cache.close()
+
+
+app = FastAPI(title="Elastic Git Sync Service", version="1.0.0", lifespan=lifespan)
+app.add_middleware(CompressionMiddleware)
 
 
 # ---------------------------------------------------------------------------
@@ -47,6 +137,69 @@ class DetectChangesRequest(BaseModel):
     api_key: str
     space: str = "default"
     baseline_snapshots: list[BaselineSnapshot] = []
+    # Hash-only baseline: {rule_id: rule_hash}. Changes that need the previous
+    # content come back with baseline_required and go through /classify-changes.
+    baseline_hashes: dict[str, str] | None = None
+    # Compare against the baseline committed to this service via /baseline/commit
+    use_baseline_store: bool = False
+    # Which committed baseline of the space to use (see baseline_store.py)
+    baseline_id: str = ""
+    # Only download rules updated since the previous run for this space
+    incremental: bool = False
+    # False: render TOML for changed rules only and leave it out of current_rules
+    include_current_toml: bool = True
+    # Changes carry a JSON Patch and reference current_rules by rule_id
+    compact: bool = False
+
+
+class BatchDetectionJob(DetectChangesRequest):
+    job_id: str = ""  # Echoed back so callers can match results to jobs
+
+
+class BatchDetectChangesRequest(BaseModel):
+    jobs: list[BatchDetectionJob] = []
+    # Seconds allowed per job; a job that runs longer fails with status_code 504
+    job_timeout: float | None = None
+    # NDJSON response with one line per job, in completion order
+    stream: bool = False
+
+
+class BaselineCommitRequest(BaseModel):
+    kibana_url: str
+    space: str = "default"
+    snapshots: list[BaselineSnapshot] = []
+    deleted_rule_ids: list[str] = []
+    replace: bool = False  # True: snapshots are the complete baseline
+    # Caller's name for the baseline, e.g. "<project>/<environment>"; other
+    # baselines of the same space are kept apart and never replaced
+    baseline_id: str = ""
+
+
+class BaselineStatusRequest(BaseModel):
+    kibana_url: str
+    space: str = "default"
+    baseline_id: str = ""
+
+
+class ClassifyChangeItem(BaseModel):
+    rule_id: str
+    rule_name: str = ""
+    previous_state: dict | None = None
+    current_state: dict | None = None
+
+
+class ClassifyChangesRequest(BaseModel):
+    changes: list[ClassifyChangeItem] = []
+
+
+class RulesExportRequest(BaseModel):
+    kibana_url: str
+    api_key: str
+    space: str = "default"
+    # Oldest cached export accepted, in seconds (default SYNC_EXPORT_CACHE_TTL)
+    max_age: float | None = None
+    # Only the fields the rule listing shows, instead of full rule content
+    summary: bool = False
 
 
 class ExportTomlRequest(BaseModel):
@@ -60,12 +213,22 @@ class RevertRuleRequest(BaseModel):
     rule_content: dict  # The approved state to restore
 
 
+class RevertRulesBulkRequest(BaseModel):
+    kibana_url: str
+    api_key: str
+    space: str = "default"
+    rules: list[dict] = []  # Approved states to restore
+    # False: skip _import and revert every rule with its own PUT
+    use_import: bool = True
+
+
 class RevertExceptionItemsRequest(BaseModel):
     kibana_url: str
     api_key: str
     space: str = "default"
     previous_items: list[dict] = []  # Exception items from baseline
     current_items: list[dict] = []   # Exception items currently in Elastic
+    previous_lists: list[dict] = []  # Exception list containers from baseline
 
 
 class ComputeHashRequest(BaseModel):
@@ -84,11 +247,28 @@ class ParseRuleContentRequest(BaseModel):
 
 @app.get("/health")
 async def health():
-    """Health check endpoint."""
-    cli_available = _check_cli_available()
+    """
+    Health check endpoint.
+
+    Returns the cached CLI probe result immediately; the probe itself runs
+    in the background every SYNC_CLI_PROBE_TTL seconds.
+    """
+    now = time.time()
+    probed_at = _health_state["cli_probed_at"]
     return {
         "status": "healthy",
-        "cli_available": cli_available,
+        "cli_available": bool(_health_state["cli_available"]),
+        "cli_probe_age_seconds": round(now - probed_at, 1) if probed_at else None,
+        "last_detection_latency_ms": _health_state["last_detection_latency_ms"],
+        "last_detection_at": _health_state["last_detection_at"],
+        "hash_cache": rule_hash_cache.stats(),
+        "rule_hash_version": RULE_HASH_VERSION,
+        "export_cache": export_cache.stats(),
+        "jobs": get_job_queue().stats(),
+        "detections": _detections.stats(),
+        "cpu_pool": get_cpu_pool().stats(),
+        "service_workers": SERVICE_WORKERS,
+        "worker_pid": os.getpid(),
         "version": "1.0.0",
     }
 
@@ -103,30 +283,249 @@ async def api_detect_changes(req: DetectChangesRequest):
     granular changes (new, modified, deleted, state changes, etc.).
     """
     logger.info(f"Detecting changes for {req.kibana_url} space={req.space}")
-    logger.info(f"Baseline has {len(req.baseline_snapshots)} snapshots")
+    return await _run_detection(req, *await _resolve_baseline(req))
+
+
+@app.post("/detect-changes/stream")
+async def api_detect_changes_stream(req: DetectChangesRequest):
+    """
+    Streaming variant of /detect-changes.
+
+    Responds with NDJSON: one {"type": "change", ...} or
+    {"type": "current_rule", ...} line per record as soon as it is computed,
+    and a final {"type": "summary", errors, warnings, change_count,
+    rule_count} line. A failure after the response has started is reported
+    as a final {"type": "error", "detail": ...} line instead of a 500.
+    """
+    logger.info(f"Streaming change detection for {req.kibana_url} space={req.space}")
+    baseline_hashes, load_baseline = await _resolve_baseline(req)
+    records = iter_detection_records(
+        kibana_url=req.kibana_url,
+        api_key=req.api_key,
+        space=req.space,
+        baseline_snapshots=[s.model_dump() for s in req.baseline_snapshots],
+        use_cli=True,
+        baseline_hashes=baseline_hashes,
+        load_baseline=load_baseline,
+        client=get_kibana_pool().get(req.kibana_url),
+        incremental=req.incremental,
+        include_current_toml=req.include_current_toml,
+        compact=req.compact,
+    )
+
+    async def ndjson():
+        started = time.monotonic()
+        try:
+            async for kind, record in records:
+                if kind == "summary":
+                    _record_detection_latency(time.monotonic() - started)
+                    logger.info(
+                        f"Streamed detection complete: {record['change_count']} changes, "
+                        f"{record['rule_count']} current rules, {len(record['errors'])} errors"
+                    )
+                yield json.dumps({"type": kind, **record}, default=str) + "\n"
+        except Exception as e:
+            logger.error(f"Streaming change detection failed: {e}", exc_info=True)
+            yield json.dumps({"type": "error", "detail": str(e)}) + "\n"
+
+    return StreamingResponse(ndjson(), media_type="application/x-ndjson")
+
+
+@app.post("/detect-changes/batch")
+async def api_detect_changes_batch(req: BatchDetectChangesRequest):
+    """
+    Run /detect-changes for many (kibana_url, space, baseline) jobs at once.
+
+    Jobs run concurrently, at most SYNC_BATCH_CONCURRENCY at a time and
+    SYNC_BATCH_HOST_CONCURRENCY per Kibana host, so a batch takes about as
+    long as its slowest space. Each job's CLI export gets its own worker
+    process (SYNC_CLI_MAX_WORKERS defaults to SYNC_BATCH_CONCURRENCY; see
+    cli_exporter.py); with a lower cap, CLI exports beyond it queue.
+
+    Each job reports {index, job_id, kibana_url, space, status} plus either
+    "result" (the /detect-changes body) or "status_code" and "error"; one
+    failing job does not fail the batch.
+
+    Returns {"results": [...], "succeeded": int, "failed": int} with results
+    in job order, or with stream=true an NDJSON line {"type": "job", ...} per
+    job as it finishes followed by {"type": "summary", ...}.
+    """
+    logger.info(f"Batch detection: {len(req.jobs)} jobs")
+    outcomes = _iter_batch_outcomes(req)
+
+    if req.stream:
+        async def ndjson():
+            counts = {"succeeded": 0, "failed": 0}
+            async for outcome in outcomes:
+                counts["succeeded" if outcome["status"] == "ok" else "failed"] += 1
+                yield json.dumps({"type": "job", **outcome}, default=str) + "\n"
+            yield json.dumps({"type": "summary", "jobs": len(req.jobs), **counts}) + "\n"
+
+        return StreamingResponse(ndjson(), media_type="application/x-ndjson")
+
+    results = sorted([outcome async for outcome in outcomes], key=lambda o: o["index"])
+    succeeded = sum(1 for o in results if o["status"] == "ok")
+    return {"results": results, "succeeded": succeeded, "failed": len(results) - succeeded}
+
+
+@app.post("/jobs/detect-changes", status_code=202)
+async def api_submit_detection_job(req: DetectChangesRequest):
+    """
+    Queue a /detect-changes run in the background and return its job id.
+
+    Poll /jobs/{job_id} for status and progress, then fetch the detection
+    result from /jobs/{job_id}/result. Baseline problems (409) are reported
+    here; a full queue answers 503.
+    """
+    logger.info(f"Queueing detection job for {req.kibana_url} space={req.space}")
+    baseline_hashes, load_baseline = await _resolve_baseline(req)
+
+    async def run(job):
+        return await _run_detection(req, baseline_hashes, load_baseline, progress=job.report)
 
     try:
-        result = detect_changes(
-            kibana_url=req.kibana_url,
-            api_key=req.api_key,
-            space=req.space,
-            baseline_snapshots=[s.model_dump() for s in req.baseline_snapshots],
-            use_cli=True,
-        )
+        job = get_job_queue().submit("detect-changes", run)
+    except JobQueueFullError as e:
+        raise HTTPException(status_code=503, detail=f"Job queue is full: {e}")
+    return {"job_id": job.id, "status": job.status}
+
+
+@app.get("/jobs/{job_id}")
+async def api_job_status(job_id: str):
+    """Report a job's status, progress counters and timings."""
+    job = await get_job_queue().get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired job")
+    return job.to_dict()
+
 
+@app.get("/jobs/{job_id}/result")
+async def api_job_result(job_id: str):
+    """
+    Return the result of a succeeded job. Answers 409 while the job is
+    queued or running and 500 with the error when it failed.
+    """
+    queue = get_job_queue()
+    job = await queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired job")
+    if not job.finished:
+        raise HTTPException(status_code=409, detail=f"Job is {job.status}")
+    if job.status == "failed":
+        raise HTTPException(status_code=500, detail=job.error)
+    return await queue.result(job)
+
+
+@app.post("/baseline/commit")
+async def api_baseline_commit(req: BaselineCommitRequest):
+    """
+    Record approved rule snapshots in the service-owned baseline store.
+
+    Called after approvals (or with replace=True when a baseline is
+    initialized) so /detect-changes can run with use_baseline_store and
+    skip sending snapshots altogether.
+    """
+    try:
+        counts = await asyncio.to_thread(
+            get_baseline_store().commit,
+            req.kibana_url,
+            req.space,
+            [s.model_dump() for s in req.snapshots],
+            deleted_rule_ids=req.deleted_rule_ids,
+            replace=req.replace,
+            baseline_id=req.baseline_id,
+        )
         logger.info(
-            f"Detection complete: {len(result['changes'])} changes, "
-            f"{len(result['current_rules'])} current rules, "
-            f"{len(result['errors'])} errors"
+            f"Baseline commit for {req.kibana_url} space={req.space} baseline={req.baseline_id!r}: "
+            f"{counts['upserted']} upserted, {counts['deleted']} deleted"
         )
+        return {"success": True, **counts}
+    except Exception as e:
+        logger.error(f"Baseline commit failed: {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.post("/baseline/status")
+async def api_baseline_status(req: BaselineStatusRequest):
+    """Report whether the baseline store holds a baseline for a space."""
+    return await asyncio.to_thread(get_baseline_store().status, req.kibana_url, req.space, req.baseline_id)
 
-        return result
 
+@app.post("/classify-changes")
+async def api_classify_changes(req: ClassifyChangesRequest):
+    """
+    Classify changes reported with baseline_required by a hash-only detection.
+
+    The caller sends the previous content only for the rules that changed,
+    together with the current_state it received from /detect-changes.
+    """
+    try:
+        pairs = [
+            (c.rule_id, c.rule_name or c.rule_id, c.previous_state, c.current_state)
+            for c in req.changes
+        ]
+        return {"changes": await classify_change_pairs(pairs)}
     except Exception as e:
-        logger.error(f"Change detection failed: {e}", exc_info=True)
+        logger.error(f"Change classification failed: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.post("/rules/export")
+async def api_rules_export(req: RulesExportRequest, request: Request):
+    """
+    Return the rules of a space from the shared export cache.
+
+    Served from the most recent API export (including those made by
+    detections) while it is younger than max_age; otherwise one export is
+    made and shared by concurrent callers. The response carries an ETag of
+    the space-level version digest; a matching If-None-Match gets a 304.
+    Exception lists that failed to load are reported in "errors" (the rules
+    are still returned, but not cached); only a failed rule fetch is a 502.
+    """
+    try:
+        entry, from_cache = await cached_export(
+            req.kibana_url, req.api_key, req.space,
+            client=get_kibana_pool().get(req.kibana_url),
+            max_age=req.max_age,
+        )
+    except Exception as e:
+        logger.error(f"Rule export failed: {e}")
+        raise HTTPException(status_code=502, detail=str(e))
+
+    etag = f'"{entry["version"]}"'
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if_none_match = request.headers.get("if-none-match", "")
+    if etag in (tag.strip().removeprefix("W/") for tag in if_none_match.split(",")):
+        return Response(status_code=304, headers=headers)
+
+    rules = entry["rules"]
+    if req.summary:
+        rules = [
+            {
+                "rule_id": r.get("rule_id") or r.get("id"),
+                "id": r.get("id"),
+                "name": r.get("name", ""),
+                "description": r.get("description", ""),
+                "severity": r.get("severity") or "unknown",
+                "type": r.get("type") or "unknown",
+                "tags": r.get("tags") or [],
+                "enabled": bool(r.get("enabled")),
+            }
+            for r in rules
+        ]
+    return JSONResponse(
+        {
+            "rules": rules,
+            "total": len(rules),
+            "version": entry["version"],
+            "fetched_at": entry["fetched_at"],
+            "cached": from_cache,
+            "errors": entry.get("errors", []),
+        },
+        headers=headers,
+    )
+
+
 @app.post("/export-toml")
 async def api_export_toml(req: ExportTomlRequest):
     """
@@ -154,55 +553,71 @@ async def api_revert_rule(req: RevertRuleRequest):
     """
     logger.info(f"Reverting rule {req.rule_content.get('rule_id', '?')} in {req.kibana_url}")
 
-    base_url = req.kibana_url.rstrip("/")
-    if req.space and req.space != "default":
-        base_url = f"{base_url}/s/{req.space}"
+    rules_url = f"{kibana_base_url(req.kibana_url, req.space)}/api/detection_engine/rules"
+    headers = kibana_headers(req.api_key)
+    client = get_kibana_pool().get(req.kibana_url)
+    return await _put_rule(client, rules_url, headers, _writable_rule(req.rule_content))
 
-    rules_url = f"{base_url}/api/detection_engine/rules"
-    headers = {
-        "Authorization": f"ApiKey {req.api_key}",
-        "kbn-xsrf": "true",
-        "Content-Type": "application/json",
-    }
-
-    # Clean the rule content of read-only and internal fields before PUT
-    rule_data = dict(req.rule_content)
-    for field in ("id", "created_at", "updated_at", "created_by", "updated_by",
-                   "execution_summary", "revision",
-                   "_exception_items", "_enriched_exceptions"):
-        rule_data.pop(field, None)
-
-    try:
-        async with httpx.AsyncClient(timeout=30, verify=False) as client:
-            # Try PUT (update existing)
-            resp = await client.put(rules_url, headers=headers, json=rule_data)
 
-            if resp.status_code == 200:
-                return {
-                    "success": True,
-                    "message": f"Rule {rule_data.get('rule_id', '')} reverted successfully",
-                }
+@app.post("/revert-rules/bulk")
+async def api_revert_rules_bulk(req: RevertRulesBulkRequest):
+    """
+    Revert many rules to their approved states with as few Kibana calls as possible.
 
-            # If PUT fails with 404, the rule was deleted — recreate it
-            if resp.status_code == 404:
-                resp = await client.post(rules_url, headers=headers, json=rule_data)
-                if resp.status_code in (200, 201):
-                    return {
+    Rules are sent to _import?overwrite=true in chunks of
+    SYNC_REVERT_IMPORT_CHUNK. Rules the import rejects, and whole chunks
+    whose import request fails, fall back to the PUT-or-create of
+    /revert-rule, SYNC_REVERT_CONCURRENCY at a time. Returns one
+    {rule_id, success, message, method} result per rule, in request order.
+    """
+    logger.info(f"Bulk reverting {len(req.rules)} rules in {req.kibana_url} space={req.space}")
+    base_url = kibana_base_url(req.kibana_url, req.space)
+    headers = kibana_headers(req.api_key)
+    client = get_kibana_pool().get(req.kibana_url)
+    rules = [_writable_rule(rule) for rule in req.rules]
+    results: dict[int, dict] = {}
+
+    fallback = list(range(len(rules)))
+    if req.use_import:
+        fallback = [i for i, rule in enumerate(rules) if not rule.get("rule_id")]
+        importable = [i for i, rule in enumerate(rules) if rule.get("rule_id")]
+        for start in range(0, len(importable), REVERT_IMPORT_CHUNK):
+            chunk = importable[start:start + REVERT_IMPORT_CHUNK]
+            rejected = await _import_rules(client, base_url, req.api_key, [rules[i] for i in chunk])
+            if rejected is None:
+                fallback.extend(chunk)
+                continue
+            for i in chunk:
+                rule_id = rules[i]["rule_id"]
+                if rule_id in rejected:
+                    logger.info(f"Import rejected {rule_id} ({rejected[rule_id]}), retrying with PUT")
+                    fallback.append(i)
+                else:
+                    results[i] = {
+                        "rule_id": rule_id,
                         "success": True,
-                        "message": f"Rule {rule_data.get('rule_id', '')} recreated successfully",
+                        "message": f"Rule {rule_id} reverted successfully",
+                        "method": "import",
                     }
 
-            return {
-                "success": False,
-                "message": f"Revert failed with status {resp.status_code}: {resp.text[:500]}",
-            }
+    semaphore = asyncio.Semaphore(REVERT_CONCURRENCY)
+    rules_url = f"{base_url}/api/detection_engine/rules"
 
-    except Exception as e:
-        logger.error(f"Revert failed: {e}", exc_info=True)
-        return {
-            "success": False,
-            "message": f"Revert error: {str(e)}",
-        }
+    async def put_one(i: int) -> None:
+        async with semaphore:
+            outcome = await _put_rule(client, rules_url, headers, rules[i])
+        results[i] = {"rule_id": rules[i].get("rule_id", ""), **outcome}
+
+    await asyncio.gather(*(put_one(i) for i in fallback))
+
+    ordered = [results[i] for i in range(len(rules))]
+    succeeded = sum(1 for r in ordered if r["success"])
+    return {
+        "success": succeeded == len(ordered),
+        "succeeded": succeeded,
+        "failed": len(ordered) - succeeded,
+        "results": ordered,
+    }
 
 
 @app.post("/revert-exception-items")
@@ -214,16 +629,13 @@ async def api_revert_exception_items(req: RevertExceptionItemsRequest):
     - Items in previous but not current → recreate
     - Items in current but not previous → delete
     - Items that differ → update
-    """
-    base_url = req.kibana_url.rstrip("/")
-    if req.space and req.space != "default":
-        base_url = f"{base_url}/s/{req.space}"
 
-    headers = {
-        "Authorization": f"ApiKey {req.api_key}",
-        "kbn-xsrf": "true",
-        "Content-Type": "application/json",
-    }
+    Operations run concurrently, SYNC_REVERT_CONCURRENCY at a time. Lists of
+    recreated items that no longer exist are created first, from
+    previous_lists when given. Results and errors keep the serial order.
+    """
+    base_url = kibana_base_url(req.kibana_url, req.space)
+    headers = kibana_headers(req.api_key)
 
     prev_by_id = {it.get("item_id"): it for it in req.previous_items if it.get("item_id")}
     curr_by_id = {it.get("item_id"): it for it in req.current_items if it.get("item_id")}
@@ -232,62 +644,83 @@ async def api_revert_exception_items(req: RevertExceptionItemsRequest):
     errors = []
 
     try:
-        async with httpx.AsyncClient(timeout=30, verify=False) as client:
-            # Items that were removed (in previous, not in current) → recreate
-            for item_id, item in prev_by_id.items():
-                if item_id not in curr_by_id:
-                    try:
-                        create_data = {k: v for k, v in item.items()
-                                       if k not in ("id", "created_at", "updated_at",
-                                                     "created_by", "updated_by",
-                                                     "_version", "tie_breaker_id")}
-                        resp = await client.post(
-                            f"{base_url}/api/exception_lists/items",
-                            headers=headers, json=create_data,
-                        )
-                        if resp.status_code in (200, 201):
-                            results.append(f"Recreated: {item.get('name', item_id)}")
-                        else:
-                            errors.append(f"Failed to recreate {item.get('name', item_id)}: {resp.status_code}")
-                    except Exception as e:
-                        errors.append(f"Error recreating {item.get('name', item_id)}: {str(e)}")
-
-            # Items that were added (in current, not in previous) → delete
-            for item_id, item in curr_by_id.items():
-                if item_id not in prev_by_id:
-                    try:
-                        namespace = item.get("namespace_type", "single")
-                        resp = await client.delete(
-                            f"{base_url}/api/exception_lists/items",
-                            params={"item_id": item_id, "namespace_type": namespace},
-                            headers=headers,
-                        )
-                        if resp.status_code == 200:
-                            results.append(f"Deleted: {item.get('name', item_id)}")
-                        else:
-                            errors.append(f"Failed to delete {item.get('name', item_id)}: {resp.status_code}")
-                    except Exception as e:
-                        errors.append(f"Error deleting {item.get('name', item_id)}: {str(e)}")
-
-            # Items that were modified → update
-            for item_id, curr_item in curr_by_id.items():
-                prev_item = prev_by_id.get(item_id)
-                if prev_item and json.dumps(prev_item, sort_keys=True) != json.dumps(curr_item, sort_keys=True):
-                    try:
-                        update_data = {k: v for k, v in prev_item.items()
-                                       if k not in ("id", "created_at", "updated_at",
-                                                     "created_by", "updated_by",
-                                                     "_version", "tie_breaker_id")}
-                        resp = await client.put(
-                            f"{base_url}/api/exception_lists/items",
-                            headers=headers, json=update_data,
-                        )
-                        if resp.status_code == 200:
-                            results.append(f"Reverted: {prev_item.get('name', item_id)}")
-                        else:
-                            errors.append(f"Failed to revert {prev_item.get('name', item_id)}: {resp.status_code}")
-                    except Exception as e:
-                        errors.append(f"Error reverting {prev_item.get('name', item_id)}: {str(e)}")
+        client = get_kibana_pool().get(req.kibana_url)
+        items_url = f"{base_url}/api/exception_lists/items"
+        semaphore = asyncio.Semaphore(REVERT_CONCURRENCY)
+
+        async def recreate(item_id: str, item: dict) -> tuple[str | None, str | None]:
+            name = item.get("name", item_id)
+            try:
+                resp = await client.post(
+                    items_url, headers=headers, json=_writable_exception_item(item), timeout=30,
+                )
+                if resp.status_code in (200, 201):
+                    return f"Recreated: {name}", None
+                return None, f"Failed to recreate {name}: {resp.status_code}"
+            except Exception as e:
+                return None, f"Error recreating {name}: {str(e)}"
+
+        async def delete(item_id: str, item: dict) -> tuple[str | None, str | None]:
+            name = item.get("name", item_id)
+            try:
+                namespace = item.get("namespace_type", "single")
+                resp = await client.delete(
+                    items_url,
+                    params={"item_id": item_id, "namespace_type": namespace},
+                    headers=headers,
+                    timeout=30,
+                )
+                if resp.status_code == 200:
+                    return f"Deleted: {name}", None
+                return None, f"Failed to delete {name}: {resp.status_code}"
+            except Exception as e:
+                return None, f"Error deleting {name}: {str(e)}"
+
+        async def update(item_id: str, item: dict) -> tuple[str | None, str | None]:
+            name = item.get("name", item_id)
+            try:
+                resp = await client.put(
+                    items_url, headers=headers, json=_writable_exception_item(item), timeout=30,
+                )
+                if resp.status_code == 200:
+                    return f"Reverted: {name}", None
+                return None, f"Failed to revert {name}: {resp.status_code}"
+            except Exception as e:
+                return None, f"Error reverting {name}: {str(e)}"
+
+        # Same order as the former serial loops: recreate, delete, update
+        operations = [
+            (recreate, item_id, item) for item_id, item in prev_by_id.items()
+            if item_id not in curr_by_id
+        ] + [
+            (delete, item_id, item) for item_id, item in curr_by_id.items()
+            if item_id not in prev_by_id
+        ] + [
+            (update, item_id, prev_by_id[item_id]) for item_id, curr_item in curr_by_id.items()
+            if item_id in prev_by_id
+            and canonical.canonical(prev_by_id[item_id]) != canonical.canonical(curr_item)
+        ]
+
+        # Items can only be recreated inside an existing list
+        missing_lists = await _ensure_exception_lists(
+            client, base_url, headers,
+            [item for op, _, item in operations if op is recreate],
+            req.previous_lists, semaphore,
+        )
+        for list_id, error in missing_lists.items():
+            errors.append(f"Failed to create exception list {list_id}: {error}")
+
+        async def run(op, item_id: str, item: dict) -> tuple[str | None, str | None]:
+            if op is recreate and item.get("list_id") in missing_lists:
+                return None, f"Failed to recreate {item.get('name', item_id)}: list {item.get('list_id')} missing"
+            async with semaphore:
+                return await op(item_id, item)
+
+        for message, error in await asyncio.gather(*(run(*operation) for operation in operations)):
+            if message:
+                results.append(message)
+            if error:
+                errors.append(error)
 
     except Exception as e:
         errors.append(f"Connection error: {str(e)}")
@@ -330,12 +763,7 @@ async def api_parse_rule_content(req: ParseRuleContentRequest):
         if fmt == "json":
             parsed = json.loads(req.content)
         elif fmt == "toml":
-            try:
-                import tomllib  # py3.11+
-                parsed = tomllib.loads(req.content)
-            except Exception:
-                import toml
-                parsed = toml.loads(req.content)
+            parsed = toml_engine.loads(req.content)
         else:
             raise HTTPException(status_code=400, detail=f"Unsupported format: {fmt}")
     except HTTPException:
@@ -354,19 +782,365 @@ async def api_parse_rule_content(req: ParseRuleContentRequest):
 # Helpers
 # ---------------------------------------------------------------------------
 
-def _check_cli_available() -> bool:
-    """Check if the detection-rules CLI is installed."""
-    import subprocess
+_baseline_store: BaselineStore | None = None
+
+
+def get_kibana_pool() -> KibanaClientPool:
+    """Return the shared Kibana client pool (created lazily outside the lifespan)."""
+    global _kibana_pool
+    if _kibana_pool is None:
+        _kibana_pool = KibanaClientPool.from_env()
+    return _kibana_pool
+
+
+def get_job_queue() -> JobQueue:
+    """Return the process-wide background job queue."""
+    global _job_queue
+    if _job_queue is None:
+        _job_queue = JobQueue.from_env()
+    return _job_queue
+
+
+def get_baseline_store() -> BaselineStore:
+    """Return the process-wide baseline store, opening it on first use."""
+    global _baseline_store
+    if _baseline_store is None:
+        path = os.environ.get("SYNC_BASELINE_DB") or os.path.join(default_data_dir(), "baseline.db")
+        _baseline_store = BaselineStore(path)
+    return _baseline_store
+
+
+def get_shared_cache() -> SharedCache:
+    """Return this worker's connection to the cross-worker cache file."""
+    global _shared_cache
+    if _shared_cache is None:
+        _shared_cache = SharedCache.from_env(default_data_dir())
+    return _shared_cache
+
+
+async def _resolve_baseline(req: DetectChangesRequest):
+    """
+    Return (baseline_hashes, load_baseline) for a detection request.
+
+    Raises a 409 when use_baseline_store is set but the space has never been
+    committed to the baseline store.
+    """
+    baseline_hashes = req.baseline_hashes
+    load_baseline = None
+    if req.use_baseline_store:
+        store = get_baseline_store()
+        baseline_hashes = await asyncio.to_thread(store.hashes, req.kibana_url, req.space, req.baseline_id)
+        if baseline_hashes is None:
+            raise HTTPException(
+                status_code=409,
+                detail="No baseline committed for this space; send baseline_snapshots or call /baseline/commit",
+            )
+        logger.info(f"Baseline store has {len(baseline_hashes)} rules")
+
+        def load_baseline(rule_ids):
+            return store.load(req.kibana_url, req.space, rule_ids, req.baseline_id)
+    elif baseline_hashes is not None:
+        logger.info(f"Baseline has {len(req.baseline_hashes)} hashes (hash-only mode)")
+    else:
+        logger.info(f"Baseline has {len(req.baseline_snapshots)} snapshots")
+    return baseline_hashes, load_baseline
+
+
+async def _run_detection(
+    req: DetectChangesRequest,
+    baseline_hashes: dict[str, str] | None,
+    load_baseline: Callable[[list[str]], list[dict]] | None,
+    progress: Callable[[str, int], None] | None = None,
+) -> dict:
+    """
+    Run detect_changes for a request whose baseline _resolve_baseline resolved.
+
+    Concurrent runs for the same space, credentials, options and baseline
+    are coalesced into one (see _detection_key); callers that join a run
+    already in flight get its result but no progress reports.
+    """
+    key = _detection_key(req, baseline_hashes)
+    return await _detections.run(
+        key, lambda: _execute_detection(req, baseline_hashes, load_baseline, progress),
+    )
+
+
+def _detection_key(req: DetectChangesRequest, baseline_hashes: dict[str, str] | None) -> tuple:
+    """
+    Single-flight key of a detection request.
+
+    Snapshots are identified by their (rule_id, rule_hash) pairs, so the
+    baseline digest is cheap to compute even for large spaces. The API key
+    is part of the key since results depend on what it is allowed to see.
+    """
+    digest = hashlib.sha256()
+    digest.update(json.dumps(baseline_hashes, sort_keys=True).encode())
+    digest.update(json.dumps(sorted((s.rule_id, s.rule_hash) for s in req.baseline_snapshots)).encode())
+    return (
+        req.kibana_url.rstrip("/"),
+        req.space or "default",
+        hashlib.sha256(req.api_key.encode()).hexdigest(),
+        req.incremental,
+        req.include_current_toml,
+        req.compact,
+        req.baseline_id if req.use_baseline_store else "",
+        digest.hexdigest(),
+    )
+
+
+async def _execute_detection(
+    req: DetectChangesRequest,
+    baseline_hashes: dict[str, str] | None,
+    load_baseline: Callable[[list[str]], list[dict]] | None,
+    progress: Callable[[str, int], None] | None,
+) -> dict:
+    started = time.monotonic()
+    try:
+        result = await detect_changes(
+            kibana_url=req.kibana_url,
+            api_key=req.api_key,
+            space=req.space,
+            baseline_snapshots=[s.model_dump() for s in req.baseline_snapshots],
+            use_cli=True,
+            baseline_hashes=baseline_hashes,
+            load_baseline=load_baseline,
+            client=get_kibana_pool().get(req.kibana_url),
+            incremental=req.incremental,
+            include_current_toml=req.include_current_toml,
+            compact=req.compact,
+            progress=progress,
+        )
+        _record_detection_latency(time.monotonic() - started)
+
+        logger.info(
+            f"Detection complete: {len(result['changes'])} changes, "
+            f"{len(result['current_rules'])} current rules, "
+            f"{len(result['errors'])} errors"
+        )
+
+        return result
+
+    except Exception as e:
+        logger.error(f"Change detection failed: {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+async def _iter_batch_outcomes(req: BatchDetectChangesRequest) -> AsyncIterator[dict]:
+    """Run the jobs of a batch concurrently and yield each outcome as it finishes."""
+    batch_slots = asyncio.Semaphore(BATCH_CONCURRENCY)
+    host_slots: dict[tuple, asyncio.Semaphore] = {}
+
+    async def run(index: int, job: BatchDetectionJob) -> dict:
+        host = kibana_host_key(job.kibana_url)
+        if host not in host_slots:
+            host_slots[host] = asyncio.Semaphore(BATCH_HOST_CONCURRENCY)
+        outcome = {"index": index, "job_id": job.job_id, "kibana_url": job.kibana_url, "space": job.space}
+        # Wait for the host before taking a batch slot, so jobs queued behind
+        # a busy host do not hold up jobs for other hosts
+        async with host_slots[host], batch_slots:
+            try:
+                result = await asyncio.wait_for(api_detect_changes(job), req.job_timeout)
+                outcome.update(status="ok", result=result)
+            except HTTPException as e:
+                outcome.update(status="error", status_code=e.status_code, error=e.detail)
+            except asyncio.TimeoutError:
+                outcome.update(
+                    status="error", status_code=504,
+                    error=f"Detection timed out after {req.job_timeout} seconds",
+                )
+            except Exception as e:
+                logger.error(f"Batch job {index} failed: {e}", exc_info=True)
+                outcome.update(status="error", status_code=500, error=str(e))
+        return outcome
+
+    tasks = [asyncio.create_task(run(i, job)) for i, job in enumerate(req.jobs)]
     try:
-        result = subprocess.run(
-            ["python3", "-m", "detection_rules", "--help"],
-            capture_output=True,
-            text=True,
-            timeout=10,
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def _import_rules(
+    client: httpx.AsyncClient,
+    base_url: str,
+    api_key: str,
+    rules: list[dict],
+) -> dict[str, str] | None:
+    """
+    Import rules with overwrite=true in one request. Returns {rule_id: error}
+    for the rules Kibana rejected, or None if the import request itself failed
+    or its success_count does not account for every other rule (lines Kibana
+    could not parse are reported as "(unknown id)", not by rule_id).
+    """
+    ndjson = "".join(json.dumps(rule) + "\n" for rule in rules)
+    # Multipart upload: let httpx set the Content-Type boundary
+    headers = {k: v for k, v in kibana_headers(api_key).items() if k != "Content-Type"}
+    try:
+        resp = await client.post(
+            f"{base_url}/api/detection_engine/rules/_import",
+            params={"overwrite": "true"},
+            headers=headers,
+            files={"file": ("rules.ndjson", ndjson.encode("utf-8"), "application/ndjson")},
+            timeout=120,
         )
-        return result.returncode == 0
-    except Exception:
-        return False
+        body = resp.json() if resp.status_code == 200 else None
+    except Exception as e:
+        # Includes a 200 whose body is not JSON (e.g. a proxy's error page)
+        logger.warning(f"Rule import failed, falling back to PUT: {e}")
+        return None
+    if not isinstance(body, dict):
+        logger.warning(f"Rule import returned {resp.status_code}, falling back to PUT: {resp.text[:200]}")
+        return None
+    rule_ids = {rule.get("rule_id") for rule in rules}
+    rejected = {
+        err.get("rule_id", ""): (err.get("error") or {}).get("message", "import failed")
+        for err in body.get("errors", [])
+        if err.get("rule_id", "") in rule_ids
+    }
+    expected = len(rules) - len(rejected)
+    if body.get("success_count", expected) != expected:
+        logger.warning(
+            f"Rule import succeeded for {body.get('success_count')} of {expected} rules "
+            f"not named in its errors, falling back to PUT"
+        )
+        return None
+    return rejected
+
+
+async def _put_rule(client: httpx.AsyncClient, rules_url: str, headers: dict, rule_data: dict) -> dict:
+    """PUT a rule back, recreating it when it was deleted. Returns {success, message, method}."""
+    try:
+        # Try PUT (update existing)
+        resp = await client.put(rules_url, headers=headers, json=rule_data, timeout=30)
+
+        if resp.status_code == 200:
+            return {
+                "success": True,
+                "message": f"Rule {rule_data.get('rule_id', '')} reverted successfully",
+                "method": "put",
+            }
+
+        # If PUT fails with 404, the rule was deleted — recreate it
+        if resp.status_code == 404:
+            resp = await client.post(rules_url, headers=headers, json=rule_data, timeout=30)
+            if resp.status_code in (200, 201):
+                return {
+                    "success": True,
+                    "message": f"Rule {rule_data.get('rule_id', '')} recreated successfully",
+                    "method": "create",
+                }
+
+        return {
+            "success": False,
+            "message": f"Revert failed with status {resp.status_code}: {resp.text[:500]}",
+            "method": "put",
+        }
+
+    except Exception as e:
+        logger.error(f"Revert failed: {e}", exc_info=True)
+        return {
+            "success": False,
+            "message": f"Revert error: {str(e)}",
+            "method": "put",
+        }
+
+
+def _writable_rule(rule_content: dict) -> dict:
+    """Copy of a rule without the read-only and internal fields Kibana rejects on write."""
+    rule_data = dict(rule_content)
+    for field in ("id", "created_at", "updated_at", "created_by", "updated_by",
+                   "execution_summary", "revision",
+                   "_exception_items", "_enriched_exceptions"):
+        rule_data.pop(field, None)
+    return rule_data
+
+
+def _writable_exception_item(item: dict) -> dict:
+    """Copy of an exception item without the read-only fields Kibana rejects on write."""
+    return {k: v for k, v in item.items()
+            if k not in ("id", "created_at", "updated_at",
+                         "created_by", "updated_by",
+                         "_version", "tie_breaker_id")}
+
+
+async def _ensure_exception_lists(
+    client: httpx.AsyncClient,
+    base_url: str,
+    headers: dict,
+    items: list[dict],
+    known_lists: list[dict],
+    semaphore: asyncio.Semaphore,
+) -> dict[str, str]:
+    """
+    Create the exception lists the items belong to that no longer exist,
+    using the matching known_lists entry (or a minimal detection list).
+    Returns {list_id: error} for lists that could not be created.
+    """
+    lists_url = f"{base_url}/api/exception_lists"
+    known_by_id = {el.get("list_id"): el for el in known_lists if el.get("list_id")}
+    wanted = {
+        item["list_id"]: item.get("namespace_type", "single")
+        for item in items if item.get("list_id")
+    }
+
+    async def ensure(list_id: str, namespace: str) -> str | None:
+        async with semaphore:
+            try:
+                resp = await client.get(
+                    lists_url, params={"list_id": list_id, "namespace_type": namespace},
+                    headers=headers, timeout=30,
+                )
+                if resp.status_code != 404:
+                    return None
+                known = known_by_id.get(list_id, {})
+                list_data = {
+                    "list_id": list_id,
+                    "name": known.get("name", list_id),
+                    "description": known.get("description", list_id),
+                    "type": known.get("type", "detection"),
+                    "namespace_type": known.get("namespace_type", namespace),
+                }
+                for field in ("tags", "os_types", "meta"):
+                    if field in known:
+                        list_data[field] = known[field]
+                resp = await client.post(lists_url, headers=headers, json=list_data, timeout=30)
+                if resp.status_code in (200, 201, 409):
+                    return None
+                return str(resp.status_code)
+            except Exception as e:
+                return str(e)
+
+    outcomes = await asyncio.gather(*(ensure(list_id, ns) for list_id, ns in wanted.items()))
+    return {list_id: error for list_id, error in zip(wanted, outcomes) if error is not None}
+
+
+def _check_cli_available() -> bool:
+    """Check if the detection-rules CLI is installed (via the warm worker pool)."""
+    return get_cli_exporter().probe()
+
+
+async def _refresh_cli_probe() -> None:
+    """Run one CLI availability probe off the event loop and cache the result."""
+    try:
+        available = await asyncio.to_thread(_check_cli_available)
+    except Exception as e:
+        logger.warning(f"CLI probe failed: {e}")
+        available = False
+    _health_state["cli_available"] = available
+    _health_state["cli_probed_at"] = time.time()
+
+
+async def _cli_probe_loop() -> None:
+    while True:
+        await _refresh_cli_probe()
+        await asyncio.sleep(CLI_PROBE_TTL)
+
+
+def _record_detection_latency(seconds: float) -> None:
+    _health_state["last_detection_latency_ms"] = round(seconds * 1000)
+    _health_state["last_detection_at"] = time.time()
 
 
 # ---------------------------------------------------------------------------
@@ -375,5 +1149,9 @@ def _check_cli_available() -> bool:
 
 if __name__ == "__main__":
     port = int(os.environ.get("SYNC_SERVICE_PORT", "8091"))
-    logger.info(f"Starting sync service on port {port}")
-    uvicorn.run(app, host="0.0.0.0", port=port, log_level="info")
+    logger.info(f"Starting sync service on port {port} with {SERVICE_WORKERS} worker(s)")
+    if SERVICE_WORKERS > 1:
+        # uvicorn needs an import string to start the app in each worker
+        uvicorn.run("main:app", host="0.0.0.0", port=port, log_level="info", workers=SERVICE_WORKERS)
+    else:
+        uvicorn.run(app, host="0.0.0.0", port=port, log_level="info")
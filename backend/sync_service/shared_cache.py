@@ -0,0 +1,177 @@
+"""
+SQLite-backed cache shared by the sync service's worker processes.
+
+With SYNC_SERVICE_WORKERS > 1 every uvicorn worker keeps its in-memory
+caches but backs them with this file, so a rule hash, a space export or a
+background job produced by one worker is visible to the others instead of
+being rebuilt (or reported missing) per process. WAL mode lets readers
+proceed while another worker writes.
+
+    SYNC_SHARED_CACHE_DB          SQLite file (default <data dir>/shared_cache.db)
+    SYNC_SHARED_HASH_CACHE_SIZE   rule hashes kept in the file (default 100000)
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import canonical
+
+
+class SharedCache:
+    """Rule hashes, space exports and job records in one SQLite file."""
+
+    def __init__(self, path: str, hash_maxsize: int = 100000):
+        self.path = path
+        self.hash_maxsize = hash_maxsize
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._hash_puts = 0
+        # Writers from other workers hold the lock briefly; wait for them
+        self._conn = sqlite3.connect(path, timeout=10, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(exports)")]
+        if columns and "item_digests" not in columns:
+            # Exports cached before item digests were kept; they are
+            # refetched on the next miss anyway
+            self._conn.execute("DROP TABLE exports")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS rule_hashes (
+                fingerprint TEXT PRIMARY KEY,
+                rule_hash TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS exports (
+                cache_key TEXT PRIMARY KEY,
+                version TEXT NOT NULL,
+                fetched_at REAL NOT NULL,
+                rules TEXT NOT NULL,
+                item_digests TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS jobs (
+                job_id TEXT PRIMARY KEY,
+                state TEXT NOT NULL,
+                result TEXT,
+                updated_at REAL NOT NULL
+            );
+            """
+        )
+        self._conn.commit()
+
+    @classmethod
+    def from_env(cls, data_dir: str) -> "SharedCache":
+        return cls(
+            os.environ.get("SYNC_SHARED_CACHE_DB") or os.path.join(data_dir, "shared_cache.db"),
+            hash_maxsize=int(os.environ.get("SYNC_SHARED_HASH_CACHE_SIZE", "100000")),
+        )
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+    # -- rule hashes --------------------------------------------------------
+
+    def get_hashes(self, fingerprints: list[str]) -> dict[str, str]:
+        """Return {fingerprint: rule_hash} for the fingerprints that are stored."""
+        found = {}
+        with self._lock:
+            # Stay well below SQLite's bound-parameter limit
+            for start in range(0, len(fingerprints), 500):
+                chunk = fingerprints[start:start + 500]
+                placeholders = ",".join("?" * len(chunk))
+                found.update(self._conn.execute(
+                    f"SELECT fingerprint, rule_hash FROM rule_hashes WHERE fingerprint IN ({placeholders})",
+                    chunk,
+                ).fetchall())
+        return found
+
+    def put_hashes(self, items: list[tuple[str, str]]) -> None:
+        if not items:
+            return
+        with self._lock:
+            with self._conn:
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO rule_hashes (fingerprint, rule_hash) VALUES (?, ?)", items,
+                )
+                self._hash_puts += len(items)
+                if self._hash_puts >= self.hash_maxsize // 10:
+                    # Oldest rows first: the rowid grows with every insert
+                    self._hash_puts = 0
+                    self._conn.execute(
+                        "DELETE FROM rule_hashes WHERE rowid <= "
+                        "(SELECT MAX(rowid) FROM rule_hashes) - ?",
+                        (self.hash_maxsize,),
+                    )
+
+    # -- exports ------------------------------------------------------------
+
+    def get_export(self, cache_key: str, max_age: float) -> dict | None:
+        """
+        Return the stored {rules, version, fetched_at} entry for a space if it
+        is younger than max_age. The rules are only read and decoded then.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT version, fetched_at FROM exports WHERE cache_key = ?", (cache_key,),
+            ).fetchone()
+            if row is None or time.time() - row[1] > max_age:
+                return None
+            # Another worker may have replaced the row since; that is fresher
+            row = self._conn.execute(
+                "SELECT version, fetched_at, rules, item_digests FROM exports WHERE cache_key = ?",
+                (cache_key,),
+            ).fetchone()
+        if row is None:
+            return None
+        rules = json.loads(row[2])
+        # Give the exception items back their digests (canonical.ItemList),
+        # so rule fingerprints need not re-serialize them
+        for rule, digest in zip(rules, json.loads(row[3])):
+            if digest is not None:
+                rule["_exception_items"] = canonical.ItemList(rule["_exception_items"], digest)
+        return {"rules": rules, "version": row[0], "fetched_at": row[1]}
+
+    def put_export(self, cache_key: str, entry: dict) -> None:
+        rules = json.dumps(entry["rules"])
+        digests = json.dumps([
+            getattr(rule.get("_exception_items"), "digest", None) for rule in entry["rules"]
+        ])
+        with self._lock:
+            with self._conn:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO exports (cache_key, version, fetched_at, rules, item_digests) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (cache_key, entry["version"], entry["fetched_at"], rules, digests),
+                )
+
+    # -- jobs ---------------------------------------------------------------
+
+    def get_job_state(self, job_id: str) -> dict | None:
+        """Return the published state of a job, or None; the result is not read."""
+        with self._lock:
+            row = self._conn.execute("SELECT state FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def get_job_result(self, job_id: str) -> object:
+        """Return the published result of a job (None until it has finished)."""
+        with self._lock:
+            row = self._conn.execute("SELECT result FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return json.loads(row[0]) if row is not None and row[0] is not None else None
+
+    def put_job(self, job_id: str, state: dict, result: object = None) -> None:
+        encoded = json.dumps(result) if result is not None else None
+        with self._lock:
+            with self._conn:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO jobs (job_id, state, result, updated_at) VALUES (?, ?, ?, ?)",
+                    (job_id, json.dumps(state), encoded, time.time()),
+                )
+
+    def prune_jobs(self, older_than: float) -> None:
+        with self._lock:
+            with self._conn:
+                self._conn.execute("DELETE FROM jobs WHERE updated_at < ?", (older_than,))
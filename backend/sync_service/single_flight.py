@@ -0,0 +1,64 @@
+"""
+Single-flight coalescing of identical concurrent calls.
+
+Callers passing the same key while a call is in flight wait for that call
+and receive its result (or exception) instead of starting their own. With a
+result TTL, a finished call's result is also reused for that many seconds.
+The shared call keeps running if the caller that started it goes away, so
+the remaining waiters are not cancelled with it.
+"""
+
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Hashable
+
+
+class SingleFlight:
+    """Run at most one call per key at a time, sharing its outcome."""
+
+    def __init__(self, result_ttl: float = 0):
+        self.result_ttl = result_ttl
+        self._inflight: dict[Hashable, asyncio.Task] = {}
+        self._results: dict[Hashable, tuple[float, Any]] = {}
+        self._executions = 0
+        self._coalesced = 0
+        self._cache_hits = 0
+
+    async def run(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """Return fn()'s result, sharing a running or recently finished call for key."""
+        now = time.monotonic()
+        self._prune(now)
+        cached = self._results.get(key)
+        if cached is not None:
+            self._cache_hits += 1
+            return cached[1]
+
+        task = self._inflight.get(key)
+        if task is None:
+            self._executions += 1
+            task = asyncio.ensure_future(fn())
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._finish(key, t))
+        else:
+            self._coalesced += 1
+        return await asyncio.shield(task)
+
+    def _finish(self, key: Hashable, task: asyncio.Task) -> None:
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if self.result_ttl > 0 and not task.cancelled() and task.exception() is None:
+            self._results[key] = (time.monotonic() + self.result_ttl, task.result())
+
+    def _prune(self, now: float) -> None:
+        expired = [key for key, (expires, _) in self._results.items() if expires <= now]
+        for key in expired:
+            del self._results[key]
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": len(self._inflight),
+            "executions": self._executions,
+            "coalesced": self._coalesced,
+            "cache_hits": self._cache_hits,
+            "cached_results": len(self._results),
+        }
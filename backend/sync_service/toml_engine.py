@@ -0,0 +1,196 @@
+"""
+TOML serialization layer for rule files.
+
+Reads use the stdlib ``tomllib`` parser (C-accelerated where available),
+falling back to the ``toml`` package for inputs tomllib rejects. Writes go
+through a pluggable engine selected by SYNC_TOML_ENGINE:
+
+    fast  (default) FastTomlEmitter, a port of toml.dumps specialised for
+          JSON-shaped rule data with cached string/key encoding
+    toml  the reference ``toml.dumps`` implementation
+
+Both engines produce byte-identical output, so hashes and TOML files written
+to Git do not change when switching between them.
+"""
+
+import functools
+import os
+import re
+
+try:
+    import tomllib  # py3.11+
+except ImportError:  # pragma: no cover
+    tomllib = None
+
+_BARE_KEY = re.compile(r"^[A-Za-z0-9_-]+$")
+
+
+def loads(content: str) -> dict:
+    """Parse a TOML document."""
+    if tomllib is not None:
+        try:
+            return tomllib.loads(content)
+        except Exception:
+            pass
+    import toml
+    return toml.loads(content)
+
+
+def load_file(path: str) -> dict:
+    """Parse a TOML file."""
+    with open(path, "r", encoding="utf-8") as f:
+        return loads(f.read())
+
+
+@functools.lru_cache(maxsize=65536)
+def _dump_str(v: str) -> str:
+    """Quote a string exactly like toml.encoder._dump_str."""
+    v = "%r" % v
+    singlequote = v.startswith("'")
+    if singlequote or v.startswith('"'):
+        v = v[1:-1]
+    if singlequote:
+        v = v.replace("\\'", "'")
+        v = v.replace('"', '\\"')
+    if "\\x" not in v:
+        return '"' + v + '"'
+    # Rewrite repr's \xNN escapes as TOML \u00NN, keeping escaped backslashes
+    parts = v.split("\\x")
+    while len(parts) > 1:
+        i = -1
+        if not parts[0]:
+            parts = parts[1:]
+        parts[0] = parts[0].replace("\\\\", "\\")
+        joinx = parts[0][i] != "\\"
+        while parts[0][:i] and parts[0][i] == "\\":
+            joinx = not joinx
+            i -= 1
+        joiner = "x" if joinx else "u00"
+        parts = [parts[0] + joiner + parts[1]] + parts[2:]
+    return '"' + parts[0] + '"'
+
+
+@functools.lru_cache(maxsize=8192)
+def _dump_key(key: str) -> str:
+    return key if _BARE_KEY.match(key) else _dump_str(key)
+
+
+def _dump_float(v: float) -> str:
+    return "{}".format(v).replace("e+0", "e+").replace("e-0", "e-")
+
+
+class FastTomlEmitter:
+    """
+    Drop-in replacement for toml.dumps on rule dictionaries.
+
+    Mirrors the section/array-of-tables layout of toml.TomlEncoder, including
+    its quirks (e.g. None inside arrays becomes "None"); values of types
+    outside plain JSON are delegated to the reference encoder.
+    """
+
+    def __init__(self):
+        self._reference = None
+
+    def _dump_value(self, v) -> str:
+        t = type(v)
+        if t is str:
+            return _dump_str(v)
+        if t is bool:
+            return "true" if v else "false"
+        if t is int:
+            return str(v)
+        if t is float:
+            return _dump_float(v)
+        if t is list or t is dict:
+            # toml iterates anything without a dump function, so a dict
+            # nested in an array is written as the list of its keys
+            if not v:
+                return "[]"
+            return "[" + "".join([" " + self._dump_value(u) + "," for u in v]) + "]"
+        if self._reference is None:
+            import toml
+            self._reference = toml.TomlEncoder()
+        return str(self._reference.dump_value(v))
+
+    def _dump_sections(self, o: dict, sup: str) -> tuple[str, dict]:
+        if sup != "" and sup[-1] != ".":
+            sup += "."
+        retstr = []
+        retdict = {}
+        arraystr = []
+        for section in o:
+            section = str(section)
+            qsection = _dump_key(section)
+            value = o[section]
+            if isinstance(value, dict):
+                retdict[qsection] = value
+            elif isinstance(value, list) and any(isinstance(a, dict) for a in value):
+                for a in value:
+                    arraytabstr = "\n"
+                    arraystr.append("[[" + sup + qsection + "]]\n")
+                    s, d = self._dump_sections(a, sup + qsection)
+                    if s:
+                        if s[0] == "[":
+                            arraytabstr += s
+                        else:
+                            arraystr.append(s)
+                    while d:
+                        newd = {}
+                        for dsec in d:
+                            s1, d1 = self._dump_sections(d[dsec], sup + qsection + "." + dsec)
+                            if s1:
+                                arraytabstr += "[" + sup + qsection + "." + dsec + "]\n" + s1
+                            for s1 in d1:
+                                newd[dsec + "." + s1] = d1[s1]
+                        d = newd
+                    arraystr.append(arraytabstr)
+            elif value is not None:
+                retstr.append(qsection + " = " + self._dump_value(value) + "\n")
+        return "".join(retstr) + "".join(arraystr), retdict
+
+    def dumps(self, o: dict) -> str:
+        retval, sections = self._dump_sections(o, "")
+        outer_objs = {id(o)}
+        while sections:
+            section_ids = {id(section) for section in sections.values()}
+            if outer_objs & section_ids:
+                raise ValueError("Circular reference detected")
+            outer_objs |= section_ids
+            newsections = {}
+            for section in sections:
+                addtoretval, addtosections = self._dump_sections(sections[section], section)
+                if addtoretval or not addtosections:
+                    if retval and retval[-2:] != "\n\n":
+                        retval += "\n"
+                    retval += "[" + section + "]\n"
+                    if addtoretval:
+                        retval += addtoretval
+                for s in addtosections:
+                    newsections[section + "." + s] = addtosections[s]
+            sections = newsections
+        return retval
+
+
+def _toml_dumps(o: dict) -> str:
+    import toml
+    return toml.dumps(o)
+
+
+WRITERS = {
+    "fast": FastTomlEmitter().dumps,
+    "toml": _toml_dumps,
+}
+
+
+def get_writer(name: str | None = None):
+    """Return the dumps function of the configured (or named) engine."""
+    name = name or os.environ.get("SYNC_TOML_ENGINE", "fast")
+    try:
+        return WRITERS[name]
+    except KeyError:
+        raise ValueError(f"Unknown TOML engine: {name}") from None
+
+
+def dumps(o: dict) -> str:
+    """Serialize a dict to TOML with the configured engine."""
+    return get_writer()(o)
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+Benchmark the sync service TOML engines on a synthetic rule corpus.
+
+Renders every rule with rule_to_toml-shaped dicts through each engine in
+toml_engine.WRITERS, checks the outputs are byte-identical and prints the
+throughput. Run from the repository root:
+
+    python scripts/bench_toml_engine.py [--rules 2000] [--rounds 3]
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend", "sync_service"))
+
+import toml_engine  # noqa: E402
+
+TACTICS = [("TA0002", "Execution"), ("TA0003", "Persistence"), ("TA0005", "Defense Evasion")]
+
+
+def make_rule(i: int, rnd: random.Random) -> dict:
+    tactic_id, tactic_name = rnd.choice(TACTICS)
+    return {
+        "metadata": {
+            "creation_date": "2024/01/01",
+            "updated_date": "2025/03/14",
+            "maturity": "production",
+        },
+        "rule": {
+            "rule_id": f"{i:08x}-5c3e-4a8a-9d7e-{rnd.getrandbits(48):012x}",
+            "name": f"Suspicious \"process\" {i} via C:\\Windows\\System32",
+            "description": "Identifies suspicious activity.\nReview the process tree.",
+            "type": "eql",
+            "language": "eql",
+            "query": (
+                'process where host.os.type == "windows" and event.type == "start" and\n'
+                f'  process.name : ("powershell.exe", "cmd.exe") and process.args : "*-enc*{i}*"'
+            ),
+            "index": ["logs-endpoint.events.process-*", "winlogbeat-*"],
+            "severity": rnd.choice(["low", "medium", "high"]),
+            "risk_score": rnd.choice([21, 47, 73]),
+            "enabled": True,
+            "interval": "5m",
+            "from": "now-9m",
+            "max_signals": 100,
+            "tags": ["Domain: Endpoint", "OS: Windows", f"Tactic: {tactic_name}"],
+            "references": [f"https://attack.mitre.org/tactics/{tactic_id}/"],
+            "threat": [{
+                "framework": "MITRE ATT&CK",
+                "tactic": {"id": tactic_id, "name": tactic_name, "reference": f"https://attack.mitre.org/tactics/{tactic_id}/"},
+                "technique": [{
+                    "id": "T1059",
+                    "name": "Command and Scripting Interpreter",
+                    "subtechnique": [{"id": "T1059.001", "name": "PowerShell"}],
+                }],
+            }],
+            "exceptions_list": [{"id": "list-1", "list_id": "endpoint_list", "namespace_type": "agnostic", "type": "endpoint"}],
+            "_exception_items": [
+                {
+                    "item_id": f"item-{i}-{n}",
+                    "name": f"Allow build agent {n}",
+                    "entries": [{"field": "host.name", "operator": "included", "type": "match_any", "value": ["build-01", "build-02"]}],
+                    "tags": [],
+                }
+                for n in range(rnd.randint(0, 3))
+            ],
+        },
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rules", type=int, default=2000)
+    parser.add_argument("--rounds", type=int, default=3)
+    args = parser.parse_args()
+
+    rnd = random.Random(0)
+    corpus = [make_rule(i, rnd) for i in range(args.rules)]
+
+    outputs = {}
+    for name in sorted(toml_engine.WRITERS):
+        writer = toml_engine.get_writer(name)
+        best = float("inf")
+        for _ in range(args.rounds):
+            start = time.perf_counter()
+            rendered = [writer(rule) for rule in corpus]
+            best = min(best, time.perf_counter() - start)
+        outputs[name] = rendered
+        print(f"{name:>5}: {len(corpus) / best:10.0f} rules/s  ({best * 1000:.1f} ms for {len(corpus)} rules)")
+
+    reference = outputs.pop("toml")
+    for name, rendered in outputs.items():
+        assert rendered == reference, f"{name} output differs from toml.dumps"
+    print("outputs byte-identical to toml.dumps")
+
+
+if __name__ == "__main__":
+    main()
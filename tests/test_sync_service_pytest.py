@@ -1,7 +1,9 @@
 import json
+import pickle
 import sys
 from pathlib import Path
 
+import httpx
 import pytest
 from fastapi import HTTPException
 
@@ -12,9 +14,16 @@ if str(SYNC_DIR) not in sys.path:
     sys.path.insert(0, str(SYNC_DIR))
 
 import change_detector as cd  # noqa: E402
+from cpu_pool import CpuPool  # noqa: E402
 import main as sync_main  # noqa: E402
 
 
+@pytest.fixture
+def anyio_backend():
+    # The sync service runs on uvicorn's asyncio loop
+    return "asyncio"
+
+
 def _rule(
     rule_id: str,
     *,
@@ -40,6 +49,12 @@ def _rule(
     }
 
 
+def _async_returning(value):
+    async def _fn(*args, **kwargs):
+        return value
+    return _fn
+
+
 def _snapshot(rule: dict) -> dict:
     return {
         "rule_id": rule["rule_id"],
@@ -53,12 +68,13 @@ def _snapshot(rule: dict) -> dict:
     }
 
 
-def test_detect_changes_happy_path_no_changes(monkeypatch):
+@pytest.mark.anyio
+async def test_detect_changes_happy_path_no_changes(monkeypatch):
     rule = _rule("r-1")
     monkeypatch.setattr(cd, "_export_via_cli", lambda *a, **k: ([rule], []))
-    monkeypatch.setattr(cd, "_export_via_api", lambda *a, **k: ([rule], []))
+    monkeypatch.setattr(cd, "_export_via_api", _async_returning(([rule], [])))
 
-    result = cd.detect_changes(
+    result = await cd.detect_changes(
         kibana_url="https://kibana.local",
         api_key="dummy",
         space="default",
@@ -71,7 +87,8 @@ def test_detect_changes_happy_path_no_changes(monkeypatch):
     assert len(result["current_rules"]) == 1
 
 
-def test_detect_changes_bidirectional_conflict_candidate(monkeypatch):
+@pytest.mark.anyio
+async def test_detect_changes_bidirectional_conflict_candidate(monkeypatch):
     # Simuliert Divergenz: eine Rule modifiziert, eine gelöscht, eine neu.
     baseline_modified = _rule("r-mod", query="old query", severity="low", enabled=True, tags=["old"])
     baseline_deleted = _rule("r-del", query="will be deleted")
@@ -79,9 +96,9 @@ def test_detect_changes_bidirectional_conflict_candidate(monkeypatch):
     current_new = _rule("r-new", query="new rule")
 
     monkeypatch.setattr(cd, "_export_via_cli", lambda *a, **k: ([current_modified, current_new], []))
-    monkeypatch.setattr(cd, "_export_via_api", lambda *a, **k: ([current_modified, current_new], []))
+    monkeypatch.setattr(cd, "_export_via_api", _async_returning(([current_modified, current_new], [])))
 
-    result = cd.detect_changes(
+    result = await cd.detect_changes(
         kibana_url="https://kibana.local",
         api_key="dummy",
         space="soc",
@@ -97,11 +114,12 @@ def test_detect_changes_bidirectional_conflict_candidate(monkeypatch):
     )
 
 
-def test_detect_changes_network_errors_from_cli_and_api(monkeypatch):
+@pytest.mark.anyio
+async def test_detect_changes_network_errors_from_cli_and_api(monkeypatch):
     monkeypatch.setattr(cd, "_export_via_cli", lambda *a, **k: ([], ["CLI export timed out after 120 seconds"]))
-    monkeypatch.setattr(cd, "_export_via_api", lambda *a, **k: ([], ["API export error: connection refused"]))
+    monkeypatch.setattr(cd, "_export_via_api", _async_returning(([], ["API export error: connection refused"])))
 
-    result = cd.detect_changes(
+    result = await cd.detect_changes(
         kibana_url="https://kibana.local",
         api_key="dummy",
         space="default",
@@ -114,13 +132,14 @@ def test_detect_changes_network_errors_from_cli_and_api(monkeypatch):
     assert any("API export error" in err for err in result["errors"])
 
 
-def test_detect_changes_cli_skip_is_supplemented_by_api(monkeypatch):
+@pytest.mark.anyio
+async def test_detect_changes_cli_skip_is_supplemented_by_api(monkeypatch):
     r1 = _rule("r-1")
     r2 = _rule("r-2")
     monkeypatch.setattr(cd, "_export_via_cli", lambda *a, **k: ([r1], []))
-    monkeypatch.setattr(cd, "_export_via_api", lambda *a, **k: ([r1, r2], []))
+    monkeypatch.setattr(cd, "_export_via_api", _async_returning(([r1, r2], [])))
 
-    result = cd.detect_changes(
+    result = await cd.detect_changes(
         kibana_url="https://kibana.local",
         api_key="dummy",
         space="default",
@@ -134,12 +153,13 @@ def test_detect_changes_cli_skip_is_supplemented_by_api(monkeypatch):
     assert result["changes"] == []
 
 
-def test_detect_changes_cli_failure_api_success_is_nonfatal(monkeypatch):
+@pytest.mark.anyio
+async def test_detect_changes_cli_failure_api_success_is_nonfatal(monkeypatch):
     rule = _rule("r-api")
     monkeypatch.setattr(cd, "_export_via_cli", lambda *a, **k: ([], ["CLI export timed out after 120 seconds"]))
-    monkeypatch.setattr(cd, "_export_via_api", lambda *a, **k: ([rule], []))
+    monkeypatch.setattr(cd, "_export_via_api", _async_returning(([rule], [])))
 
-    result = cd.detect_changes(
+    result = await cd.detect_changes(
         kibana_url="https://kibana.local",
         api_key="dummy",
         space="default",
@@ -151,13 +171,71 @@ def test_detect_changes_cli_failure_api_success_is_nonfatal(monkeypatch):
     assert result["changes"] == []
 
 
-def test_detect_changes_cli_priority_for_same_rule_id(monkeypatch):
+@pytest.mark.anyio
+async def test_detect_changes_runs_cli_and_api_exports_concurrently(monkeypatch):
+    import threading
+
+    rule = _rule("r-1")
+    api_started = threading.Event()
+
+    def _cli(*args, **kwargs):
+        # Only completes if the API export starts while the CLI is running
+        assert api_started.wait(timeout=5)
+        return [rule], []
+
+    async def _api(*args, **kwargs):
+        api_started.set()
+        return [rule], []
+
+    monkeypatch.setattr(cd, "_export_via_cli", _cli)
+    monkeypatch.setattr(cd, "_export_via_api", _api)
+
+    result = await cd.detect_changes(
+        kibana_url="https://kibana.local",
+        api_key="dummy",
+        space="default",
+        baseline_snapshots=[_snapshot(rule)],
+    )
+
+    assert result["errors"] == []
+    assert result["changes"] == []
+
+
+@pytest.mark.anyio
+async def test_detect_changes_renders_toml_only_for_changes_when_requested(monkeypatch):
+    unchanged = [_rule(f"r-{i}") for i in range(5)]
+    modified = _rule("r-mod", query="new query")
+    rendered = []
+    real_rule_to_toml = cd.rule_to_toml
+    monkeypatch.setattr(cd, "rule_to_toml", lambda rule: rendered.append(rule["rule_id"]) or real_rule_to_toml(rule))
+    # Render in this process so the patched rule_to_toml is the one called
+    monkeypatch.setattr(cd, "get_cpu_pool", lambda: CpuPool(workers=0))
+    monkeypatch.setattr(cd, "_export_via_api", _async_returning(([*unchanged, modified], [])))
+
+    result = await cd.detect_changes(
+        kibana_url="https://kibana.local",
+        api_key="dummy",
+        space="default",
+        baseline_snapshots=[_snapshot(r) for r in unchanged] + [_snapshot(_rule("r-mod", query="old"))],
+        use_cli=False,
+        include_current_toml=False,
+    )
+
+    assert rendered == ["r-mod"]
+    assert 'query = "new query"' in result["changes"][0]["toml_content"]
+    by_id = {r["rule_id"]: r for r in result["current_rules"]}
+    assert by_id["r-0"]["toml_content"] is None
+    assert by_id["r-mod"]["toml_content"] == result["changes"][0]["toml_content"]
+
+
+@pytest.mark.anyio
+async def test_detect_changes_cli_priority_for_same_rule_id(monkeypatch):
     cli_rule = _rule("r-1", query="query from cli")
     api_rule = _rule("r-1", query="query from api")
     monkeypatch.setattr(cd, "_export_via_cli", lambda *a, **k: ([cli_rule], []))
-    monkeypatch.setattr(cd, "_export_via_api", lambda *a, **k: ([api_rule], []))
+    monkeypatch.setattr(cd, "_export_via_api", _async_returning(([api_rule], [])))
 
-    result = cd.detect_changes(
+    result = await cd.detect_changes(
         kibana_url="https://kibana.local",
         api_key="dummy",
         space="default",
@@ -168,12 +246,13 @@ def test_detect_changes_cli_priority_for_same_rule_id(monkeypatch):
     assert result["current_rules"][0]["rule_content"]["query"] == "query from cli"
 
 
-def test_detect_changes_deleted_rule(monkeypatch):
+@pytest.mark.anyio
+async def test_detect_changes_deleted_rule(monkeypatch):
     rule = _rule("r-del")
     monkeypatch.setattr(cd, "_export_via_cli", lambda *a, **k: ([], []))
-    monkeypatch.setattr(cd, "_export_via_api", lambda *a, **k: ([], []))
+    monkeypatch.setattr(cd, "_export_via_api", _async_returning(([], [])))
 
-    result = cd.detect_changes(
+    result = await cd.detect_changes(
         kibana_url="https://kibana.local",
         api_key="dummy",
         space="default",
@@ -185,6 +264,375 @@ def test_detect_changes_deleted_rule(monkeypatch):
     assert result["changes"][0]["change_types"] == ["deleted_rule"]
 
 
+@pytest.mark.anyio
+async def test_detect_changes_hash_only_baseline_loads_changed_rules(monkeypatch):
+    unchanged = _rule("r-same")
+    baseline_modified = _rule("r-mod", query="old query")
+    baseline_deleted = _rule("r-del")
+    current_modified = _rule("r-mod", query="new query")
+    monkeypatch.setattr(cd, "_export_via_cli", lambda *a, **k: ([unchanged, current_modified], []))
+    monkeypatch.setattr(cd, "_export_via_api", _async_returning(([unchanged, current_modified], [])))
+
+    snapshots = {r["rule_id"]: _snapshot(r) for r in (unchanged, baseline_modified, baseline_deleted)}
+    requested = []
+
+    def _load(rule_ids):
+        requested.extend(rule_ids)
+        return [snapshots[rid] for rid in rule_ids]
+
+    result = await cd.detect_changes(
+        kibana_url="https://kibana.local",
+        api_key="dummy",
+        space="default",
+        baseline_hashes={rid: snap["rule_hash"] for rid, snap in snapshots.items()},
+        load_baseline=_load,
+    )
+
+    assert sorted(requested) == ["r-del", "r-mod"]
+    by_id = {c["rule_id"]: c for c in result["changes"]}
+    assert set(by_id) == {"r-mod", "r-del"}
+    assert "query_changed" in by_id["r-mod"]["change_types"]
+    assert by_id["r-del"]["previous_state"]["rule_id"] == "r-del"
+    assert not any(c.get("baseline_required") for c in result["changes"])
+
+
+@pytest.mark.anyio
+async def test_hash_only_changes_are_finished_by_classify_endpoint(monkeypatch):
+    baseline = _rule("r-mod", query="old query")
+    current = _rule("r-mod", query="new query")
+    monkeypatch.setattr(cd, "_export_via_cli", lambda *a, **k: ([current], []))
+    monkeypatch.setattr(cd, "_export_via_api", _async_returning(([current], [])))
+
+    result = await cd.detect_changes(
+        kibana_url="https://kibana.local",
+        api_key="dummy",
+        space="default",
+        baseline_hashes={"r-mod": cd.compute_rule_hash(baseline), "r-gone": "abc"},
+    )
+
+    by_id = {c["rule_id"]: c for c in result["changes"]}
+    assert by_id["r-mod"]["baseline_required"] is True
+    assert by_id["r-mod"]["change_types"] == ["modified_rule"]
+    assert by_id["r-gone"]["change_types"] == ["deleted_rule"]
+    assert by_id["r-gone"]["baseline_required"] is True
+
+    resp = await sync_main.api_classify_changes(
+        sync_main.ClassifyChangesRequest(changes=[
+            {"rule_id": "r-mod", "previous_state": baseline, "current_state": by_id["r-mod"]["current_state"]},
+        ])
+    )
+    assert "query_changed" in resp["changes"][0]["change_types"]
+
+
+def test_baseline_store_commit_and_load(tmp_path):
+    from baseline_store import BaselineStore
+
+    store = BaselineStore(str(tmp_path / "baseline.db"))
+    r1, r2 = _rule("r-1"), _rule("r-2")
+    assert store.hashes("https://kibana.local/", "soc") is None
+
+    store.commit("https://kibana.local/", "soc", [_snapshot(r1), _snapshot(r2)], replace=True)
+    store.commit("https://kibana.local", "soc", [], deleted_rule_ids=["r-2"])
+
+    reopened = BaselineStore(str(tmp_path / "baseline.db"))
+    assert reopened.hashes("https://kibana.local", "soc") == {"r-1": cd.compute_rule_hash(r1)}
+    assert reopened.load("https://kibana.local", "soc", ["r-1", "r-2"])[0]["rule_content"] == r1
+    assert reopened.status("https://kibana.local", "default")["initialized"] is False
+
+    # Another project watching the same space keeps its own baseline:
+    # replacing it leaves this one alone
+    reopened.commit("https://kibana.local", "soc", [_snapshot(r2)], replace=True, baseline_id="p2/e1")
+    assert reopened.hashes("https://kibana.local", "soc", "p2/e1") == {"r-2": cd.compute_rule_hash(r2)}
+    assert reopened.hashes("https://kibana.local", "soc") == {"r-1": cd.compute_rule_hash(r1)}
+    assert reopened.load("https://kibana.local", "soc", ["r-1"], "p2/e1") == []
+
+
+def test_baseline_store_starts_over_on_a_file_without_baseline_ids(tmp_path):
+    import sqlite3
+    from baseline_store import BaselineStore
+
+    path = str(tmp_path / "baseline.db")
+    conn = sqlite3.connect(path)
+    conn.executescript(
+        "CREATE TABLE baseline_spaces (kibana_url TEXT, space TEXT, committed_at REAL);"
+        "CREATE TABLE baseline_rules (kibana_url TEXT, space TEXT, rule_id TEXT, rule_hash TEXT, snapshot TEXT);"
+        "INSERT INTO baseline_spaces VALUES ('https://kibana.local', 'soc', 1.0);"
+    )
+    conn.commit()
+    conn.close()
+
+    store = BaselineStore(path)
+    assert store.hashes("https://kibana.local", "soc") is None
+    store.commit("https://kibana.local", "soc", [{"rule_id": "r-1", "rule_hash": "h1"}], baseline_id="p1/e1")
+    assert store.hashes("https://kibana.local", "soc", "p1/e1") == {"r-1": "h1"}
+
+
+@pytest.mark.anyio
+async def test_detect_changes_endpoint_uses_baseline_store(monkeypatch, tmp_path):
+    from baseline_store import BaselineStore
+
+    baseline = _rule("r-mod", query="old query")
+    current = _rule("r-mod", query="new query")
+    monkeypatch.setattr(cd, "_export_via_cli", lambda *a, **k: ([current], []))
+    monkeypatch.setattr(cd, "_export_via_api", _async_returning(([current], [])))
+    monkeypatch.setattr(sync_main, "_baseline_store", BaselineStore(str(tmp_path / "baseline.db")))
+
+    payload = sync_main.DetectChangesRequest(
+        kibana_url="https://kibana.local", api_key="dummy", space="soc", use_baseline_store=True,
+    )
+    with pytest.raises(HTTPException) as exc:
+        await sync_main.api_detect_changes(payload)
+    assert exc.value.status_code == 409
+
+    await sync_main.api_baseline_commit(sync_main.BaselineCommitRequest(
+        kibana_url="https://kibana.local", space="soc", snapshots=[_snapshot(baseline)], replace=True,
+    ))
+    result = await sync_main.api_detect_changes(payload)
+    assert result["changes"][0]["previous_state"]["query"] == "old query"
+    assert "query_changed" in result["changes"][0]["change_types"]
+
+
+def _kibana_transport(rules: list[dict], exception_lists: list[dict], items_by_list: dict[str, list[dict]]):
+    """Fake Kibana API serving _find endpoints for rules and exception lists."""
+    def _page(data, request):
+        per_page = int(request.url.params.get("per_page", "20"))
+        page = int(request.url.params.get("page", "1"))
+        chunk = data[(page - 1) * per_page: page * per_page]
+        return httpx.Response(200, json={"data": chunk, "total": len(data), "page": page, "per_page": per_page})
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        path = request.url.path
+        if path.endswith("/api/detection_engine/rules/_find"):
+            return _page(rules, request)
+        if path.endswith("/api/exception_lists/_find"):
+            return _page(exception_lists, request)
+        if path.endswith("/api/exception_lists/items/_find"):
+            return _page(items_by_list.get(request.url.params["list_id"], []), request)
+        return httpx.Response(404)
+
+    return httpx.MockTransport(handler)
+
+
+@pytest.mark.anyio
+async def test_export_via_api_attaches_exception_items():
+    rule = _rule("r-1", exceptions_list=[{"list_id": "shared", "namespace_type": "single"}])
+    items = [{"item_id": "b", "name": "B", "id": "x1"}, {"item_id": "a", "name": "A", "id": "x2"}]
+    transport = _kibana_transport([rule], [{"list_id": "shared", "namespace_type": "single"}], {"shared": items})
+
+    async with httpx.AsyncClient(transport=transport) as client:
+        rules, errors = await cd._export_via_api("https://kibana.local", "dummy", "soc", client=client)
+
+    assert errors == []
+    assert [r["rule_id"] for r in rules] == ["r-1"]
+    assert rules[0]["_exception_items"] == [{"item_id": "a", "name": "A"}, {"item_id": "b", "name": "B"}]
+
+
+@pytest.mark.anyio
+async def test_export_via_api_fetches_exception_lists_concurrently(monkeypatch):
+    import asyncio
+
+    monkeypatch.setattr(cd, "EXCEPTION_FETCH_CONCURRENCY", 2)
+    lists = [{"list_id": f"l-{i}", "namespace_type": "single"} for i in range(6)]
+    rule = _rule("r-1", exceptions_list=lists)
+    in_flight = 0
+    peak = 0
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        nonlocal in_flight, peak
+        path = request.url.path
+        if path.endswith("/rules/_find"):
+            return httpx.Response(200, json={"data": [rule], "total": 1})
+        if path.endswith("/exception_lists/_find"):
+            return httpx.Response(200, json={"data": lists, "total": len(lists)})
+        list_id = request.url.params["list_id"]
+        in_flight += 1
+        peak = max(peak, in_flight)
+        await asyncio.sleep(0.01)
+        in_flight -= 1
+        if list_id == "l-3":
+            raise httpx.ConnectError("boom")
+        return httpx.Response(200, json={"data": [{"item_id": list_id}], "total": 1})
+
+    async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+        rules, errors = await cd._export_via_api("https://kibana.local", "dummy", "default", client=client)
+
+    assert peak == 2
+    assert len(errors) == 1 and "Failed to fetch items for list l-3" in errors[0]
+    assert len(rules[0]["_exception_items"]) == 5
+
+
+@pytest.mark.anyio
+async def test_export_via_api_pages_through_exception_lists_and_items(monkeypatch):
+    monkeypatch.setattr(cd, "EXCEPTION_PAGE_SIZE", 2)
+    lists = [{"list_id": f"l-{i}", "namespace_type": "single"} for i in range(3)]
+    items = {"l-2": [{"item_id": f"i-{n}", "name": f"item {n}"} for n in range(5)]}
+    rule = _rule("r-1", exceptions_list=[{"list_id": "l-2", "namespace_type": "single"}])
+
+    progress: dict[str, int] = {}
+
+    def _report(stage, count):
+        progress[stage] = progress.get(stage, 0) + count
+
+    async with httpx.AsyncClient(transport=_kibana_transport([rule], lists, items)) as client:
+        rules, errors = await cd._export_via_api(
+            "https://kibana.local", "dummy", "default", client=client, progress=_report,
+        )
+
+    assert errors == []
+    assert progress == {"rules_fetched": 1, "lists_total": len(lists), "lists_fetched": len(lists)}
+    assert len(rules[0]["_enriched_exceptions"]) == 1
+    assert [it["item_id"] for it in rules[0]["_exception_items"]] == [f"i-{n}" for n in range(5)]
+
+
+@pytest.mark.anyio
+async def test_detect_changes_incremental_fetches_only_updated_rules(monkeypatch):
+    from collections import OrderedDict
+
+    monkeypatch.setattr(cd, "_incremental_state", OrderedDict())
+    monkeypatch.setattr(cd, "_INCREMENTAL_STATE_SIZE", 1)
+    kibana = {
+        r["rule_id"]: dict(r, updated_at=f"2025-01-01T00:00:0{i}.000Z")
+        for i, r in enumerate([_rule("r-1"), _rule("r-2"), _rule("r-3")])
+    }
+    full_exports = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        params = request.url.params
+        if request.url.path.endswith("/exception_lists/_find"):
+            return httpx.Response(200, json={"data": [], "total": 0})
+        rules = list(kibana.values())
+        if "fields" in params:
+            data = [{"rule_id": r["rule_id"], "updated_at": r["updated_at"]} for r in rules]
+        elif "filter" in params:
+            watermark = params["filter"].split('"')[1]
+            data = [r for r in rules if r["updated_at"] >= watermark]
+        else:
+            full_exports.append(1)
+            data = rules
+        return httpx.Response(200, json={"data": data, "total": len(data)})
+
+    async def _run(baseline, api_key="dummy"):
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+            return await cd.detect_changes(
+                kibana_url="https://kibana.local", api_key=api_key, space="soc",
+                baseline_snapshots=baseline, client=client, incremental=True,
+            )
+
+    first = await _run([])
+    assert first["incremental"]["full_export"] is True
+    baseline = [_snapshot(r["rule_content"]) for r in first["current_rules"]]
+
+    kibana["r-2"] = dict(kibana["r-2"], query="changed", updated_at="2025-02-01T00:00:00.000Z")
+    del kibana["r-3"]
+    second = await _run(baseline)
+
+    assert len(full_exports) == 1
+    assert second["incremental"] == {"full_export": False, "rules_fetched": 1, "rules_deleted": 1}
+    by_id = {c["rule_id"]: c["change_types"] for c in second["changes"]}
+    assert by_id == {"r-2": ["query_changed"], "r-3": ["deleted_rule"]}
+
+    # State is kept per API key, least recently used key evicted first
+    assert (await _run([], api_key="other"))["incremental"]["full_export"] is True
+    assert (await _run(baseline))["incremental"]["full_export"] is True
+    assert len(cd._incremental_state) == 1
+
+
+def test_kibana_client_pool_reuses_client_per_host():
+    from kibana_client import KibanaClientPool
+
+    pool = KibanaClientPool(max_connections=5)
+    first = pool.get("https://kibana.local:5601")
+    assert pool.get("https://kibana.local:5601/s/soc") is first
+    assert pool.get("https://other.local:5601") is not first
+
+
+_FAKE_CLI_WORKER = """
+import json, os, sys, time
+available = sys.argv[1] == "ok"
+delay = float(sys.argv[2]) if len(sys.argv) > 2 else 0
+print(json.dumps({"ready": True, "available": available, "error": "" if available else "no module"}), flush=True)
+for line in sys.stdin:
+    args = json.loads(line)["args"]
+    time.sleep(delay)
+    print(json.dumps({"returncode": 0, "stderr": str(os.getpid()) + " " + " ".join(args)}), flush=True)
+"""
+
+
+def test_cli_exporter_pool_reuses_warm_worker(tmp_path):
+    from cli_exporter import CliExporterPool
+
+    script = tmp_path / "fake_worker.py"
+    script.write_text(_FAKE_CLI_WORKER)
+    pool = CliExporterPool(command=[sys.executable, str(script), "ok"], max_exports=2)
+    try:
+        assert pool.probe() is True
+        _, first = pool.run(["export-rules"], timeout=10)
+        _, second = pool.run(["export-rules"], timeout=10)
+        _, third = pool.run(["export-rules"], timeout=10)
+    finally:
+        pool.close()
+
+    assert first.endswith("export-rules")
+    # probe + one export reuse the same process; it is recycled after max_exports
+    assert first.split()[0] == second.split()[0]
+    assert third.split()[0] != first.split()[0]
+
+
+@pytest.mark.anyio
+async def test_cli_exporter_pool_runs_concurrent_exports_on_one_off_workers(tmp_path):
+    import asyncio
+    import subprocess
+    import threading
+    import time
+    from cli_exporter import CliExporterPool
+
+    script = tmp_path / "fake_worker.py"
+    script.write_text(_FAKE_CLI_WORKER)
+    pool = CliExporterPool(size=1, max_workers=3, command=[sys.executable, str(script), "ok", "0.5"])
+    default_threads = {t.name for t in threading.enumerate()}
+    try:
+        started = time.monotonic()
+        results = await asyncio.gather(*(
+            pool.run_in_thread(pool.run, ["export-rules"], 10) for _ in range(3)
+        ))
+        elapsed = time.monotonic() - started
+        export_threads = {t.name for t in threading.enumerate()} - default_threads
+        # Only the warm worker is kept; the one-off workers were closed
+        kept = pool._idle.qsize()
+    finally:
+        pool.close()
+
+    # Three exports ran side by side instead of queueing behind one worker
+    assert elapsed < 1.4
+    assert len({stderr.split()[0] for _, stderr in results}) == 3
+    assert export_threads and all(name.startswith("cli-export") for name in export_threads)
+    assert kept == 1
+
+    busy = CliExporterPool(size=1, command=[sys.executable, str(script), "ok", "1"])
+    try:
+        holder = asyncio.ensure_future(busy.run_in_thread(busy.run, ["export-rules"], 10))
+        await asyncio.sleep(0.2)
+        # Waiting for the only slot counts against the export timeout
+        with pytest.raises(subprocess.TimeoutExpired):
+            busy.run(["export-rules"], timeout=0.1)
+        await holder
+    finally:
+        busy.close()
+
+
+def test_cli_exporter_pool_reports_missing_cli(tmp_path):
+    from cli_exporter import CliExporterPool, CliUnavailableError
+
+    script = tmp_path / "fake_worker.py"
+    script.write_text(_FAKE_CLI_WORKER)
+    pool = CliExporterPool(command=[sys.executable, str(script), "missing"])
+
+    assert pool.probe() is False
+    with pytest.raises(CliUnavailableError):
+        pool.run(["export-rules"], timeout=10)
+    assert pool.error == "no module"
+
+
 def test_classify_changes_exception_item_modified():
     previous = _rule("r-exc", exception_items=[{"item_id": "1", "name": "A"}])
     current = _rule("r-exc", exception_items=[{"item_id": "1", "name": "B"}])
@@ -207,6 +655,57 @@ def test_compute_rule_hash_ignores_volatile_fields():
     assert cd.compute_rule_hash(base) == cd.compute_rule_hash(with_volatile)
 
 
+def test_compute_rule_hash_memoizes_by_kibana_fingerprint(monkeypatch):
+    monkeypatch.setattr(cd, "rule_hash_cache", cd.RuleHashCache(maxsize=2))
+    kibana_rule = dict(_rule("r-cache"), id="so-1", revision=3, updated_at="2025-01-01T00:00:00Z")
+    expected = cd._compute_rule_hash_uncached(kibana_rule)
+
+    assert cd.compute_rule_hash(kibana_rule) == expected
+    assert cd.compute_rule_hash(dict(kibana_rule)) == expected
+    assert cd.rule_hash_cache.stats()["hits"] == 1
+
+    # Different exception items must not share the cached hash
+    with_items = dict(kibana_rule, _exception_items=[{"item_id": "1"}])
+    assert cd.compute_rule_hash(with_items) == cd._compute_rule_hash_uncached(with_items)
+
+    # Rules without a Kibana fingerprint bypass the cache entirely
+    cd.compute_rule_hash(_rule("r-plain"))
+    assert cd.rule_hash_cache.stats()["misses"] == 2
+
+
+def test_toml_engine_matches_reference_dumps(monkeypatch):
+    import toml
+    import toml_engine
+
+    rule = dict(
+        _rule(
+            "r-toml-engine",
+            name='Quoted "name" in C:\\Windows\\System32',
+            tags=["Domain: Endpoint", "Tactic: Execution"],
+            exception_items=[{"item_id": "1", "entries": [{"field": "host.name", "value": ["a", "b"]}]}],
+        ),
+        threat=[{
+            "framework": "MITRE ATT&CK",
+            "tactic": {"id": "TA0002", "name": "Execution"},
+            "technique": [{"id": "T1059", "subtechnique": [{"id": "T1059.001"}]}],
+        }],
+        risk_score_mapping=[],
+        max_signals=100,
+        interval="5m",
+        threshold={"field": ["host.name"], "value": 1.5},
+    )
+    monkeypatch.setenv("SYNC_TOML_ENGINE", "toml")
+    reference = cd.rule_to_toml(rule)
+    monkeypatch.setenv("SYNC_TOML_ENGINE", "fast")
+    rendered = cd.rule_to_toml(rule)
+
+    assert rendered == reference
+    assert toml_engine.get_writer("fast")({"rule": rule}) == toml.dumps({"rule": rule})
+    assert toml_engine.loads(rendered)["rule"]["rule_id"] == "r-toml-engine"
+    with pytest.raises(ValueError):
+        toml_engine.get_writer("yaml")
+
+
 @pytest.mark.anyio
 async def test_parse_rule_content_json_and_toml():
     json_req = sync_main.ParseRuleContentRequest(content=json.dumps(_rule("r-json")), format="json")
@@ -259,6 +758,23 @@ async def test_parse_rule_content_invalid_formats():
     assert "Unsupported format" in unsupported_exc.value.detail
 
 
+@pytest.mark.anyio
+async def test_health_returns_cached_cli_probe(monkeypatch):
+    calls = []
+    monkeypatch.setattr(sync_main, "_health_state", dict(sync_main._health_state, cli_probed_at=None))
+    monkeypatch.setattr(sync_main, "_check_cli_available", lambda: calls.append(1) or True)
+
+    before = await sync_main.health()
+    assert calls == []
+    assert before["cli_probe_age_seconds"] is None
+
+    await sync_main._refresh_cli_probe()
+    after = await sync_main.health()
+    assert calls == [1]
+    assert after["cli_available"] is True
+    assert after["cli_probe_age_seconds"] >= 0
+
+
 @pytest.mark.anyio
 async def test_detect_changes_endpoint_handles_internal_failure(monkeypatch):
     def _boom(*args, **kwargs):
@@ -275,3 +791,890 @@ async def test_detect_changes_endpoint_handles_internal_failure(monkeypatch):
         await sync_main.api_detect_changes(payload)
     assert exc.value.status_code == 500
     assert "network down" in exc.value.detail
+
+
+@pytest.mark.anyio
+async def test_detect_changes_stream_emits_ndjson_records(monkeypatch):
+    unchanged = _rule("r-same")
+    modified = _rule("r-mod", query="new query")
+    deleted = _rule("r-gone")
+    monkeypatch.setattr(cd, "_export_via_cli", lambda *a, **k: ([], ["no cli"]))
+    monkeypatch.setattr(cd, "_export_via_api", _async_returning(([unchanged, modified], [])))
+
+    payload = sync_main.DetectChangesRequest(
+        kibana_url="https://kibana.local",
+        api_key="dummy",
+        baseline_snapshots=[
+            _snapshot(unchanged),
+            _snapshot(_rule("r-mod", query="old query")),
+            _snapshot(deleted),
+        ],
+        include_current_toml=False,
+    )
+    resp = await sync_main.api_detect_changes_stream(payload)
+    assert resp.media_type == "application/x-ndjson"
+    lines = [chunk async for chunk in resp.body_iterator]
+    records = [json.loads(line) for line in lines]
+
+    assert all(line.endswith("\n") for line in lines)
+    assert [(r["type"], r.get("rule_id")) for r in records] == [
+        ("current_rule", "r-same"),
+        ("change", "r-mod"),
+        ("current_rule", "r-mod"),
+        ("change", "r-gone"),
+        ("summary", None),
+    ]
+    assert records[1]["change_types"] == ["query_changed"]
+    assert 'query = "new query"' in records[1]["toml_content"]
+    assert records[0]["toml_content"] is None
+    summary = records[-1]
+    assert summary["change_count"] == 2
+    assert summary["rule_count"] == 2
+    assert summary["errors"] == []
+    assert any("no cli" in w for w in summary["warnings"])
+
+
+@pytest.mark.anyio
+async def test_detect_changes_stream_reports_failure_in_band(monkeypatch):
+    async def _boom(*args, **kwargs):
+        raise RuntimeError("network down")
+
+    monkeypatch.setattr(cd, "_export_via_cli", lambda *a, **k: ([], []))
+    monkeypatch.setattr(cd, "_export_via_api", _boom)
+    payload = sync_main.DetectChangesRequest(kibana_url="https://kibana.local", api_key="dummy")
+    resp = await sync_main.api_detect_changes_stream(payload)
+    records = [json.loads(line) async for line in resp.body_iterator]
+    assert records == [{"type": "error", "detail": "network down"}]
+
+
+def test_json_patch_describes_structural_changes():
+    previous = {"query": "a", "tags": ["x", "y"], "threat": [{"id": "T1"}], "a/b": 1, "gone": True}
+    current = {"query": "b", "tags": ["x", "z"], "threat": [{"id": "T1"}, {"id": "T2"}], "a/b": 2, "new": 0}
+
+    assert cd.json_patch(previous, current) == [
+        {"op": "remove", "path": "/gone"},
+        {"op": "replace", "path": "/query", "value": "b"},
+        {"op": "replace", "path": "/tags/1", "value": "z"},
+        {"op": "replace", "path": "/threat", "value": [{"id": "T1"}, {"id": "T2"}]},
+        {"op": "replace", "path": "/a~1b", "value": 2},
+        {"op": "add", "path": "/new", "value": 0},
+    ]
+    assert cd.json_patch(previous, dict(previous)) == []
+    assert cd.json_patch({"enabled": 1}, {"enabled": True}) == [{"op": "replace", "path": "/enabled", "value": True}]
+
+
+@pytest.mark.anyio
+async def test_detect_changes_compact_mode_references_current_rules(monkeypatch):
+    modified = _rule("r-mod", query="new query")
+    new = _rule("r-new")
+    deleted = _rule("r-del")
+    monkeypatch.setattr(cd, "_export_via_api", _async_returning(([modified, new], [])))
+
+    result = await cd.detect_changes(
+        kibana_url="https://kibana.local",
+        api_key="dummy",
+        space="default",
+        baseline_snapshots=[_snapshot(_rule("r-mod", query="old query")), _snapshot(deleted)],
+        use_cli=False,
+        compact=True,
+    )
+
+    assert result["compact"] is True
+    by_id = {c["rule_id"]: c for c in result["changes"]}
+    assert by_id["r-mod"]["patch"] == [{"op": "replace", "path": "/query", "value": "new query"}]
+    assert by_id["r-new"]["patch"] is None
+    assert by_id["r-del"]["previous_state"] == deleted
+    for change in result["changes"]:
+        assert "current_state" not in change and "toml_content" not in change
+    assert "previous_state" not in by_id["r-mod"]
+    current = {r["rule_id"]: r for r in result["current_rules"]}
+    assert current["r-mod"]["rule_content"] == modified
+    assert 'query = "new query"' in current["r-mod"]["toml_content"]
+
+
+@pytest.mark.anyio
+async def test_compression_middleware_negotiates_gzip(monkeypatch):
+    import gzip
+
+    import compression
+    from fastapi import FastAPI
+    from fastapi.responses import StreamingResponse
+
+    monkeypatch.setattr(compression, "zstandard", None)
+    app = FastAPI()
+    app.add_middleware(compression.CompressionMiddleware, minimum_size=100)
+
+    @app.get("/big")
+    async def big():
+        return {"rules": ["x" * 50] * 100}
+
+    @app.get("/small")
+    async def small():
+        return {"ok": True}
+
+    @app.get("/stream")
+    async def stream():
+        async def lines():
+            for i in range(3):
+                yield json.dumps({"n": i}) + "\n"
+        return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        resp = await client.get("/big", headers={"Accept-Encoding": "zstd, gzip"})
+        assert resp.headers["content-encoding"] == "gzip"
+        assert resp.json() == {"rules": ["x" * 50] * 100}
+
+        resp = await client.get("/small", headers={"Accept-Encoding": "gzip"})
+        assert "content-encoding" not in resp.headers
+
+        resp = await client.get("/big", headers={"Accept-Encoding": "gzip;q=0, identity"})
+        assert "content-encoding" not in resp.headers
+
+        resp = await client.get("/stream", headers={"Accept-Encoding": "gzip"})
+        assert resp.headers["content-encoding"] == "gzip"
+        assert [json.loads(line) for line in resp.text.splitlines()] == [{"n": 0}, {"n": 1}, {"n": 2}]
+
+    assert compression.choose_encoding("br, gzip;q=0.5") == "gzip"
+    assert gzip.decompress(compression._GzipCompressor(6).finish(b"abc")) == b"abc"
+
+
+@pytest.mark.anyio
+async def test_detect_changes_batch_runs_jobs_concurrently_with_host_caps(monkeypatch):
+    import asyncio
+
+    running: dict[str, int] = {}
+    peak: dict[str, int] = {}
+
+    async def _detect(kibana_url, space, **kwargs):
+        running[kibana_url] = running.get(kibana_url, 0) + 1
+        peak[kibana_url] = max(peak.get(kibana_url, 0), running[kibana_url])
+        await asyncio.sleep(0.05)
+        running[kibana_url] -= 1
+        if space == "broken":
+            raise RuntimeError("kibana unreachable")
+        return {"changes": [], "current_rules": [], "errors": [], "warnings": [], "space": space}
+
+    monkeypatch.setattr(sync_main, "detect_changes", _detect)
+    monkeypatch.setattr(sync_main, "BATCH_HOST_CONCURRENCY", 2)
+    jobs = [
+        sync_main.BatchDetectionJob(job_id=f"a{i}", kibana_url="https://a.local", api_key="k", space=f"s{i}")
+        for i in range(4)
+    ] + [
+        sync_main.BatchDetectionJob(job_id="b", kibana_url="https://b.local:5601", api_key="k", space="broken"),
+    ]
+
+    resp = await sync_main.api_detect_changes_batch(sync_main.BatchDetectChangesRequest(jobs=jobs))
+
+    assert [r["job_id"] for r in resp["results"]] == ["a0", "a1", "a2", "a3", "b"]
+    assert resp["succeeded"] == 4 and resp["failed"] == 1
+    assert resp["results"][1]["result"]["space"] == "s1"
+    assert resp["results"][4]["status_code"] == 500
+    assert "kibana unreachable" in resp["results"][4]["error"]
+    assert peak == {"https://a.local": 2, "https://b.local:5601": 1}
+
+
+@pytest.mark.anyio
+async def test_detect_changes_batch_runs_cli_exports_side_by_side(monkeypatch, tmp_path):
+    import time
+    from cli_exporter import CliExporterPool
+
+    script = tmp_path / "fake_worker.py"
+    script.write_text(_FAKE_CLI_WORKER)
+    monkeypatch.delenv("SYNC_CLI_MAX_WORKERS", raising=False)
+    monkeypatch.setenv("SYNC_BATCH_CONCURRENCY", "4")
+    pool = CliExporterPool.from_env()
+    pool.command = [sys.executable, str(script), "ok", "0.5"]
+    monkeypatch.setattr(cd, "get_cli_exporter", lambda: pool)
+    monkeypatch.setattr(cd, "_export_via_api", _async_returning(([_rule("r-1")], [])))
+    jobs = [
+        sync_main.BatchDetectionJob(job_id=f"j{i}", kibana_url=f"https://k{i}.local", api_key="k")
+        for i in range(4)
+    ]
+
+    try:
+        started = time.monotonic()
+        resp = await sync_main.api_detect_changes_batch(sync_main.BatchDetectChangesRequest(jobs=jobs))
+        elapsed = time.monotonic() - started
+    finally:
+        pool.close()
+
+    assert pool.max_workers == 4
+    assert resp["succeeded"] == 4
+    # Four 0.5 s CLI exports: about the slowest one, not their 2 s sum
+    assert elapsed < 1.5
+
+
+@pytest.mark.anyio
+async def test_detect_changes_batch_streams_jobs_and_times_out(monkeypatch):
+    import asyncio
+
+    async def _detect(kibana_url, space, **kwargs):
+        await asyncio.sleep(5 if space == "slow" else 0)
+        return {"changes": [], "current_rules": [], "errors": [], "warnings": []}
+
+    monkeypatch.setattr(sync_main, "detect_changes", _detect)
+    req = sync_main.BatchDetectChangesRequest(
+        jobs=[
+            sync_main.BatchDetectionJob(job_id="slow", kibana_url="https://a.local", api_key="k", space="slow"),
+            sync_main.BatchDetectionJob(job_id="fast", kibana_url="https://b.local", api_key="k", space="fast"),
+        ],
+        job_timeout=0.1,
+        stream=True,
+    )
+    resp = await sync_main.api_detect_changes_batch(req)
+    records = [json.loads(line) async for line in resp.body_iterator]
+
+    assert [(r["type"], r.get("job_id"), r.get("status")) for r in records[:2]] == [
+        ("job", "fast", "ok"),
+        ("job", "slow", "error"),
+    ]
+    assert records[1]["status_code"] == 504
+    assert records[2] == {"type": "summary", "jobs": 2, "succeeded": 1, "failed": 1}
+
+
+@pytest.mark.anyio
+async def test_detection_job_reports_progress_and_result(monkeypatch):
+    import asyncio
+
+    from job_queue import JobQueue
+
+    release = asyncio.Event()
+
+    async def _detect(progress=None, **kwargs):
+        progress("rules_fetched", 120)
+        progress("rules_hashed", 40)
+        await release.wait()
+        return {"changes": [], "current_rules": [], "errors": [], "warnings": []}
+
+    queue = JobQueue(workers=1, max_queued=1, result_ttl=60)
+    monkeypatch.setattr(sync_main, "_job_queue", queue)
+    monkeypatch.setattr(sync_main, "detect_changes", _detect)
+    payload = sync_main.DetectChangesRequest(kibana_url="https://kibana.local", api_key="dummy")
+    try:
+        submitted = await sync_main.api_submit_detection_job(payload)
+        for _ in range(5):
+            await asyncio.sleep(0)
+        status = await sync_main.api_job_status(submitted["job_id"])
+        assert status["status"] == "running"
+        assert status["progress"] == {"rules_fetched": 120, "rules_hashed": 40}
+        with pytest.raises(HTTPException) as exc:
+            await sync_main.api_job_result(submitted["job_id"])
+        assert exc.value.status_code == 409
+
+        # One job running and one queued: the next submission is rejected
+        second = await sync_main.api_submit_detection_job(payload)
+        with pytest.raises(HTTPException) as exc:
+            await sync_main.api_submit_detection_job(payload)
+        assert exc.value.status_code == 503
+
+        release.set()
+        for _ in range(10):
+            await asyncio.sleep(0)
+        result = await sync_main.api_job_result(submitted["job_id"])
+        assert result["changes"] == []
+        assert queue.stats()["succeeded"] == 2
+
+        # Beyond max_finished, the oldest finished jobs are dropped first
+        queue.max_finished = 1
+        with pytest.raises(HTTPException) as exc:
+            await sync_main.api_job_status(submitted["job_id"])
+        assert exc.value.status_code == 404
+        assert (await sync_main.api_job_status(second["job_id"]))["status"] == "succeeded"
+
+        queue.result_ttl = -1
+        with pytest.raises(HTTPException) as exc:
+            await sync_main.api_job_status(second["job_id"])
+        assert exc.value.status_code == 404
+    finally:
+        await queue.stop()
+
+
+@pytest.mark.anyio
+async def test_detection_job_failure_is_reported(monkeypatch):
+    import asyncio
+
+    from job_queue import JobQueue
+
+    async def _boom(**kwargs):
+        raise RuntimeError("network down")
+
+    queue = JobQueue(workers=1)
+    monkeypatch.setattr(sync_main, "_job_queue", queue)
+    monkeypatch.setattr(sync_main, "detect_changes", _boom)
+    try:
+        payload = sync_main.DetectChangesRequest(kibana_url="https://kibana.local", api_key="dummy")
+        job_id = (await sync_main.api_submit_detection_job(payload))["job_id"]
+        for _ in range(10):
+            await asyncio.sleep(0)
+        status = await sync_main.api_job_status(job_id)
+        assert status["status"] == "failed"
+        assert "network down" in status["error"]
+        with pytest.raises(HTTPException) as exc:
+            await sync_main.api_job_result(job_id)
+        assert exc.value.status_code == 500
+    finally:
+        await queue.stop()
+
+
+@pytest.mark.anyio
+async def test_concurrent_detections_for_same_space_share_one_export(monkeypatch):
+    import asyncio
+
+    from single_flight import SingleFlight
+
+    calls = []
+
+    async def _detect(space, **kwargs):
+        calls.append(space)
+        run = len(calls)
+        await asyncio.sleep(0.05)
+        return {"changes": [], "current_rules": [], "errors": [], "warnings": [], "run": run}
+
+    monkeypatch.setattr(sync_main, "detect_changes", _detect)
+    monkeypatch.setattr(sync_main, "_detections", SingleFlight())
+    same = sync_main.DetectChangesRequest(kibana_url="https://kibana.local", api_key="k", baseline_hashes={"r": "h"})
+    other_baseline = sync_main.DetectChangesRequest(
+        kibana_url="https://kibana.local", api_key="k", baseline_hashes={"r": "h2"},
+    )
+
+    results = await asyncio.gather(
+        sync_main.api_detect_changes(same),
+        sync_main.api_detect_changes(same.model_copy()),
+        sync_main.api_detect_changes(other_baseline),
+    )
+
+    assert len(calls) == 2
+    assert results[0] is results[1]
+    assert results[2]["run"] != results[0]["run"]
+    assert sync_main._detections.stats()["coalesced"] == 1
+
+    # Without a result TTL, a later call runs a fresh export
+    await sync_main.api_detect_changes(same)
+    assert len(calls) == 3
+
+
+@pytest.mark.anyio
+async def test_single_flight_result_ttl_and_errors():
+    from single_flight import SingleFlight
+
+    flight = SingleFlight(result_ttl=30)
+    calls = []
+
+    async def _ok():
+        calls.append("ok")
+        return {"n": len(calls)}
+
+    async def _fail():
+        calls.append("fail")
+        raise RuntimeError("boom")
+
+    assert await flight.run("a", _ok) == {"n": 1}
+    assert await flight.run("a", _ok) == {"n": 1}
+    assert flight.stats()["cache_hits"] == 1
+
+    for _ in range(2):
+        with pytest.raises(RuntimeError):
+            await flight.run("b", _fail)
+    # Failures are not cached
+    assert calls == ["ok", "fail", "fail"]
+
+
+@pytest.mark.anyio
+async def test_rules_export_is_cached_and_revalidated_with_etag(monkeypatch):
+    import asyncio
+
+    exports = []
+
+    async def _api(kibana_url, api_key, space, **kwargs):
+        exports.append(space)
+        await asyncio.sleep(0.01)
+        return [_rule("r-1", name="Rule one"), _rule("r-2")], []
+
+    monkeypatch.setattr(cd, "export_cache", cd.ExportCache(ttl=60))
+    monkeypatch.setattr(sync_main, "export_cache", cd.export_cache)
+    monkeypatch.setattr(cd, "_export_via_api", _api)
+    body = {"kibana_url": "https://kibana.local", "api_key": "k", "space": "soc"}
+
+    transport = httpx.ASGITransport(app=sync_main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://sync") as client:
+        first, second = await asyncio.gather(
+            client.post("/rules/export", json=body),
+            client.post("/rules/export", json=body),
+        )
+        assert exports == ["soc"]
+        assert first.status_code == 200
+        assert first.json()["total"] == 2
+        etag = first.headers["etag"]
+        assert second.headers["etag"] == etag
+
+        resp = await client.post("/rules/export", json={**body, "summary": True})
+        assert resp.json()["cached"] is True
+        assert resp.json()["rules"][0] == {
+            "rule_id": "r-1", "id": None, "name": "Rule one", "description": "",
+            "severity": "low", "type": "query", "tags": [], "enabled": True,
+        }
+
+        resp = await client.post("/rules/export", json=body, headers={"If-None-Match": etag})
+        assert resp.status_code == 304
+        assert exports == ["soc"]
+
+        # max_age=0 forces a fresh export; same content keeps the same version
+        resp = await client.post("/rules/export", json={**body, "max_age": 0})
+        assert resp.json()["cached"] is False
+        assert resp.headers["etag"] == etag
+        assert exports == ["soc", "soc"]
+
+
+@pytest.mark.anyio
+async def test_detection_warms_export_cache(monkeypatch):
+    rule = _rule("r-1")
+    monkeypatch.setattr(cd, "export_cache", cd.ExportCache(ttl=60))
+    monkeypatch.setattr(cd, "_export_via_api", _async_returning(([rule], [])))
+
+    await cd.detect_changes(
+        kibana_url="https://kibana.local/", api_key="k", space="default", use_cli=False,
+    )
+
+    async def _no_export(*args, **kwargs):
+        raise AssertionError("listing should be served from the detection's export")
+
+    monkeypatch.setattr(cd, "_export_via_api", _no_export)
+    entry, from_cache = await cd.cached_export("https://kibana.local", "k", "default")
+    assert from_cache is True
+    assert entry["rules"] == [rule]
+    assert entry["version"] == cd.export_version([rule])
+
+    # Another API key does not see this entry
+    with pytest.raises(AssertionError):
+        await cd.cached_export("https://kibana.local", "other-key", "default")
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("ttl", [0, 60])
+async def test_detection_hashes_each_rule_once(monkeypatch, ttl):
+    rules = [_rule("r-1"), _rule("r-2")]
+    monkeypatch.setattr(cd, "export_cache", cd.ExportCache(ttl=ttl))
+    monkeypatch.setattr(cd, "_export_via_api", _async_returning((rules, [])))
+    hashed = []
+    hash_rules = cd._hash_rules
+
+    async def _counting_hash_rules(batch):
+        hashed.extend(rule["rule_id"] for rule in batch)
+        return await hash_rules(batch)
+
+    monkeypatch.setattr(cd, "_hash_rules", _counting_hash_rules)
+    await cd.detect_changes(
+        kibana_url="https://kibana.local", api_key="k", space="default", use_cli=False,
+    )
+
+    assert sorted(hashed) == ["r-1", "r-2"]
+    assert cd.export_cache.stats()["size"] == (1 if ttl > 0 else 0)
+
+
+@pytest.mark.anyio
+async def test_cached_export_returns_rules_when_an_exception_list_fails(monkeypatch):
+    monkeypatch.setattr(cd, "export_cache", cd.ExportCache(ttl=60))
+    lists = [{"list_id": "ok", "namespace_type": "single"}, {"list_id": "broken", "namespace_type": "single"}]
+    rule = _rule("r-1", exceptions_list=lists)
+    fake = _kibana_transport([rule], lists, {"ok": [{"item_id": "a"}]})
+    rules_down = False
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        if request.url.params.get("list_id") == "broken":
+            raise httpx.ConnectError("connection reset", request=request)
+        if rules_down and request.url.path.endswith("/rules/_find"):
+            return httpx.Response(503)
+        return fake.handle_request(request)
+
+    async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+        entry, from_cache = await cd.cached_export("https://kibana.local", "k", "default", client=client)
+        assert from_cache is False
+        assert [r["rule_id"] for r in entry["rules"]] == ["r-1"]
+        assert len(entry["errors"]) == 1 and "broken" in entry["errors"][0]
+
+        # The incomplete export was not cached; a failed rule fetch still raises
+        rules_down = True
+        with pytest.raises(RuntimeError):
+            await cd.cached_export("https://kibana.local", "k", "default", client=client)
+
+
+class _FakePool:
+    def __init__(self, client: httpx.AsyncClient):
+        self.client = client
+
+    def get(self, kibana_url: str) -> httpx.AsyncClient:
+        return self.client
+
+
+@pytest.mark.anyio
+async def test_revert_rules_bulk_imports_then_falls_back_per_rule(monkeypatch):
+    calls = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        calls.append((request.method, request.url.path))
+        if request.url.path.endswith("/_import"):
+            assert request.url.params["overwrite"] == "true"
+            body = request.content.decode()
+            assert '"rule_id": "r-1"' in body and '"revision"' not in body
+            return httpx.Response(200, json={
+                "success": False,
+                "success_count": 1,
+                "errors": [{"rule_id": "r-2", "error": {"status_code": 400, "message": "bad query"}}],
+            })
+        if request.method == "PUT":
+            return httpx.Response(404, json={"message": "not found"})
+        if "rule_id" not in json.loads(request.content):
+            return httpx.Response(400, json={"message": "rule_id is required"})
+        return httpx.Response(200, json={})
+
+    async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+        monkeypatch.setattr(sync_main, "get_kibana_pool", lambda: _FakePool(client))
+        resp = await sync_main.api_revert_rules_bulk(sync_main.RevertRulesBulkRequest(
+            kibana_url="https://kibana.local",
+            api_key="k",
+            space="soc",
+            rules=[dict(_rule("r-1"), revision=4, id="so-1"), _rule("r-2"), {"name": "no id"}],
+        ))
+
+    assert [(r["rule_id"], r["success"], r["method"]) for r in resp["results"]] == [
+        ("r-1", True, "import"),
+        ("r-2", True, "create"),
+        ("", False, "put"),
+    ]
+    assert resp["succeeded"] == 2 and resp["failed"] == 1 and resp["success"] is False
+    assert calls.count(("POST", "/s/soc/api/detection_engine/rules/_import")) == 1
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("import_response", [
+    # One line failed to parse: reported without its rule_id
+    lambda: httpx.Response(200, json={
+        "success": False,
+        "success_count": 2,
+        "errors": [{"rule_id": "(unknown id)", "error": {"status_code": 400, "message": "bad line"}}],
+    }),
+    # A proxy answering for Kibana
+    lambda: httpx.Response(200, text="<html>gateway</html>"),
+])
+async def test_revert_rules_bulk_puts_whole_chunk_when_import_result_is_unusable(monkeypatch, import_response):
+    puts = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        if request.url.path.endswith("/_import"):
+            return import_response()
+        puts.append(json.loads(request.content)["rule_id"])
+        return httpx.Response(200, json={})
+
+    async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+        monkeypatch.setattr(sync_main, "get_kibana_pool", lambda: _FakePool(client))
+        resp = await sync_main.api_revert_rules_bulk(sync_main.RevertRulesBulkRequest(
+            kibana_url="https://kibana.local",
+            api_key="k",
+            rules=[_rule(f"r-{i}") for i in range(3)],
+        ))
+
+    assert resp["success"] is True
+    assert {r["method"] for r in resp["results"]} == {"put"}
+    assert sorted(puts) == ["r-0", "r-1", "r-2"]
+
+
+@pytest.mark.anyio
+async def test_revert_rules_bulk_uses_concurrent_puts_when_import_fails(monkeypatch):
+    import asyncio
+
+    in_flight = 0
+    peak = 0
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        nonlocal in_flight, peak
+        if request.url.path.endswith("/_import"):
+            return httpx.Response(500, text="import disabled")
+        in_flight += 1
+        peak = max(peak, in_flight)
+        await asyncio.sleep(0.01)
+        in_flight -= 1
+        return httpx.Response(200, json={})
+
+    monkeypatch.setattr(sync_main, "REVERT_CONCURRENCY", 3)
+    monkeypatch.setattr(sync_main, "REVERT_IMPORT_CHUNK", 4)
+    async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+        monkeypatch.setattr(sync_main, "get_kibana_pool", lambda: _FakePool(client))
+        resp = await sync_main.api_revert_rules_bulk(sync_main.RevertRulesBulkRequest(
+            kibana_url="https://kibana.local",
+            api_key="k",
+            rules=[_rule(f"r-{i}") for i in range(10)],
+        ))
+
+    assert resp["success"] is True
+    assert [r["rule_id"] for r in resp["results"]] == [f"r-{i}" for i in range(10)]
+    assert {r["method"] for r in resp["results"]} == {"put"}
+    assert peak == 3
+
+
+@pytest.mark.anyio
+async def test_revert_exception_items_runs_concurrently_after_creating_lists(monkeypatch):
+    import asyncio
+
+    events = []
+    in_flight = 0
+    peak = 0
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        nonlocal in_flight, peak
+        path = request.url.path
+        if path == "/api/exception_lists":
+            if request.method == "GET":
+                return httpx.Response(404, json={})
+            events.append(("create_list", json.loads(request.content)["name"]))
+            return httpx.Response(200, json={})
+        in_flight += 1
+        peak = max(peak, in_flight)
+        await asyncio.sleep(0.01)
+        in_flight -= 1
+        if request.method == "POST":
+            events.append(("create_item", json.loads(request.content)["item_id"]))
+        return httpx.Response(200, json={})
+
+    def item(item_id, **extra):
+        return {"item_id": item_id, "list_id": "L1", "name": item_id, "id": "so-" + item_id, **extra}
+
+    monkeypatch.setattr(sync_main, "REVERT_CONCURRENCY", 2)
+    async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+        monkeypatch.setattr(sync_main, "get_kibana_pool", lambda: _FakePool(client))
+        resp = await sync_main.api_revert_exception_items(sync_main.RevertExceptionItemsRequest(
+            kibana_url="https://kibana.local",
+            api_key="k",
+            previous_items=[item("a"), item("b"), item("m", comment="old")],
+            current_items=[item("m", comment="new"), item("x")],
+            previous_lists=[{"list_id": "L1", "name": "Allow list"}],
+        ))
+
+    assert resp["success"] is True
+    assert resp["results"] == ["Recreated: a", "Recreated: b", "Deleted: x", "Reverted: m"]
+    assert events[0] == ("create_list", "Allow list")
+    assert sorted(events[1:]) == [("create_item", "a"), ("create_item", "b")]
+    assert peak == 2
+
+
+@pytest.mark.anyio
+async def test_detect_changes_matches_between_process_and_thread_pools(monkeypatch):
+    unchanged = _rule("r-same")
+    modified = _rule("r-mod", query="new query", exception_items=[{"item_id": "i-1"}])
+    monkeypatch.setattr(cd, "_export_via_api", _async_returning(([unchanged, modified, _rule("r-new")], [])))
+    monkeypatch.setattr(cd, "CPU_CHUNK_SIZE", 2)
+    monkeypatch.setattr(cd, "CPU_PARALLEL_THRESHOLD", 0)
+
+    results = []
+    for pool in (CpuPool(workers=1), CpuPool(workers=0)):
+        monkeypatch.setattr(cd, "get_cpu_pool", lambda: pool)
+        try:
+            results.append(await cd.detect_changes(
+                kibana_url="https://kibana.local",
+                api_key="dummy",
+                space="default",
+                baseline_snapshots=[_snapshot(unchanged), _snapshot(_rule("r-mod")), _snapshot(_rule("r-gone"))],
+                use_cli=False,
+            ))
+        finally:
+            pool.shutdown()
+
+    in_process, in_thread = results
+    assert in_process == in_thread
+    assert [(c["rule_id"], c["change_types"][0]) for c in in_process["changes"]] == [
+        ("r-mod", "query_changed"),
+        ("r-new", "new_rule"),
+        ("r-gone", "deleted_rule"),
+    ]
+
+
+def test_baseline_store_sees_commits_from_another_worker(tmp_path):
+    from baseline_store import BaselineStore
+
+    path = str(tmp_path / "baseline.db")
+    worker_a, worker_b = BaselineStore(path), BaselineStore(path)
+    worker_a.commit("https://kibana.local", "default", [{"rule_id": "r-1", "rule_hash": "h1"}])
+    assert worker_b.hashes("https://kibana.local", "default") == {"r-1": "h1"}
+
+    worker_a.commit("https://kibana.local", "default", [{"rule_id": "r-2", "rule_hash": "h2"}])
+    worker_b.commit("https://kibana.local", "default", [], deleted_rule_ids=["r-1"])
+    assert worker_a.hashes("https://kibana.local", "default") == {"r-2": "h2"}
+    assert worker_b.hashes("https://kibana.local", "default") == {"r-2": "h2"}
+
+
+@pytest.mark.anyio
+async def test_shared_cache_backs_hash_export_and_job_caches_across_workers(tmp_path, monkeypatch):
+    import asyncio
+
+    from job_queue import JobQueue
+    from shared_cache import SharedCache
+
+    path = str(tmp_path / "shared.db")
+    items = cd.canonical.ItemList([{"item_id": "i-1"}], "d1")
+    rule = dict(
+        _rule("r-1"), id="so-1", revision=3, updated_at="2024-01-01T00:00:00Z", _exception_items=items,
+    )
+    key = cd.RuleHashCache.fingerprint(rule)
+
+    worker_a, worker_b = cd.RuleHashCache(maxsize=10), cd.RuleHashCache(maxsize=10)
+    worker_a.shared, worker_b.shared = SharedCache(path), SharedCache(path)
+    worker_a.put_many([(key, "h1")])
+    assert worker_b.get_many([key, None]) == ["h1", None]
+    assert worker_b.stats()["shared_hits"] == 1
+
+    exports_a, exports_b = cd.ExportCache(ttl=60), cd.ExportCache(ttl=60)
+    exports_a.shared, exports_b.shared = worker_a.shared, worker_b.shared
+    space = cd.export_cache_key("https://kibana.local", "default", "k")
+    written = exports_a.put(space, [rule])
+    read = exports_b.get(space)
+    assert read["rules"] == [rule] and read["version"] == written["version"]
+    assert read["rules"][0]["_exception_items"].digest == "d1"
+    assert exports_b.get(space, max_age=-1) is None
+    # Detections keep their export to their own worker
+    other = cd.export_cache_key("https://kibana.local", "soc", "k")
+    exports_a.put(other, [rule], share=False)
+    assert exports_a.get(other) is not None and exports_b.get(other) is None
+
+    queue_a, queue_b = JobQueue(workers=1), JobQueue(workers=1)
+    queue_a.shared, queue_b.shared = worker_a.shared, worker_b.shared
+
+    async def run(job):
+        job.report("rules_fetched", 5)
+        return {"changes": []}
+
+    async def published(job_id, status):
+        # Writes happen in a thread, off the event loop
+        for _ in range(200):
+            found = await queue_b.get(job_id)
+            if found is not None and found.status == status:
+                return found
+            await asyncio.sleep(0.01)
+        raise AssertionError(f"job never reached {status}")
+
+    try:
+        job = queue_a.submit("detect-changes", run)
+        elsewhere = await published(job.id, "succeeded")
+        assert elsewhere.progress == {"rules_fetched": 5}
+        # Status polls do not load the result; the result endpoint does
+        assert elsewhere.result is None
+        assert await queue_b.result(elsewhere) == {"changes": []}
+        # Once published, the submitting worker reads it back too
+        local = await queue_a.get(job.id)
+        assert local.result is None
+        assert await queue_a.result(local) == {"changes": []}
+    finally:
+        await queue_a.stop()
+
+
+def _slow_chunk(chunk: list[int], delay: float) -> list[int]:
+    import time
+    # Later chunks finish first, so ordering comes from imap itself
+    time.sleep(delay / (chunk[0] + 1))
+    return [n * 2 for n in chunk]
+
+
+@pytest.mark.anyio
+async def test_cpu_pool_imap_keeps_chunk_order_with_bounded_window(monkeypatch):
+    pool = CpuPool(workers=0)
+    in_flight = []
+    real_run = pool.run
+
+    async def run(fn, *args):
+        in_flight.append(args[0][0])
+        return await real_run(fn, *args)
+
+    monkeypatch.setattr(pool, "workers", 3)
+    monkeypatch.setattr(pool, "run", run)
+    results = []
+    async for part in pool.imap(_slow_chunk, cd._chunks(list(range(10)), 2), 0.02):
+        results.append(part)
+        # Never more than `workers` chunks submitted ahead of the consumer
+        assert len(in_flight) <= len(results) + 3
+
+    assert [n for part in results for n in part] == [n * 2 for n in range(10)]
+
+
+def test_cpu_plan_shards_only_above_threshold(monkeypatch):
+    pool = CpuPool(workers=2)
+    monkeypatch.setattr(cd, "get_cpu_pool", lambda: pool)
+    monkeypatch.setattr(cd, "CPU_PARALLEL_THRESHOLD", 100)
+    monkeypatch.setattr(cd, "CPU_CHUNK_SIZE", 25)
+
+    small_pool, small_chunk = cd._cpu_plan(99)
+    assert small_pool is not pool and small_pool.workers == 0 and small_chunk == 99
+    assert cd._cpu_plan(100) == (pool, 25)
+
+
+def test_canonical_forms_match_json_dumps_and_are_computed_once_per_item(monkeypatch):
+    import canonical
+
+    shared = [
+        {"item_id": "b", "entries": [{"field": "host.name", "value": "x"}], "name": "B"},
+        {"name": "A", "item_id": "a", "entries": []},
+        {"item_id": "c", "comments": None, "tags": ["é", 1.5, True]},
+    ]
+    assert canonical.canonical_list(shared) == json.dumps(shared, sort_keys=True)
+    assert canonical.canonical_list([]) == json.dumps([], sort_keys=True)
+    assert canonical.sort_items(shared) == sorted(shared, key=lambda x: json.dumps(x, sort_keys=True))
+
+    # Within one texts scope the same item objects are serialized once
+    dumps = []
+    monkeypatch.setattr(canonical, "_dumps", lambda obj: dumps.append(obj) or json.dumps(obj, sort_keys=True))
+    texts: dict[int, str] = {}
+    for _ in range(50):
+        canonical.sort_items(shared, texts)
+    assert len(dumps) == len(shared) and len(texts) == len(shared)
+    # Nothing outlives the caller's scope
+    canonical.canonical_list(shared)
+    assert len(dumps) == 2 * len(shared)
+
+    previous = _rule("r-1", exception_items=[dict(item) for item in shared])
+    current = _rule("r-1", exception_items=[*shared[:2], dict(shared[2], tags=[])])
+    assert cd.classify_changes(previous, current) == ["exception_modified"]
+    assert cd.classify_changes(previous, _rule("r-1", exception_items=shared)) == ["modified_rule"]
+
+
+@pytest.mark.anyio
+async def test_shared_exception_lists_are_attached_once_and_hashed_by_digest_in_v2(monkeypatch):
+    import canonical
+
+    shared = {"list_id": "shared", "namespace_type": "single"}
+    extra = {"list_id": "extra", "namespace_type": "single"}
+    rules = [_rule(f"r-{i}", exceptions_list=[shared]) for i in range(20)]
+    rules.append(_rule("r-both", exceptions_list=[extra, shared]))
+    items = {
+        "shared": [{"item_id": f"s-{n}", "name": f"shared {n}"} for n in range(30)],
+        "extra": [{"item_id": "e-1", "name": "extra"}],
+    }
+    async with httpx.AsyncClient(transport=_kibana_transport(rules, [shared, extra], items)) as client:
+        exported, errors = await cd._export_via_api("https://kibana.local", "dummy", "default", client=client)
+
+    assert errors == []
+    # One item list object per combination of referenced lists
+    assert len({id(r["_exception_items"]) for r in exported[:20]}) == 1
+    assert exported[-1]["_exception_items"] == canonical.sort_items(
+        [*exported[0]["_exception_items"], {"item_id": "e-1", "name": "extra"}]
+    )
+
+    # v1 stays the detection-rules algorithm; v2 folds the items into a digest
+    rule = exported[0]
+    copy = json.loads(json.dumps(rule))
+    v1 = cd._compute_rule_hash_uncached(rule, 1)
+    assert v1 == cd._compute_rule_hash_uncached(copy, 1)
+    v2 = cd._compute_rule_hash_uncached(rule, 2)
+    assert v2 != v1
+    assert v2 == cd._compute_rule_hash_uncached(copy, 2)
+    changed = dict(copy, _exception_items=copy["_exception_items"][1:])
+    assert cd._compute_rule_hash_uncached(changed, 2) != v2
+
+    monkeypatch.setattr(cd, "RULE_HASH_VERSION", 2)
+    monkeypatch.setattr(cd, "rule_hash_cache", cd.RuleHashCache(maxsize=0))
+    # The digest attached with the export is carried, not recomputed, even
+    # through the CPU workers' pickling
+    assert rule["_exception_items"].digest == canonical.items_digest(copy["_exception_items"])
+    assert pickle.loads(pickle.dumps(rule))["_exception_items"].digest == rule["_exception_items"].digest
+    digests = []
+    monkeypatch.setattr(canonical, "_dumps", lambda obj: digests.append(obj) or json.dumps(obj, sort_keys=True))
+    hashes = await cd._hash_rules(exported)
+    assert hashes[0] == v2
+    assert not [obj for obj in digests if isinstance(obj, dict) and "item_id" in obj]